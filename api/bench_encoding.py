@@ -0,0 +1,86 @@
+"""Compares the size of JSON and MessagePack bodies, and the time it takes to encode and decode
+them: observation events as submitted by field clients, and entity lists as downloaded by map
+clients. Run from the api directory.
+
+The compact encoding (shared.encoding) makes the smallest bodies, gzipped or not, but it is not
+free: it decodes slower than JSON (taking about half as long again for observation events, and
+up to twice as long for entity lists, which are mostly small maps), and encodes about as fast as
+JSON, where plain MessagePack is several times faster than both."""
+import gzip
+import json
+import math
+import random
+import timeit
+import msgpack
+from shared import encoding
+from bench_validation import corpus
+
+ROUNDS = 200
+ENTITIES = 500
+
+
+def entities() -> list[dict]:
+    """An entity list like those of /entities/tile, half of them with a shape."""
+    rng = random.Random(0)
+    out = []
+    for i in range(ENTITIES):
+        longitude = round(-122.3 + rng.random() / 10, 7)
+        latitude = round(37.8 + rng.random() / 10, 7)
+        entity = {
+            "entity_type": "facility",
+            "location": {"longitude": longitude, "latitude": latitude},
+            "latest_observation_at": "2022-11-24T23:30:35+00:00",
+            "identifiers": [{"id_type": "generic", "id_text": f"facility-{i}"}],
+            "shape": None,
+            "observations": None,
+            "data": {
+                "observation_type": "facility",
+                "description": f"Facility {i}",
+                "functions": ["energy:electricity:voltage:lower"],
+            },
+        }
+        if i % 2:
+            ring = [
+                [
+                    round(longitude + math.cos(a * math.pi / 8) / 1000, 7),
+                    round(latitude + math.sin(a * math.pi / 8) / 1000, 7),
+                ]
+                for a in range(17)
+            ]
+            geometry = {"type": "Polygon", "coordinates": [ring]}
+            entity["shape"] = {
+                "type": "FeatureCollection",
+                "features": [{"type": "Feature", "geometry": geometry, "properties": {}}],
+            }
+        out.append(entity)
+    return out
+
+
+CODECS = {
+    "json": (lambda content: json.dumps(content).encode(), json.loads),
+    "msgpack": (msgpack.packb, msgpack.unpackb),
+    "msgpack, short keys and packed coordinates": (encoding.dumps, encoding.loads),
+}
+
+
+def main():
+    for name, bodies in [("observation events", corpus()), ("entity list", [entities()])]:
+        print(f"{name}:")
+        for codec, (dumps, loads) in CODECS.items():
+            encoded = [dumps(body) for body in bodies]
+            size = sum(len(body) for body in encoded)
+            gzipped = sum(len(gzip.compress(body)) for body in encoded)
+            encode = min(
+                timeit.repeat(lambda: [dumps(body) for body in bodies], number=ROUNDS, repeat=3)
+            )
+            decode = min(
+                timeit.repeat(lambda: [loads(body) for body in encoded], number=ROUNDS, repeat=3)
+            )
+            print(
+                f"  {codec}: {size} bytes ({gzipped} gzipped), "
+                f"encode {encode / ROUNDS * 1e6:.0f}µs, decode {decode / ROUNDS * 1e6:.0f}µs"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Compares the compiled observation validator used by /observations/bulk with full pydantic
+validation, on a corpus of valid observation events. Run from the api directory."""
+import json
+import timeit
+from shared.schemas import ObservationEvent
+from shared.validator import get_observation_validator
+
+ROUNDS = 2000
+
+
+def corpus() -> list[dict]:
+    """Valid observation events covering the observation types, scraped ones included."""
+    event = {
+        "observer": "test@example.com",
+        "source": "scrape",
+        "observed_at": "2022-11-24T23:30:35+0000",
+        "submitted_at": "2022-11-24T23:30:35+0000",
+        "location": {"longitude": -122.2850385, "latitude": 37.7987407},
+    }
+    square = [[[-122.29, 37.79], [-122.28, 37.79], [-122.28, 37.8], [-122.29, 37.79]]]
+    return [
+        {
+            **event,
+            "payload": [
+                {
+                    "payload_ref": "1",
+                    "observation_type": "asset",
+                    "asset_type": "container:multimodal_container:40ft",
+                    "configuration": "mounted:trailer",
+                    "asset_id": {"id_type": "BIC", "id_text": "CSQU 305438 3"},
+                },
+                {
+                    "payload_ref": "2",
+                    "observation_type": "asset",
+                    "asset_type": "vehicle:truck:semi_tractor",
+                    "configuration": "moving:road",
+                    "asset_id": {"id_type": "license_plate:united_states", "id_text": "1XYZ234"},
+                },
+                {
+                    "payload_ref": "3",
+                    "observation_type": "transport",
+                    "mode": "semi_trailer",
+                    "transporter": {"ref": "2"},
+                    "vessel": {"ref": "1"},
+                },
+            ],
+        },
+        {
+            **event,
+            "payload": {
+                "observation_type": "facility",
+                "description": "PG&E Substation C",
+                "functions": ["energy:electricity:voltage:lower"],
+                "props": {"operator": "PG&E"},
+            },
+        },
+        {
+            **event,
+            "payload": {
+                "observation_type": "extent",
+                "description": "Berkeley Aquatic Park",
+                "boundary_type": "administrative_boundary",
+                "landuse_type": "developed:open_space:park_rec_area[211]",
+                "shape": {
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "geometry": {"type": "Polygon", "coordinates": square},
+                            "properties": {},
+                        }
+                    ],
+                },
+            },
+        },
+        {
+            **event,
+            "payload": [
+                {
+                    "observation_type": "connection",
+                    "connection_type": "conductor:aluminum",
+                    "connection_function": "electricity:distribution:primary",
+                    "upstream": {"ref": "1"},
+                    "downstream": {"ref": "2"},
+                },
+                {
+                    "observation_type": "agriculture",
+                    "agriculture_type": "crop",
+                    "product": "cereal:wheat[11]",
+                },
+            ],
+        },
+    ]
+
+
+def full_validation(body: bytes):
+    """What /observations does with a body: a pydantic model, then the payload dicts."""
+    event = ObservationEvent.parse_raw(body)
+    payloads = event.payload if isinstance(event.payload, list) else [event.payload]
+    return [p.dict(exclude_unset=True) for p in payloads]
+
+
+def compiled_validation(body: bytes):
+    """What /observations/bulk does with an event."""
+    document = json.loads(body)
+    get_observation_validator()(document)
+    payloads = document["payload"]
+    return payloads if isinstance(payloads, list) else [payloads]
+
+
+def main():
+    bodies = [json.dumps(document).encode() for document in corpus()]
+    for body in bodies:
+        # both accept the corpus, and make the same payloads of it (pydantic turns references into
+        # strings, so the corpus uses strings)
+        assert json.loads(json.dumps(full_validation(body))) == compiled_validation(body)
+
+    for name, validate in [("pydantic", full_validation), ("compiled", compiled_validation)]:
+        seconds = min(
+            timeit.repeat(lambda: [validate(body) for body in bodies], number=ROUNDS, repeat=3)
+        )
+        per_event = seconds / (ROUNDS * len(bodies)) * 1e6
+        print(f"{name}: {per_event:.1f}µs per event")
+
+
+if __name__ == "__main__":
+    main()
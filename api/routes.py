@@ -1,15 +1,26 @@
 from typing import Optional
-from datetime import datetime, timedelta
-from fastapi import FastAPI, Depends, HTTPException, status
+import json
+import time
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import copy
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.routing import APIRoute
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy import select, insert, update, func
+from pydantic.datetime_parse import parse_datetime
+from sqlalchemy import select, insert, update, func, tuple_, union_all
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from prometheus_client import Counter as MetricCounter, Gauge, Histogram, make_asgi_app
 from geoalchemy2.shape import to_shape
-from shapely import Point, Polygon, to_geojson
+from shapely import Point, Polygon
+from shapely.geometry import mapping
 
 from shared.auth import (
     authenticate_user,
     create_access_token,
     get_password_hash,
+    is_bulk_importer,
     user_from_token,
 )
 from shared.schemas import (
@@ -20,31 +31,57 @@ from shared.schemas import (
     LatLongLocation,
     ExtentObservation,
     AgricultureObservation,
+    ResourceObservation,
+    SourceType,
     Entity as EntitySchema,
     Identifier,
 )
 from shared.db import (
     db,
+    db_replica,
+    read_db,
+    pool_stats,
     Users,
     ObservationEvents,
     Observations,
     Entity as EntityDB,
     EntityIdentifier,
-    # UserStats as UserStatsDB,
+    AssetPosition,
+    NetworkEdge,
     Rewards,
     create_transaction,
     create_reward,
     maybe_increase_level,
+    notify_observations,
+    record_daily_counts,
+    rolling_counts,
+    record_activity,
+    activity_time,
+    get_streaks,
+    record_territory,
+    get_territory,
+    INSERT_OBSERVATION_EVENT,
+    INSERT_OBSERVATION,
+    balance_at,
+    ledger_totals,
+    attribute_conditions,
+    attribute_taxa,
+    Accounts,
+    Entries,
 )
 from shared.models import (
     User,
     UserCreate,
     Token,
     Reward,
+    RewardsPage,
+    LedgerEntry,
+    LedgerPage,
     Interpretation,
     InterpretationRequest,
     UserUpdate,
-    # UserStats as UserStatsModel,
+    UserStats as UserStatsModel,
+    Territory,
 )
 from shared.util import (
     enum_to_dict,
@@ -52,23 +89,160 @@ from shared.util import (
     format_as_native,
     format_as_geojson,
     compute_reward,
+    observation_reward,
     tile_to_lat_lon_bbox,
     geohash_to_lat_lon_bbox,
+    canonicalize_identifier,
+    encode_cursor,
+    decode_cursor,
 )
+from shared.graph import NetworkGraph
+from shared.geocoder import get_geocoder
+from shared.leaderboard import leaderboard_top, leaderboard_rank
+from shared.querystats import start_request
+from shared.validator import SchemaError, get_observation_validator
+from shared import encoding
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+class MessagePackRequest(Request):
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = encoding.loads(await self.body())
+        return self._json
+
+
+class MessagePackResponse(Response):
+    media_type = encoding.MEDIA_TYPE
+
+    def render(self, content) -> bytes:
+        return encoding.dumps(content)
+
+
+def accepts_msgpack(accept: str) -> bool:
+    """Whether an Accept header asks for MessagePack."""
+    return any(
+        media_range.split(";")[0].strip().lower() in encoding.MEDIA_TYPES
+        for media_range in accept.split(",")
+    )
+
+
+class NegotiatedRoute(APIRoute):
+    """A route that takes request bodies as JSON or MessagePack (see shared.encoding), according
+    to their Content-Type, and gives its response as MessagePack if the Accept header asks for it,
+    and as JSON otherwise."""
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+        msgpack_route = copy.copy(self)
+        msgpack_route.response_class = MessagePackResponse
+        msgpack_handler = APIRoute.get_route_handler(msgpack_route)
+
+        async def handler(request: Request) -> Response:
+            content_type = request.headers.get("content-type", "")
+            if content_type.split(";")[0].strip().lower() in encoding.MEDIA_TYPES:
+                # FastAPI reads a body without a content type with Request.json, which decodes
+                # the MessagePack here
+                headers = [(k, v) for k, v in request.scope["headers"] if k != b"content-type"]
+                request = MessagePackRequest({**request.scope, "headers": headers}, request.receive)
+            if accepts_msgpack(request.headers.get("accept", "")):
+                response = await msgpack_handler(request)
+            else:
+                response = await json_handler(request)
+            response.headers.add_vary_header("Accept")
+            return response
+
+        return handler
+
+
 app = FastAPI()
+app.router.route_class = NegotiatedRoute
 app.debug = True
+app.mount("/metrics", make_asgi_app())
+
+DB_POOL_CONNECTIONS = Gauge(
+    "layers_db_pool_connections", "Connections in a database pool", ["pool", "state"]
+)
+DB_READS_ROUTED = Gauge(
+    "layers_db_reads_routed", "Read-only queries sent to each database since startup", ["pool"]
+)
+DB_REPLICA_LAG = Gauge("layers_db_replica_lag_seconds", "Last measured replication lag")
+for _pool, _database in [("primary", db), ("replica", db_replica)]:
+    if not _database:
+        continue
+    for _state in ("size", "idle", "max_size"):
+        DB_POOL_CONNECTIONS.labels(_pool, _state).set_function(
+            lambda database=_database, state=_state: pool_stats(database)[state]
+        )
+    DB_READS_ROUTED.labels(_pool).set_function(lambda pool=_pool: read_db.routed[pool])
+DB_REPLICA_LAG.set_function(lambda: read_db.lag if read_db.lag is not None else -1)
+
+REQUEST_DB_QUERIES = Histogram(
+    "layers_request_db_queries",
+    "Database queries made per request",
+    ["route"],
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200],
+)
+REQUEST_DB_SECONDS = Histogram(
+    "layers_request_db_seconds", "Time spent in database queries per request", ["route"]
+)
+REQUEST_SLOW_QUERIES = MetricCounter(
+    "layers_request_slow_queries", "Database queries over the slow query threshold", ["route"]
+)
+_route_paths: dict = {}
+
+
+def route_path(request: Request) -> str:
+    """The path template of the route that handled a request, e.g. /entities/{entity_id}/track."""
+    if not _route_paths:
+        _route_paths.update({r.endpoint: r.path for r in app.routes if hasattr(r, "endpoint")})
+    return _route_paths.get(request.scope.get("endpoint"), "unmatched")
+
+
+@app.middleware("http")
+async def query_stats(request: Request, call_next):
+    """Count and time the database queries made for each request, and report them in a
+    Server-Timing header and in the request metrics."""
+    stats = start_request()
+    response = await call_next(request)
+    response.headers["Server-Timing"] = stats.server_timing()
+    route = route_path(request)
+    REQUEST_DB_QUERIES.labels(route).observe(stats.count)
+    REQUEST_DB_SECONDS.labels(route).observe(stats.seconds)
+    if stats.slow:
+        REQUEST_SLOW_QUERIES.labels(route).inc(stats.slow)
+    return response
+
+# the observation types reported in user stats, and the names of their counts
+STATS_COUNTS = {
+    "asset": "assets",
+    "facility": "facilities",
+    "resource": "resources",
+    "transport": "transports",
+    "extent": "extents",
+}
+
+# the utility network graph is rebuilt from the database at most this often (in seconds)
+NETWORK_GRAPH_TTL = 300
+_network_graph: Optional[NetworkGraph] = None
+_network_graph_loaded_at = 0.0
+_network_graph_lock = asyncio.Lock()
 
 
 @app.on_event("startup")
 async def startup():
     await db.connect()
+    await read_db.connect()
+    # load the boundary datasets up front, rather than in the first request that needs them
+    await asyncio.to_thread(get_geocoder)
+    get_observation_validator()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     await db.disconnect()
+    await read_db.disconnect()
 
 
 @app.get("/")
@@ -87,7 +261,7 @@ async def root(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/facility-functions")
 async def facility_functions(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(FacilityObservation.FacilityFunction, alpha=True)
@@ -95,7 +269,7 @@ async def facility_functions(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/facility-processes")
 async def facility_processes(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(FacilityObservation.FacilityProcess, alpha=True)
@@ -103,7 +277,7 @@ async def facility_processes(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/asset-types")
 async def asset_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     out = enum_to_dict(AssetObservation.ContainerType, alpha=True)
@@ -113,7 +287,7 @@ async def asset_types(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/asset-configurations")
 async def asset_configurations(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(AssetObservation.AssetConfiguration, alpha=True)
@@ -121,7 +295,7 @@ async def asset_configurations(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/transport-modes")
 async def transport_modes(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(TransportObservation.TransportMode, alpha=True)
@@ -129,7 +303,7 @@ async def transport_modes(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/agriculture-types")
 async def agriculture_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(AgricultureObservation.AgricultureType, alpha=True)
@@ -137,7 +311,7 @@ async def agriculture_types(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/agriculture-crop-types")
 async def crop_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(AgricultureObservation.CropType, alpha=True)
@@ -145,7 +319,7 @@ async def crop_types(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/agriculture-livestock-types")
 async def livestock_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(AgricultureObservation.LiveStockType, alpha=True)
@@ -153,7 +327,7 @@ async def livestock_types(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/extent-boundary-types")
 async def boundary_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(ExtentObservation.BoundaryType, alpha=True)
@@ -161,12 +335,51 @@ async def boundary_types(token: str = Depends(oauth2_scheme)):
 
 @app.get("/meta/extent-land-use-types")
 async def landuse_types(token: str = Depends(oauth2_scheme)):
-    user = await user_from_token(token, db)
+    user = await user_from_token(token, read_db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return enum_to_dict(ExtentObservation.LandUseType, alpha=True)
 
 
+@app.get("/meta/field-keys")
+async def field_keys(token: str = Depends(oauth2_scheme)):
+    """The integer keys that stand for field names in MessagePack bodies."""
+    user = await user_from_token(token, read_db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return encoding.field_keys()
+
+
+@app.get("/meta/resource-types")
+async def resource_types(token: str = Depends(oauth2_scheme)):
+    user = await user_from_token(token, read_db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return enum_to_dict(ResourceObservation.ResourceType, alpha=True)
+
+
+def attribute_filters(
+    asset_type: Optional[str] = None,
+    configuration: Optional[str] = None,
+    resource_type: Optional[str] = None,
+    connection_type: Optional[str] = None,
+    facility_function: Optional[str] = None,
+    facility_process: Optional[str] = None,
+) -> dict[str, str]:
+    """Filters on payload attributes, keyed by the attribute columns they apply to (see
+    shared.db.attribute_conditions). A value ending in * matches everything under it in the
+    attribute's hierarchy, e.g. asset_type=container:* or resource_type=provision:mineral:*"""
+    filters = {
+        "asset_type": asset_type,
+        "configuration": configuration,
+        "resource_type": resource_type,
+        "connection_type": connection_type,
+        "facility_functions": facility_function,
+        "facility_processes": facility_process,
+    }
+    return {name: value for name, value in filters.items() if value}
+
+
 @app.get("/users/me")
 async def user_info(token: str = Depends(oauth2_scheme)):
     user = await user_from_token(token, db)
@@ -175,25 +388,103 @@ async def user_info(token: str = Depends(oauth2_scheme)):
     return user.dict()
 
 
-@app.get(
-    "/users/me/rewards",
-    response_model=list[Reward],
-)
-async def user_rewards(token: str = Depends(oauth2_scheme)):
+def _page_position(cursor: Optional[str]):
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/users/me/rewards", response_model=RewardsPage)
+async def user_rewards(
+    cursor: Optional[str] = None, limit: int = 10, token: str = Depends(oauth2_scheme)
+):
+    """The current user's rewards, newest first, a page at a time. Pass the next_cursor of a page
+    to get the page after it."""
     user = await user_from_token(token, db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    # get most recent rewards
+    limit = max(1, min(limit, 100))
+    position = _page_position(cursor)
     query = (
-        select(Rewards)
+        select(Rewards.id, Rewards.amount, Rewards.created_at)
         .where(Rewards.username == user.username)
-        .join(ObservationEvents, Rewards.observation_event_id == ObservationEvents.id)
-        .order_by(Rewards.created_at.desc())
-        .limit(10)
+        .order_by(Rewards.created_at.desc(), Rewards.id.desc())
+        .limit(limit + 1)
     )
+    if position:
+        query = query.where(tuple_(Rewards.created_at, Rewards.id) < position)
     rewards = await db.fetch_all(query)
-    return [Reward(amount=r.amount, created_at=r.created_at) for r in rewards]
+
+    next_cursor = None
+    if len(rewards) > limit:
+        rewards = rewards[:limit]
+        next_cursor = encode_cursor(rewards[-1].created_at, rewards[-1].id)
+    totals = await ledger_totals(user.username)
+    return RewardsPage(
+        rewards=[Reward(amount=r.amount, created_at=r.created_at) for r in rewards],
+        next_cursor=next_cursor,
+        totals=totals["reward"],
+    )
+
+
+@app.get("/users/me/ledger", response_model=LedgerPage)
+async def user_ledger(
+    cursor: Optional[str] = None, limit: int = 10, token: str = Depends(oauth2_scheme)
+):
+    """The ledger entries into and out of the current user's account, newest first, a page at a
+    time. Pass the next_cursor of a page to get the page after it."""
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    limit = max(1, min(limit, 100))
+    position = _page_position(cursor)
+    columns = [
+        Entries.id,
+        Entries.from_username,
+        Entries.to_username,
+        Entries.amount,
+        Entries.txtype,
+        Entries.created_at,
+    ]
+    # each side is a range scan of its own index; entries from the user to themselves are only
+    # taken from the incoming side
+    sides = []
+    for side in (
+        Entries.to_username == user.username,
+        (Entries.from_username == user.username)
+        & Entries.to_username.is_distinct_from(user.username),
+    ):
+        query = (
+            select(*columns)
+            .where(side)
+            .order_by(Entries.created_at.desc(), Entries.id.desc())
+            .limit(limit + 1)
+        )
+        if position:
+            query = query.where(tuple_(Entries.created_at, Entries.id) < position)
+        sides.append(query)
+    both = union_all(*sides).subquery()
+    entries = await db.fetch_all(
+        select(both).order_by(both.c.created_at.desc(), both.c.id.desc()).limit(limit + 1)
+    )
+
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        next_cursor = encode_cursor(entries[-1].created_at, entries[-1].id)
+    totals = await ledger_totals(user.username)
+    return LedgerPage(
+        entries=[
+            LedgerEntry(**{k: v for k, v in e._mapping.items() if k != "id"}) for e in entries
+        ],
+        next_cursor=next_cursor,
+        totals={kind: totals[kind] for kind in ("credit", "debit")},
+    )
 
 
 @app.patch("/users/me")
@@ -222,53 +513,100 @@ async def update_user(updated_user: UserUpdate, token: str = Depends(oauth2_sche
     return user.dict()
 
 
-# @app.get("/users/me/stats")
-# async def user_stats(token: str = Depends(oauth2_scheme)) -> UserStatsModel:
-#     user = await user_from_token(token, db)
-#     if not user:
-#         raise HTTPException(status_code=401, detail="Not authenticated")
+@app.get("/users/me/stats", response_model=UserStatsModel)
+async def user_stats(token: str = Depends(oauth2_scheme)):
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    now = datetime.now(timezone.utc)
+    counts = await rolling_counts(user.username, now.date())
+    current_streak, longest_streak = await get_streaks(user.username, now.date())
+
+    def to_counts(by_type: dict[str, int]) -> UserStatsModel.Counts:
+        return UserStatsModel.Counts(
+            **{plural: by_type.get(obs_type, 0) for obs_type, plural in STATS_COUNTS.items()}
+        )
+
+    last_day = counts.pop("last_day")
+    return UserStatsModel(
+        username=user.username,
+        created_at=now.isoformat(),
+        last_observation=last_day.isoformat() if last_day else "",
+        current_streak=current_streak,
+        longest_streak=longest_streak,
+        **{f"counts_{name}": to_counts(by_type) for name, by_type in counts.items()},
+    )
+
 
-#     return await get_user_stats(user)
+@app.get("/users/me/territory", response_model=Territory)
+async def user_territory(token: str = Depends(oauth2_scheme)):
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
 
+    return Territory(username=user.username, **await get_territory(user.username))
 
-# async def get_user_stats(user: User, max_age: int = 0) -> UserStatsModel:
-#     latest_stats: UserStatsModel | None = await get_latest_user_stats(user)
-#     if latest_stats:
-#         return latest_stats
-#     else:
-#         return await compute_user_stats(user)
 
+@app.get("/users/me/balance")
+async def user_balance(at: Optional[datetime] = None, token: str = Depends(oauth2_scheme)):
+    """The current user's balance according to the ledger as of a time (by default, now)."""
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
 
-# async def get_latest_user_stats(user: User) -> UserStatsModel | None:
-#     """Get the latest user stats from the database, or None if the user's stats have never been calculated ."""
-#     query = (
-#         select(UserStatsDB)
-#         .where(UserStatsDB.username == user.username)
-#         .order_by(UserStatsDB.created_at.desc())
-#         .limit(1)
-#     )
-#     result = await db.fetch_one(query)
-#     if result:
-#         return None
-#         # stats = UserStatsModel(**result)
-#         # return stats
-#     else:
-#         return None
+    if at is None:
+        at = datetime.now(timezone.utc)
+    elif at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    account = await db.fetch_one(select(Accounts.id).where(Accounts.username == user.username))
+    if not account:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return {"balance": await balance_at(account.id, at), "at": at.isoformat()}
 
 
-# async def compute_user_stats(user: User) -> UserStatsModel:
-#     """Compute the user's stats, save them to the database, and return them."""
-#     query = select(ObservationEvents).where(
-#         ObservationEvents.observer == user.username
-#         or ObservationEvents.observer == user.email
-#     )
-#     result = await db.fetch_all(query)
+# the most users that a leaderboard lists
+LEADERBOARD_MAX_LIMIT = 100
 
-#     ins = insert(UserStatsDB).values()
-#     await db.execute(ins)
 
-#     stats = UserStatsModel()
-#     return stats
+async def _leaderboard(name: str, scope: str, limit: int, token: str):
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    return {
+        "top": await leaderboard_top(name, scope, limit),
+        "me": await leaderboard_rank(name, scope, user.username),
+    }
+
+
+@app.get("/leaderboard")
+async def global_leaderboard(
+    limit: int = Query(10, ge=1, le=LEADERBOARD_MAX_LIMIT), token: str = Depends(oauth2_scheme)
+):
+    """The users with the most XP, and the current user's rank."""
+    return await _leaderboard("leaderboard_global", "all", limit, token)
+
+
+@app.get("/leaderboard/types/{observation_type}")
+async def observation_type_leaderboard(
+    observation_type: str,
+    limit: int = Query(10, ge=1, le=LEADERBOARD_MAX_LIMIT),
+    token: str = Depends(oauth2_scheme),
+):
+    """The users with the most observations of a type, and the current user's rank."""
+    return await _leaderboard("leaderboard_observation_type", observation_type, limit, token)
+
+
+@app.get("/leaderboard/regions/{region}")
+async def region_leaderboard(
+    region: str,
+    limit: int = Query(10, ge=1, le=LEADERBOARD_MAX_LIMIT),
+    token: str = Depends(oauth2_scheme),
+):
+    """The users with the most XP earned in a region (a geohash of REGION_PRECISION characters),
+    and the current user's rank."""
+    return await _leaderboard("leaderboard_region", region.lower(), limit, token)
 
 
 @app.post("/users", status_code=201)
@@ -363,60 +701,135 @@ async def observations_open(observation: ObservationEvent):
     return await _observations(observation)
 
 
-async def _observations(observation_event: ObservationEvent, user: User | None = None):
-    if isinstance(observation_event.payload, list):
-        count = len(observation_event.payload)
-    else:
-        count = 1
+@app.post(
+    "/observations/bulk",
+    responses={
+        201: {"description": "Observations created"},
+        400: {"description": "Invalid payload"},
+        403: {"description": "Not a bulk importer"},
+    },
+    status_code=201,
+)
+async def observations_bulk(request: Request, token: str = Depends(oauth2_scheme)):
+    """Import a batch of observation events from a trusted bulk source (source "scrape"), as a
+    JSON or MessagePack array of events. Only users with the bulk importer role (see
+    shared.auth.BULK_IMPORTERS) may import. The events are checked by the compiled observation
+    validator rather than parsed into pydantic models, and stored straight from the decoded body;
+    one invalid event rejects the whole batch."""
+    user = await user_from_token(token, db)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not is_bulk_importer(user):
+        raise HTTPException(status_code=403, detail="Not allowed to import observations in bulk")
+    try:
+        documents = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid body")
+    if not isinstance(documents, list):
+        raise HTTPException(status_code=400, detail="Expected an array of observation events")
+
+    validate = get_observation_validator()
+    for i, document in enumerate(documents):
+        try:
+            validate(document)
+        except SchemaError as e:
+            raise HTTPException(status_code=400, detail=str(e.within(i)))
+        if document["source"] != SourceType.SCRAPE:
+            raise HTTPException(status_code=400, detail=f"/{i}/source: must be scrape")
+        if "longitude" not in document["location"]:
+            raise HTTPException(
+                status_code=400, detail=f"/{i}/location: only LatLongLocation is supported"
+            )
+
+    async with db.transaction():
+        for document in documents:
+            payloads = document["payload"]
+            if not isinstance(payloads, list):
+                payloads = [payloads]
+            event = {
+                "observer": document["observer"],
+                "source": document["source"],
+                "observed_at": parse_datetime(document["observed_at"]),
+                "submitted_at": parse_datetime(document["submitted_at"]),
+                "location": document["location"],
+            }
+            await store_observation_event(
+                user.username, event, payloads, observation_reward(len(payloads))
+            )
+    return {"msg": "success", "count": len(documents)}
+
 
+async def _observations(observation_event: ObservationEvent, user: User | None = None):
     username = "beau"
     if user:
         username = user.username
 
+    if not isinstance(observation_event.location, LatLongLocation):
+        raise NotImplementedError("Only LatLongLocation is supported at the moment")
+    p = observation_event.payload
+    if not isinstance(p, list):
+        p = [p]
+
+    event = {
+        "observer": observation_event.observer,
+        "source": observation_event.source,
+        "observed_at": observation_event.observed_at,
+        "submitted_at": observation_event.submitted_at,
+        "location": observation_event.location.dict(),
+    }
     async with db.transaction():
-        geo = None
-        if isinstance(observation_event.location, LatLongLocation):
-            loc = observation_event.location
-            geo = f"POINT({loc.longitude} {loc.latitude})"
-        else:
-            raise NotImplementedError("Only LatLongLocation is supported at the moment")
-
-        query = insert(ObservationEvents).values(
-            # user_id=user.username,
-            username=username,
-            observer=observation_event.observer,
-            source=observation_event.source,
-            observed_at=observation_event.observed_at,
-            submitted_at=observation_event.submitted_at,
-            location=observation_event.location.dict(),
-            observation_count=count,
-            geo=geo,
+        await store_observation_event(
+            username,
+            event,
+            [pld.dict(exclude_unset=True) for pld in p],
+            compute_reward(observation_event),
         )
-        result = await db.execute(query)
-        event_id = result
-        p = observation_event.payload
-        if not isinstance(p, list):
-            p = [p]
-
-        for pld in p:
-            obs = {
-                "event_id": event_id,
-                "observation_type": pld.observation_type,
-                "payload": pld.dict(exclude_unset=True),
-            }
-            if "shape" in obs["payload"]:
-                shape = obs["payload"]["shape"]
-                obs["geo"] = func.ST_GeomFromGeoJSON(shape["features"][0]["geometry"])
-            query = insert(Observations).values(**obs)
-            result = await db.execute(query)
 
-        reward = compute_reward(observation_event)
+    return {"msg": "success"}
+
 
-        await create_reward(username, reward, event_id)
-        await create_transaction("house", username, reward, "observation")
-        await maybe_increase_level(username)
+async def store_observation_event(username: str, event: dict, payloads: list[dict], reward: int):
+    """Store an observation event, given as the columns of its observation_events row and the
+    payloads of its observations, and credit the user for it. The location must be a
+    LatLongLocation. This must be done in a transaction (assumed to be handled by the caller)."""
+    loc = event["location"]
+    geo = f"POINT({loc['longitude']} {loc['latitude']})"
+    event_id = await db.execute(
+        INSERT_OBSERVATION_EVENT,
+        {
+            "username": username,
+            **event,
+            "observation_count": len(payloads),
+            "geo": geo,
+        },
+    )
 
-    return {"msg": "success"}
+    obs_counts = Counter()
+    for payload in payloads:
+        obs_counts[payload["observation_type"]] += 1
+        obs = {
+            "event_id": event_id,
+            "submitted_at": event["submitted_at"],
+            "observation_type": payload["observation_type"],
+            "payload": payload,
+        }
+        obs.update(attribute_taxa(payload))
+        if "shape" in payload:
+            shape = payload["shape"]
+            obs["geo"] = func.ST_GeomFromGeoJSON(shape["features"][0]["geometry"])
+            await db.execute(insert(Observations).values(**obs))
+        else:
+            await db.execute(INSERT_OBSERVATION, obs)
+
+    active_at = activity_time(event["observed_at"])
+    await record_daily_counts(username, active_at, obs_counts)
+    await record_activity(username, active_at)
+    await record_territory(username, float(loc["longitude"]), float(loc["latitude"]))
+
+    await create_reward(username, reward, event_id)
+    await create_transaction("house", username, reward, "observation")
+    await maybe_increase_level(username)
+    await notify_observations(event_id)
 
 
 @app.get("/observations")
@@ -424,9 +837,11 @@ async def get_observations(
     obs_type: Optional[str] = None,
     fmt: str = "native",
     max_age: int = 0,
+    filters: dict[str, str] = Depends(attribute_filters),
     token: str = Depends(oauth2_scheme),
 ):
-    """Get the observations for the current user, within a certain area, optionally of a certain type."""
+    """Get the observations for the current user, within a certain area, optionally of a certain
+    type and with certain payload attributes."""
     user = await user_from_token(token, db)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
@@ -434,15 +849,19 @@ async def get_observations(
     query = (
         select(ObservationEvents)
         .where(ObservationEvents.observer == user.username)
-        .join(Observations)
+        .join(ObservationEvents.observations)
     )
     if obs_type:
         query = query.where(Observations.observation_type == obs_type)
+    if filters:
+        query = query.where(*attribute_conditions(Observations, filters))
     if max_age > 0:
+        # filter both tables on their partition key, so that both are pruned
+        since = datetime.now() - timedelta(minutes=max_age)
         query = query.where(
-            ObservationEvents.submitted_at > datetime.now() - timedelta(minutes=max_age)
+            ObservationEvents.submitted_at > since, Observations.submitted_at > since
         )
-    result = await db.fetch_all(query)
+    result = await read_db.fetch_all(query)
 
     if fmt == "native":
         return format_as_native(result)
@@ -454,20 +873,30 @@ async def get_observations(
 
 @app.get("/entities/geohash/{geohash}.{fmt}")
 async def get_entities_geohash(
-    geohash: str, fmt: str, entity_type: Optional[str] = None
+    geohash: str,
+    fmt: str,
+    entity_type: Optional[str] = None,
+    filters: dict[str, str] = Depends(attribute_filters),
 ):
-    """Get the entities within a certain area, optionally of a certain type."""
+    """Get the entities within a certain area, optionally of a certain type and with certain
+    attributes."""
     (south, west, north, east) = geohash_to_lat_lon_bbox(geohash)
-    return await get_entities_bbox(south, west, north, east, fmt, entity_type)
+    return await get_entities_bbox(south, west, north, east, fmt, entity_type, filters)
 
 
 @app.get("/entities/tile/{z}/{x}/{y}.{fmt}")
 async def get_entities_tile(
-    z: int, x: int, y: int, fmt: str, entity_type: Optional[str] = None
+    z: int,
+    x: int,
+    y: int,
+    fmt: str,
+    entity_type: Optional[str] = None,
+    filters: dict[str, str] = Depends(attribute_filters),
 ):
-    """Get the entities within a certain area, optionally of a certain type."""
+    """Get the entities within a certain area, optionally of a certain type and with certain
+    attributes."""
     (south, west, north, east) = tile_to_lat_lon_bbox(z=z, y=y, x=x)
-    return await get_entities_bbox(south, west, north, east, fmt, entity_type)
+    return await get_entities_bbox(south, west, north, east, fmt, entity_type, filters)
 
 
 async def get_entities_bbox(
@@ -477,6 +906,7 @@ async def get_entities_bbox(
     east: float,
     fmt: str = "json",
     entity_type: Optional[str] = None,
+    filters: Optional[dict[str, str]] = None,
 ):
     query = (
         select(EntityDB)
@@ -491,7 +921,9 @@ async def get_entities_bbox(
     )
     if entity_type:
         query = query.where(EntityDB.entity_type == entity_type)
-    result = await db.fetch_all(query)
+    if filters:
+        query = query.where(*attribute_conditions(EntityDB, filters))
+    result = await read_db.fetch_all(query)
     entities = [EntityDB(**dict(r)) for r in result if r is not None]
 
     out = []
@@ -500,7 +932,7 @@ async def get_entities_bbox(
             continue
 
         subquery = select(EntityIdentifier).where(EntityIdentifier.entity_id == e.id)
-        e.identifiers = await db.fetch_all(subquery)
+        e.identifiers = await read_db.fetch_all(subquery)
 
         # convert the location from a geoalchemy WKBElement to a shapely Point geometry
         shape: Point = to_shape(e.location)
@@ -514,9 +946,13 @@ async def get_entities_bbox(
             ],
         )
         if e.shape:
-            # convert the shape from a geoalchemy WKBElement to a 
+            # convert the shape from a geoalchemy WKBElement to a
             # geojson FeatureCollection
-            es.shape = to_geojson(to_shape(e.shape))
+            geometry = mapping(to_shape(e.shape))
+            es.shape = {
+                "type": "FeatureCollection",
+                "features": [{"type": "Feature", "geometry": geometry, "properties": {}}],
+            }
         if e.data:
             es.data = e.data
         out.append(es)
@@ -524,6 +960,140 @@ async def get_entities_bbox(
     return out
 
 
+@app.get("/entities/{entity_id}/position")
+async def get_entity_position(entity_id: int):
+    """Get the last known position of an asset."""
+    query = (
+        select(
+            AssetPosition.observed_at,
+            func.ST_X(AssetPosition.geo).label("longitude"),
+            func.ST_Y(AssetPosition.geo).label("latitude"),
+        )
+        .where(AssetPosition.entity_id == entity_id)
+        .order_by(AssetPosition.observed_at.desc())
+        .limit(1)
+    )
+    result = await read_db.fetch_one(query)
+    if not result:
+        raise HTTPException(status_code=404, detail="No known position")
+    return {
+        "observed_at": result.observed_at,
+        "location": LatLongLocation(longitude=result.longitude, latitude=result.latitude),
+    }
+
+
+@app.get("/entities/{entity_id}/track")
+async def get_entity_track(
+    entity_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    tolerance: float = 0.0001,
+):
+    """Get the track of an asset within a time window (by default, the last 7 days) as a GeoJSON
+    LineString feature. The line is simplified on the server, to within tolerance degrees."""
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=7)
+    line = func.ST_MakeLine(aggregate_order_by(AssetPosition.geo, AssetPosition.observed_at))
+    query = select(
+        func.ST_AsGeoJSON(func.ST_Simplify(line, tolerance)).label("geometry"),
+        func.count().label("positions"),
+    ).where(
+        AssetPosition.entity_id == entity_id,
+        AssetPosition.observed_at >= start,
+        AssetPosition.observed_at < end,
+    )
+    result = await read_db.fetch_one(query)
+    return {
+        "type": "Feature",
+        "geometry": json.loads(result.geometry) if result.geometry else None,
+        "properties": {
+            "entity_id": entity_id,
+            "start": start,
+            "end": end,
+            "positions": result.positions,
+        },
+    }
+
+
+@app.get("/entities/identifiers")
+async def search_identifiers(q: str, id_type: Optional[str] = None, limit: int = 10):
+    """Find the entity identifiers most similar to q, e.g. to look up a container code or license
+    plate that was only partially (or wrongly) read."""
+    canonical = canonicalize_identifier(q)
+    similarity = func.similarity(EntityIdentifier.identifier_canonical, canonical)
+    query = (
+        select(
+            EntityIdentifier.entity_id,
+            EntityIdentifier.id_type,
+            EntityIdentifier.identifier,
+            similarity.label("similarity"),
+        )
+        # the % operator is served by the trigram index on identifier_canonical
+        .where(EntityIdentifier.identifier_canonical.op("%")(canonical))
+        .order_by(similarity.desc())
+        .limit(min(limit, 100))
+    )
+    if id_type:
+        query = query.where(EntityIdentifier.id_type == id_type)
+    result = await read_db.fetch_all(query)
+    return [dict(r._mapping) for r in result]
+
+
+async def get_network_graph() -> NetworkGraph:
+    """The utility network graph, loaded from network_edges and kept in memory for
+    NETWORK_GRAPH_TTL seconds."""
+    global _network_graph, _network_graph_loaded_at
+    async with _network_graph_lock:
+        if (
+            _network_graph is None
+            or time.monotonic() - _network_graph_loaded_at > NETWORK_GRAPH_TTL
+        ):
+            # two arrays in a single row are much cheaper to fetch than a row per edge
+            query = select(
+                func.array_agg(NetworkEdge.upstream_id).label("upstream"),
+                func.array_agg(NetworkEdge.downstream_id).label("downstream"),
+            )
+            result = await read_db.fetch_one(query)
+            _network_graph = NetworkGraph(result.upstream or [], result.downstream or [])
+            _network_graph_loaded_at = time.monotonic()
+    return _network_graph
+
+
+@app.get("/network/{entity_id}/downstream")
+async def network_downstream(entity_id: int, max_depth: Optional[int] = None):
+    """Get the ids of the entities downstream of an entity in the utility network, optionally
+    only those within max_depth connections."""
+    graph = await get_network_graph()
+    return graph.downstream(entity_id, max_depth)
+
+
+@app.get("/network/{entity_id}/upstream")
+async def network_upstream(entity_id: int, max_depth: Optional[int] = None):
+    """Get the ids of the entities upstream of an entity in the utility network, optionally only
+    those within max_depth connections."""
+    graph = await get_network_graph()
+    return graph.upstream(entity_id, max_depth)
+
+
+@app.get("/network/{entity_id}/component")
+async def network_component(entity_id: int):
+    """Get the ids of all entities connected to an entity in the utility network, in either
+    direction."""
+    graph = await get_network_graph()
+    return graph.component(entity_id)
+
+
+@app.get("/network/path")
+async def network_path(source: int, target: int, directed: bool = True):
+    """Get the ids of the entities along a path with the fewest connections from source to
+    target."""
+    graph = await get_network_graph()
+    path = graph.shortest_path(source, target, directed)
+    if path is None:
+        raise HTTPException(status_code=404, detail="No path found")
+    return path
+
+
 @app.post("/interpretation", response_model=Interpretation)
 async def interpretation(
     req: InterpretationRequest, token: str = Depends(oauth2_scheme)
@@ -29,6 +29,7 @@ job "api" {
         VIRTUAL_ENV = "/Users/beau/venv"
         LAYERS_SECRET_KEY = "FIXME"
         DB_CREDS = "FIXME"
+        LAYERS_BOUNDARIES_PATH = "/Users/beau/layers/boundaries"
       }
     }
   }
@@ -0,0 +1,30 @@
+// A Nomad job file for running the platon observation processor as a long-running daemon. Like the API job, this is
+// currently implemented as a raw_exec job that runs directly on the host machine.
+
+job "platon" {
+  region      = "global"
+  datacenters = ["dc1"]
+
+  type = "service"
+
+  group "main" {
+    count = 1
+
+    task "daemon" {
+      driver = "raw_exec"
+
+      config {
+        command = "/Users/beau/venv/bin/python"
+        args    = ["/Users/beau/layers/platon/process.py", "daemon"]
+      }
+      env {
+        VIRTUAL_ENV = "/Users/beau/venv"
+        DB_CREDS = "FIXME"
+      }
+
+      // give the daemon time to commit its current batch on shutdown
+      kill_signal  = "SIGTERM"
+      kill_timeout = "30s"
+    }
+  }
+}
@@ -0,0 +1,160 @@
+from typing import Optional
+import re
+from collections import OrderedDict
+from shared.util import is_valid_bic
+
+
+IdentifierKey = tuple[str, str]
+
+# the id_type of container codes, as in shared.schemas.Identifier.IDType.BIC (not imported here,
+# since the schemas are slow to import)
+BIC_ID_TYPE = "BIC"
+
+
+class IdentifierCache:
+    """A bounded LRU map from (id_type, canonical identifier) to the id of the entity that owns the
+    identifier. It lives for as long as the worker process, across batches.
+
+    Entries learned inside a transaction are only staged until that transaction commits, so that a
+    rolled back batch can never leave behind entity ids that do not exist."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[IdentifierKey, int] = OrderedDict()
+        self._pending: dict[IdentifierKey, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: IdentifierKey) -> bool:
+        return key in self._pending or key in self._entries
+
+    def get(self, key: IdentifierKey) -> Optional[int]:
+        entity_id = self._pending.get(key)
+        if entity_id is None:
+            entity_id = self._entries.get(key)
+            if entity_id is not None:
+                self._entries.move_to_end(key)
+        if entity_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entity_id
+
+    def put(self, key: IdentifierKey, entity_id: int):
+        self._pending[key] = entity_id
+
+    def commit(self):
+        """Make the entries staged since the last commit or rollback visible to later batches."""
+        for key, entity_id in self._pending.items():
+            self._entries[key] = entity_id
+            self._entries.move_to_end(key)
+        self._pending.clear()
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def rollback(self):
+        self._pending.clear()
+
+    def savepoint(self) -> dict[IdentifierKey, int]:
+        """The staged entries, to undo the entries staged after this point with rollback_to."""
+        return dict(self._pending)
+
+    def rollback_to(self, savepoint: dict[IdentifierKey, int]):
+        self._pending = savepoint
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def compact_identifier(canonical: str) -> str:
+    """Reduce a canonical identifier to its letters and digits, since OCR readings often drop or
+    invent separators."""
+    return re.sub(r"[^0-9a-z]", "", canonical.lower())
+
+
+def edit_distance(a: str, b: str) -> int:
+    """The Levenshtein distance between two strings."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            )
+        previous = current
+    return previous[-1]
+
+
+class FuzzyIdentifierIndex:
+    """A symmetric-delete index over asset identifiers, for matching identifiers that were read with
+    OCR errors. Every stored identifier is indexed under each string that can be made from it by
+    deleting up to max_distance characters; a lookup generates the same deletions of the query, so
+    finding all identifiers within max_distance edits takes a handful of dict probes rather than
+    a scan. Identifiers are partitioned by id_type."""
+
+    def __init__(self, max_distance: int = 1):
+        self.max_distance = max_distance
+        # the highest entity_identifiers.id loaded so far, for incremental refreshes
+        self.last_id = 0
+        self._deletes: dict[tuple[Optional[str], str], set[str]] = {}
+        self._owners: dict[tuple[Optional[str], str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self._owners)
+
+    def _variants(self, word: str) -> set[str]:
+        variants = {word}
+        frontier = {word}
+        for _ in range(self.max_distance):
+            frontier = {w[:i] + w[i + 1 :] for w in frontier for i in range(len(w))}
+            variants |= frontier
+        return variants
+
+    def add(self, id_type: Optional[str], canonical: str, entity_id: int):
+        word = compact_identifier(canonical)
+        if not word or (id_type, word) in self._owners:
+            return
+        self._owners[(id_type, word)] = entity_id
+        for variant in self._variants(word):
+            self._deletes.setdefault((id_type, variant), set()).add(word)
+
+    def candidates(self, id_type: str, canonical: str) -> list[tuple[int, str, int]]:
+        """All (distance, identifier, entity_id) within max_distance edits of the identifier, among
+        identifiers of the same type and those stored without a type."""
+        word = compact_identifier(canonical)
+        found = {}
+        for typ in (id_type, None):
+            for variant in self._variants(word):
+                for other in self._deletes.get((typ, variant), ()):
+                    if (typ, other) in found:
+                        continue
+                    distance = edit_distance(word, other)
+                    if distance <= self.max_distance:
+                        found[(typ, other)] = (distance, other, self._owners[(typ, other)])
+        return sorted(found.values())
+
+    def match(self, id_type: str, canonical: str) -> Optional[int]:
+        """The entity that an identifier most likely refers to, if there is a single best match.
+        Container codes (BIC) carry a check digit: a code that validates is taken as read, and
+        otherwise only candidates that validate are considered."""
+        if self.max_distance <= 0:
+            return None
+        candidates = self.candidates(id_type, canonical)
+        if id_type == BIC_ID_TYPE:
+            if is_valid_bic(canonical):
+                return None
+            candidates = [c for c in candidates if is_valid_bic(c[1])]
+        if not candidates:
+            return None
+
+        best = candidates[0][0]
+        owners = {entity_id for distance, _, entity_id in candidates if distance == best}
+        if len(owners) != 1:
+            return None
+        return owners.pop()
@@ -1,11 +1,38 @@
 from typing import Optional
 import os
-from datetime import datetime
+import selectors
+import signal
+import threading
+import time
+import math
+import json
+from difflib import SequenceMatcher
+from datetime import date, datetime, timedelta, timezone
 import typer
-from sqlalchemy import select, create_engine, insert, func
-from sqlalchemy.orm import Session
-from geoalchemy2 import Geometry
-from geojson_pydantic.geometries import Point, Polygon
+from sqlalchemy import (
+    select,
+    bindparam,
+    create_engine,
+    insert,
+    delete,
+    update,
+    func,
+    cast,
+    or_,
+    tuple_,
+    Date,
+    String,
+    literal,
+    text,
+    union_all,
+)
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.schema import AddConstraint, CreateColumn
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import OperationalError
+from geoalchemy2 import Geography
 from shared.db import (
     Users,
     ObservationEvents,
@@ -13,47 +40,535 @@ from shared.db import (
     Entity,
     EntityObservation,
     EntityIdentifier,
+    ProcessingCheckpoint,
+    FailedObservation,
+    AssetPosition,
+    NetworkEdge,
+    UserDailyCounts,
+    Entries,
+    Accounts,
+    Rewards,
+    BalanceCheckpoint,
+    DailyLedgerTotals,
+    OBSERVATIONS_CHANNEL,
+    LIST_ATTRIBUTES,
+    TAXON_COLUMNS,
+    attribute_conditions,
+    attribute_taxa,
 )
 from shared.util import canonicalize_identifier
+from shared.partitions import (
+    create_monthly_partitions,
+    detach_partitions_before,
+    month_start,
+)
+from shared.leaderboard import create_leaderboards, refresh_leaderboards
+from shared.taxonomy import get_taxonomies
+from identifiers import IdentifierCache, IdentifierKey, FuzzyIdentifierIndex
 
 
 DATABASE_URL = os.getenv("DB_CREDS")
-engine = create_engine(DATABASE_URL)
+# created when a command starts (see connect), so that the CLI itself starts without a database
+engine = None
+
+# SQLSTATE raised by Postgres when it aborts one side of a deadlock
+DEADLOCK_DETECTED = "40P01"
+
+# facility observations are merged into an existing facility entity within this many meters
+FACILITY_MATCH_RADIUS = float(os.getenv("PLATON_FACILITY_RADIUS", "150"))
+FACILITY_MATCH_CANDIDATES = 5
+METERS_PER_DEGREE = 111_320
+# size, in degrees, of the grid cells used to serialize facility resolution across workers; at
+# least twice the match radius, so that the radius touches few cells
+FACILITY_LOCK_CELL = max(0.05, 2 * FACILITY_MATCH_RADIUS / METERS_PER_DEGREE)
+GEOGRAPHY = Geography(srid=4326)
+
+# maps asset identifiers to entity ids across batches; most asset observations repeat identifiers
+# (container codes, license plates) that have been seen before
+identifier_cache = IdentifierCache(int(os.getenv("PLATON_IDENTIFIER_CACHE_SIZE", "100000")))
+
+# matches asset identifiers that were misread (typically by OCR) to known ones, within this many
+# edits; 0 disables fuzzy matching
+fuzzy_index = FuzzyIdentifierIndex(int(os.getenv("PLATON_FUZZY_DISTANCE", "1")))
+
+# tables that are range partitioned by month, and how often (in seconds) the daemon makes sure that
+# their upcoming partitions exist
+PARTITIONED_TABLES = [
+    ObservationEvents.__tablename__,
+    Observations.__tablename__,
+    AssetPosition.__tablename__,
+]
+MAINTENANCE_INTERVAL = 3600
+# partitions for months older than this many months are detached (0 keeps everything)
+PARTITION_RETENTION_MONTHS = int(os.getenv("PLATON_PARTITION_RETENTION_MONTHS", "0"))
+# seconds between refreshes of the leaderboard rankings by the daemon
+LEADERBOARD_INTERVAL = float(os.getenv("PLATON_LEADERBOARD_INTERVAL", "300"))
+
+# set when a running daemon or worker should stop after its current batch
+shutdown = threading.Event()
 
 app = typer.Typer()
 
 
+def connect():
+    global engine
+    if engine is None:
+        engine = create_engine(DATABASE_URL)
+    return engine
+
+
+@app.callback()
+def setup():
+    connect()
+
+
+BATCH_SIZE = 100
+CHECKPOINT_NAME = "main"
+
+
 @app.command()
-def main():
-    with Session(engine) as session:
-        # Select all observations that do not have a link to an entity -- i.e., the outer join on the
-        # EntityObservation table is NULL for that column.
+def main(
+    workers: int = typer.Option(1, help="Number of worker processes to run on this host"),
+    batch_size: int = typer.Option(BATCH_SIZE, help="Observations claimed per transaction"),
+    limit: Optional[int] = typer.Option(
+        None, help="Stop after processing this many observations in total"
+    ),
+    since: Optional[datetime] = typer.Option(
+        None, help="Only process observations submitted at or after this time"
+    ),
+    resume: bool = typer.Option(
+        True, help="Start from the saved checkpoint rather than scanning from the beginning"
+    ),
+):
+    """Process all observations that are not yet linked to an entity. Any number of workers, on
+    this host or others, can run at once: each one claims its own batches of observations."""
+    if workers <= 1:
+        run_worker(batch_size, limit, since, resume)
+        return
 
-        stmt = (
-            select(
-                Observations.id,
-                Observations.observation_type,
-                Observations.payload,
-                EntityObservation.observation_id,
-                EntityObservation.entity_id,
-                ObservationEvents.location,
-            )
-            .outerjoin(EntityObservation)
-            .join(ObservationEvents)
-            .where(EntityObservation.observation_id.is_(None))
-        )
-        resp = session.execute(stmt)
-        for r in resp.fetchall():
-            process_observation(r, session)
-        
+    import multiprocessing
+
+    procs = []
+    for i in range(workers):
+        worker_limit = None
+        if limit is not None:
+            worker_limit = limit // workers + (1 if i < limit % workers else 0)
+        procs.append(
+            multiprocessing.Process(
+                target=_worker_process, args=(batch_size, worker_limit, since, resume)
+            )
+        )
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+def run_worker(
+    batch_size: int = BATCH_SIZE,
+    limit: Optional[int] = None,
+    since: Optional[datetime] = None,
+    resume: bool = True,
+):
+    """Claim and process batches of unlinked observations until there are none left (or the limit
+    is reached). Each batch is processed and committed in its own transaction, and the checkpoint
+    is advanced after every commit, so a crash loses at most one batch of work. An observation
+    that fails is recorded as failed (see process_batch) rather than failing its batch."""
+    after_id = 0
+    if resume:
+        with Session(engine) as session:
+            after_id = load_checkpoint(session)
+
+    processed = 0
+    while (limit is None or processed < limit) and not shutdown.is_set():
+        size = batch_size if limit is None else min(batch_size, limit - processed)
+        with Session(engine) as session:
+            try:
+                batch = claim_batch(session, size, after_id, since)
+                if not batch:
+                    break
+                refresh_fuzzy_index(session)
+                lock_resolution_keys(batch, session)
+                process_batch(batch, session)
+                flush_identifiers(session)
+                flush_positions(session)
+                session.commit()
+                identifier_cache.commit()
+            except OperationalError as exc:
+                identifier_cache.rollback()
+                # two batches resolved to the same entity through different keys; Postgres
+                # aborts one of them, and its observations are simply claimed again
+                if getattr(exc.orig, "pgcode", None) != DEADLOCK_DETECTED:
+                    raise
+                session.rollback()
+                typer.echo("Deadlock detected, retrying batch")
+                continue
+            except Exception:
+                identifier_cache.rollback()
+                raise
+
+            after_id = max(r.id for r in batch)
+            processed += len(batch)
+            save_checkpoint(session, after_id)
+
+    typer.echo(
+        f"Identifier cache: {len(identifier_cache)} entries, "
+        f"{identifier_cache.hit_rate():.1%} hit rate"
+    )
+
+
+def process_batch(batch, session: Session):
+    """Process the observations of a claimed batch. Each observation is processed in a savepoint:
+    if it fails, its changes are rolled back, and it is recorded as failed so that it is not
+    claimed again, while the rest of the batch goes ahead. Operational errors (deadlocks, lost
+    connections) are not caused by the observation, so they fail the whole batch."""
+    # connections refer to the other observations of their event, so they go last, once their
+    # endpoints have been resolved and locked
+    connections = [r for r in batch if r.observation_type == "connection"]
+    for r in batch:
+        if r.observation_type != "connection":
+            process_isolated(r, session)
+    lock_connection_keys(connections, session)
+    for r in connections:
+        process_isolated(r, session)
+
+
+def process_isolated(r, session: Session):
+    identifiers = identifier_cache.savepoint()
+    pending = {
+        "new_identifiers": dict(session.info.get("new_identifiers", {})),
+        "new_positions": list(session.info.get("new_positions", [])),
+    }
+    savepoint = session.begin_nested()
+    try:
+        process_observation(r, session)
+        savepoint.commit()
+    except OperationalError:
+        raise
+    except Exception as exc:
+        savepoint.rollback()
+        identifier_cache.rollback_to(identifiers)
+        session.info.update(pending)
+        typer.echo(f" | failed: {exc}", err=True)
+        record_failure(r, exc, session)
+
+
+def record_failure(obs, exc: Exception, session: Session):
+    stmt = pg_insert(FailedObservation).values(
+        observation_id=obs.id, failed_at=datetime.now(timezone.utc), error=str(exc)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[FailedObservation.observation_id],
+        set_={"failed_at": stmt.excluded.failed_at, "error": stmt.excluded.error},
+    )
+    session.execute(stmt)
+
+
+@app.command()
+def retry_failed():
+    """Clear the recorded failures of observations that could not be processed, so that workers
+    claim them again; run this once the cause has been fixed."""
+    with Session(engine) as session:
+        first = session.scalar(select(func.min(FailedObservation.observation_id)))
+        if first is None:
+            typer.echo("No failed observations")
+            return
+        result = session.execute(delete(FailedObservation))
+        # the checkpoint moves past failed observations, so move it back before the first one
+        checkpoint = session.get(ProcessingCheckpoint, CHECKPOINT_NAME, with_for_update=True)
+        if checkpoint and checkpoint.observation_id and checkpoint.observation_id >= first:
+            checkpoint.observation_id = first - 1
         session.commit()
+    typer.echo(f"Cleared {result.rowcount} failed observations")
+
+
+def _worker_process(*args):
+    if engine is None:
+        # a spawned (rather than forked) worker starts from a fresh import
+        connect()
+    else:
+        # pooled connections must not be shared with a parent process after a fork
+        engine.dispose(close=False)
+    run_worker(*args)
+
+
+@app.command()
+def daemon(
+    batch_size: int = typer.Option(BATCH_SIZE, help="Observations claimed per transaction"),
+    debounce: float = typer.Option(
+        1.0, help="Seconds to wait after a notification so that ingests can accumulate"
+    ),
+    poll_interval: float = typer.Option(
+        60.0, help="Seconds between backlog checks when no notifications arrive"
+    ),
+):
+    """Run continuously, processing new observations within seconds of their ingest. The API
+    notifies on the observations channel whenever it stores an observation event; the daemon also
+    polls the backlog periodically in case a notification was missed. SIGINT or SIGTERM stops the
+    daemon once the current batch has been committed."""
+
+    def request_shutdown(signum, frame):
+        typer.echo("Shutting down after the current batch")
+        shutdown.set()
+
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+    conn = engine.raw_connection()
+    try:
+        listener = conn.dbapi_connection
+        listener.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        listener.cursor().execute(f"LISTEN {OBSERVATIONS_CHANNEL}")
+        sel = selectors.DefaultSelector()
+        sel.register(listener, selectors.EVENT_READ)
+
+        maintained_at = 0.0
+        ranked_at = 0.0
+        while not shutdown.is_set():
+            # a failing step is logged and tried again at its next turn, rather than stopping the
+            # daemon (which would only fail the same way after a restart)
+            if time.monotonic() - maintained_at > MAINTENANCE_INTERVAL:
+                maintained_at = time.monotonic()
+                run_step(
+                    "Partition maintenance",
+                    maintain_partitions,
+                    months_back=1,
+                    months_ahead=3,
+                    retain_months=PARTITION_RETENTION_MONTHS,
+                )
+            if time.monotonic() - ranked_at > LEADERBOARD_INTERVAL:
+                ranked_at = time.monotonic()
+                run_step("Leaderboard refresh", refresh_leaderboards_command)
+            # drain the whole backlog; notifications that arrive meanwhile are coalesced, so a
+            # burst of ingests never queues up more than one extra pass
+            run_step("Processing", run_worker, batch_size)
+            if wait_for_notification(sel, listener, poll_interval):
+                # micro-batch: give concurrent ingests a moment to land before claiming
+                shutdown.wait(debounce)
+            listener.poll()
+            listener.notifies.clear()
+    finally:
+        conn.close()
+
+
+def run_step(name: str, step, *args, **kwargs):
+    try:
+        step(*args, **kwargs)
+    except Exception as exc:
+        typer.echo(f"{name} failed: {exc!r}", err=True)
+
+
+def wait_for_notification(sel, listener, timeout: float) -> bool:
+    """Wait until a notification arrives on the listening connection, the timeout expires or a
+    shutdown is requested. Waits in short slices so that shutdown requests are noticed quickly."""
+    deadline = time.monotonic() + timeout
+    while not shutdown.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if sel.select(min(remaining, 1.0)):
+            listener.poll()
+            if listener.notifies:
+                return True
+    return False
+
+
+def unlinked_observations():
+    """Select the observations that do not have a link to an entity yet, and have not failed."""
+    linked = select(EntityObservation.observation_id).where(
+        EntityObservation.observation_id == Observations.id
+    )
+    failed = select(FailedObservation.observation_id).where(
+        FailedObservation.observation_id == Observations.id
+    )
+    return (
+        select(
+            Observations.id,
+            Observations.event_id,
+            Observations.observation_type,
+            Observations.payload,
+            ObservationEvents.location,
+            ObservationEvents.observed_at,
+            ObservationEvents.geo,
+        )
+        .join(Observations.event)
+        .where(~linked.exists(), ~failed.exists())
+        .order_by(Observations.id)
+    )
+
+
+def claim_batch(
+    session: Session,
+    batch_size: int,
+    after_id: int = 0,
+    since: Optional[datetime] = None,
+):
+    """Claim the next batch of unlinked observations after after_id. The rows stay locked until
+    the transaction ends, and rows already claimed by another worker are skipped rather than
+    waited on."""
+    while True:
+        stmt = unlinked_observations().where(Observations.id > after_id)
+        if since:
+            stmt = stmt.where(
+                ObservationEvents.submitted_at >= since, Observations.submitted_at >= since
+            )
+        stmt = stmt.limit(batch_size).with_for_update(skip_locked=True, of=Observations)
+        batch = session.execute(stmt).fetchall()
+        if not batch:
+            return batch
+
+        # The link check above ran on the statement's snapshot. Another worker may have linked
+        # some of the rows and committed (releasing their locks) since then, and since linking
+        # does not update the observation row, locking it does not recheck the condition. Check
+        # again now that the rows are locked, in a statement that sees those commits.
+        linked = set(
+            session.scalars(
+                select(EntityObservation.observation_id).where(
+                    EntityObservation.observation_id.in_([r.id for r in batch])
+                )
+            )
+        )
+        claimed = [r for r in batch if r.id not in linked]
+        if claimed:
+            return claimed
+        after_id = max(r.id for r in batch)
+
+
+def load_checkpoint(session: Session) -> int:
+    checkpoint = session.get(ProcessingCheckpoint, CHECKPOINT_NAME)
+    if checkpoint and checkpoint.observation_id:
+        return checkpoint.observation_id
+    return 0
+
+
+def save_checkpoint(session: Session, after_id: int):
+    """Advance the checkpoint to just before the oldest observation that is still unlinked. This
+    holds no matter how many workers are running, or which of them have committed."""
+    previous = load_checkpoint(session)
+    oldest_unlinked = session.scalar(
+        unlinked_observations()
+        .with_only_columns(Observations.id)
+        .where(Observations.id > previous)
+        .limit(1)
+    )
+    watermark = after_id if oldest_unlinked is None else min(after_id, oldest_unlinked - 1)
+
+    stmt = pg_insert(ProcessingCheckpoint).values(
+        name=CHECKPOINT_NAME, observation_id=watermark, updated_at=datetime.now()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProcessingCheckpoint.name],
+        set_={
+            "observation_id": func.greatest(
+                ProcessingCheckpoint.observation_id, stmt.excluded.observation_id
+            ),
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    session.execute(stmt)
+    session.commit()
+
+
+def resolution_keys(obs) -> list[str]:
+    """The keys under which an observation is resolved to an entity. Two observations that share a
+    key may resolve to the same entity, so they must never be processed concurrently. Connections
+    are resolved by their endpoints, which are only known once the rest of their batch has been
+    processed, so they are locked then (see lock_connection_keys)."""
+    if obs.observation_type == "asset":
+        return [
+            f"asset:{canonicalize_identifier(id_text)}"
+            for _, id_text in observation_identifiers(obs.payload)
+        ]
+    if obs.observation_type == "facility":
+        # Facilities match anything within the radius, so lock every grid cell that the radius
+        # touches. Two observations within matching distance always share at least one cell: the
+        # cell of either one. Towards the poles the radius spans more degrees of longitude than a
+        # cell, so the cells are counted out rather than taken from the corners of the radius.
+        location = observation_location(obs)
+        if location is None:
+            return []
+        lat, lon = location
+        dlat, dlon = _radius_degrees(lat)
+        rows = range(
+            math.floor((lat - dlat) / FACILITY_LOCK_CELL),
+            math.floor((lat + dlat) / FACILITY_LOCK_CELL) + 1,
+        )
+        columns = range(
+            math.floor((lon - dlon) / FACILITY_LOCK_CELL),
+            math.floor((lon + dlon) / FACILITY_LOCK_CELL) + 1,
+        )
+        return sorted(f"facility:{row}:{column}" for row in rows for column in columns)
+    return []
+
+
+def lock_resolution_keys(batch, session: Session):
+    """Take a transaction-scoped advisory lock on every resolution key in the batch. Keys are
+    locked in sorted order so that concurrent workers cannot deadlock on them."""
+    keys = sorted({key for obs in batch for key in resolution_keys(obs)})
+    for key in keys:
+        session.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
+
+def connection_key(payload, endpoints: tuple[int, int]) -> Optional[str]:
+    """The resolution key of a connection observation: find_connection matches a connection with
+    the same endpoints and type. A connection without both endpoints never matches, so it has no
+    key."""
+    upstream_id, downstream_id = endpoints
+    if upstream_id is None or downstream_id is None:
+        return None
+    return f"connection:{upstream_id}:{downstream_id}:{payload.get('connection_type')}"
+
+
+def lock_connection_keys(connections, session: Session):
+    """Take an advisory lock on the resolution key of every connection observation whose endpoints
+    have been linked, in sorted order like lock_resolution_keys."""
+    keys = set()
+    for obs in connections:
+        try:
+            endpoints = connection_endpoints(obs, session)
+        except DanglingReference:
+            # recorded as failed when it is processed
+            continue
+        if endpoints is not None:
+            keys.add(connection_key(obs.payload, endpoints))
+    keys.discard(None)
+    for key in sorted(keys):
+        session.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
+
+@app.command()
+def rebuild(entity_id: Optional[int] = typer.Argument(None)):
+    """Re-synthesize one entity (or all of them) from every linked observation. Normal processing
+    folds observations in incrementally; this is the repair path for when the stored state has
+    drifted from the observations."""
+    with Session(engine) as session:
+        stmt = select(Entity.id).order_by(Entity.id)
+        if entity_id is not None:
+            stmt = stmt.where(Entity.id == entity_id)
+        for ent_id in session.scalars(stmt).all():
+            synthesize_entity(session.get(Entity, ent_id), session)
+            session.commit()
+            identifier_cache.commit()
 
 
 def process_observation(obs: Observations, session: Session):
     typer.echo(f"Processing observation {obs.id} ", nl=False)
 
     # check if the observation refers to an entity that already exists
-    ent = find_entity(obs)
+    endpoints = None
+    if obs.observation_type == "connection":
+        # a connection whose endpoint can never be linked raises DanglingReference, and is
+        # recorded as failed (see process_isolated) rather than left unlinked for good
+        endpoints = connection_endpoints(obs, session)
+        if endpoints is None:
+            # left unlinked, so that it is picked up again by a later run
+            typer.echo(" | D (endpoints not processed yet)")
+            return
+        ent = find_connection(obs.payload, endpoints, session)
+    else:
+        ent = find_entity(obs, session)
 
     # if the entity does not exist, create it
     if ent:
@@ -61,51 +576,405 @@ def process_observation(obs: Observations, session: Session):
     else:
         ent = create_entity_from_observation(obs, session)
 
-    # link the observation to the entity and then (re-)synthesize the entity
+    # link the observation to the entity and then fold it into the entity's state
     typer.echo(ent)
     add_observation_to_entity(obs, ent, session)
-    synthesize_entity(ent, session)
+    fold_observation(ent, obs)
+    register_identifiers(ent, obs.payload, session)
+    record_position(ent, obs, session)
+    if endpoints:
+        record_edge(ent, obs.payload, endpoints, session)
+    session.flush()
 
 
-def find_entity(obs) -> Optional[Entity]:
-    obs_type = obs.observation_type
-    obs_payload = obs.payload
+class DanglingReference(ValueError):
+    """A connection refers to an endpoint that will never be linked to an entity: no observation
+    of its event has the payload_ref, or the ones that do have failed."""
+
+
+def payload_ref_entity(targets) -> Optional[int]:
+    """The entity that a payload_ref resolves to, given the (entity_id, failed) of each observation
+    in the event with that payload_ref: the entity of a linked one, or None while one is still
+    waiting to be processed. Raises DanglingReference if none can ever be linked."""
+    pending = False
+    for entity_id, failed in targets:
+        if entity_id is not None:
+            return entity_id
+        pending = pending or not failed
+    if not pending:
+        raise DanglingReference("no observation with this payload_ref can be linked")
+    return None
+
+
+def resolve_payload_ref(event_id: int, ref, session: Session) -> Optional[int]:
+    """Find the entity that the observation with the given payload_ref, in the same event, has
+    been linked to (see payload_ref_entity)."""
+    stmt = (
+        select(EntityObservation.entity_id, FailedObservation.observation_id.is_not(None))
+        .select_from(Observations)
+        .outerjoin(EntityObservation, EntityObservation.observation_id == Observations.id)
+        .outerjoin(FailedObservation, FailedObservation.observation_id == Observations.id)
+        .where(
+            Observations.event_id == event_id,
+            Observations.payload["payload_ref"].astext == str(ref),
+        )
+    )
+    return payload_ref_entity(session.execute(stmt).all())
+
+
+def connection_endpoints(obs, session: Session) -> Optional[tuple[int, int]]:
+    """The (upstream, downstream) entity ids of a connection observation, or None if an endpoint
+    it refers to has not been processed yet. Either id is None when the observation does not name
+    that endpoint. Raises DanglingReference if an endpoint it refers to can never be linked."""
+    endpoints = []
+    for side in ("upstream", "downstream"):
+        ref = (obs.payload.get(side) or {}).get("ref")
+        entity_id = None
+        if ref is not None:
+            try:
+                entity_id = resolve_payload_ref(obs.event_id, ref, session)
+            except DanglingReference as exc:
+                raise DanglingReference(f"{side} ref {ref!r}: {exc}") from exc
+            if entity_id is None:
+                return None
+        endpoints.append(entity_id)
+    return tuple(endpoints)
+
+
+def find_connection(payload, endpoints: tuple[int, int], session: Session) -> Optional[Entity]:
+    """Find the connection entity of the same type that already joins the same two entities."""
+    upstream_id, downstream_id = endpoints
+    if upstream_id is None or downstream_id is None:
+        return None
+    stmt = (
+        select(NetworkEdge.connection_id)
+        .where(
+            NetworkEdge.upstream_id == upstream_id,
+            NetworkEdge.downstream_id == downstream_id,
+            NetworkEdge.connection_type == payload.get("connection_type"),
+        )
+        .limit(1)
+    )
+    connection_id = session.scalar(stmt)
+    return session.get(Entity, connection_id) if connection_id else None
+
+
+def record_edge(ent: Entity, payload, endpoints: tuple[int, int], session: Session):
+    """Add the network edge made by a connection entity between its two endpoints."""
+    upstream_id, downstream_id = endpoints
+    if upstream_id is None or downstream_id is None:
+        return
+    stmt = pg_insert(NetworkEdge).values(
+        connection_id=ent.id,
+        upstream_id=upstream_id,
+        downstream_id=downstream_id,
+        connection_type=payload.get("connection_type"),
+        connection_function=payload.get("connection_function"),
+        created_at=datetime.now(),
+    )
+    session.execute(stmt.on_conflict_do_nothing())
+
+
+def observation_location(obs) -> Optional[tuple[float, float]]:
+    """The (latitude, longitude) of the event that an observation belongs to."""
     try:
-        obs_location = (
+        return (
             float(obs.location["latitude"]),
             float(obs.location["longitude"]),
         )
-    except ValueError:
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def find_entity(obs, session: Session) -> Optional[Entity]:
+    obs_type = obs.observation_type
+    obs_payload = obs.payload
+    obs_location = observation_location(obs)
+    if obs_location is None:
         typer.echo("Invalid location")
         return None
 
-    # temp = select(Entity).where(func.)
     if obs_type == "facility":
-        pass
+        return find_nearby_facility(obs_payload, obs_location, session)
     elif obs_type == "asset":
-        if "asset_id" in obs_payload and "id_text" in obs_payload["asset_id"]:
-            id_text = obs_payload["asset_id"].get("id_text", None)
-            # typer.echo(f"Searching for asset entity with id {id_text}...", nl=False)
-            stmt = (
-                select(Entity, EntityIdentifier)
-                .join(EntityIdentifier)
-                .where(
-                    EntityIdentifier.identifier_canonical == id_text
-                    and Entity.entity_type == "asset"
-                )
+        for id_type, id_text in observation_identifiers(obs_payload):
+            entity_id = resolve_identifier(
+                (id_type, canonicalize_identifier(id_text)), session
             )
-            with engine.connect() as conn:
-                res = conn.execute(stmt)
-                entity = res.fetchone()
-                if entity:
-                    # typer.echo("FOUND")
-                    return entity
-                else:
-                    # typer.echo("NOT FOUND")
-                    return None
+            if entity_id is not None:
+                return session.get(Entity, entity_id)
+
+        # no exact match, so the identifiers may have been misread
+        for id_type, id_text in observation_identifiers(obs_payload):
+            entity_id = fuzzy_index.match(id_type, canonicalize_identifier(id_text))
+            if entity_id is not None:
+                typer.echo(f" | ~{id_text}", nl=False)
+                # the entity is stored under another identifier than the ones locked for this
+                # observation (see resolution_keys), so lock its row before folding into it
+                return session.get(
+                    Entity, entity_id, with_for_update=True, populate_existing=True
+                )
     return None
 
 
+def refresh_fuzzy_index(session: Session):
+    """Add the asset identifiers stored since the last refresh (by any worker) to the fuzzy
+    index. The first refresh loads every asset identifier."""
+    if fuzzy_index.max_distance <= 0:
+        return
+    stmt = (
+        select(
+            EntityIdentifier.id,
+            EntityIdentifier.id_type,
+            EntityIdentifier.identifier_canonical,
+            EntityIdentifier.entity_id,
+        )
+        .join(Entity)
+        .where(Entity.entity_type == "asset", EntityIdentifier.id > fuzzy_index.last_id)
+        .order_by(EntityIdentifier.id)
+        .execution_options(yield_per=10_000)
+    )
+    for row in session.execute(stmt):
+        fuzzy_index.add(row.id_type, row.identifier_canonical, row.entity_id)
+        fuzzy_index.last_id = row.id
+
+
+def resolve_identifier(key: IdentifierKey, session: Session) -> Optional[int]:
+    """Find the id of the asset entity that owns an identifier, through the identifier cache and
+    then the unique (id_type, identifier_canonical) index. Identifiers stored before their type was
+    recorded have no id_type, and match an identifier of any type."""
+    entity_id = identifier_cache.get(key)
+    if entity_id is not None:
+        return entity_id
+
+    id_type, canonical = key
+    stmt = (
+        select(EntityIdentifier.entity_id)
+        .join(Entity)
+        .where(
+            EntityIdentifier.identifier_canonical == canonical,
+            or_(EntityIdentifier.id_type == id_type, EntityIdentifier.id_type.is_(None)),
+            Entity.entity_type == "asset",
+        )
+        .order_by(EntityIdentifier.id_type.nulls_last())
+        .limit(1)
+    )
+    entity_id = session.scalar(stmt)
+    if entity_id is not None:
+        identifier_cache.put(key, entity_id)
+    return entity_id
+
+
+def register_identifiers(ent: Entity, payload, session: Session):
+    """Record the identifiers in an observation payload as belonging to the entity, unless they
+    are already known. New identifiers are collected on the session and written in bulk by
+    flush_identifiers; until then, the identifier cache resolves them within the batch."""
+    pending = session.info.setdefault("new_identifiers", {})
+    for id_type, id_text in observation_identifiers(payload):
+        key = (id_type, canonicalize_identifier(id_text))
+        if key in identifier_cache:
+            continue
+        pending[key] = {
+            "entity_id": ent.id,
+            "id_type": id_type,
+            "issuer_type": "operator",
+            "identifier": id_text,
+            "identifier_canonical": key[1],
+        }
+        identifier_cache.put(key, ent.id)
+
+
+def flush_identifiers(session: Session):
+    """Insert the identifiers collected by register_identifiers with a single upsert. Rows that
+    conflict with an existing identifier are skipped, and an identifier that already belongs to
+    another entity keeps its owner."""
+    pending = session.info.pop("new_identifiers", {})
+    if not pending:
+        return
+
+    stmt = (
+        pg_insert(EntityIdentifier)
+        .values(list(pending.values()))
+        .on_conflict_do_nothing()
+        .returning(EntityIdentifier.id_type, EntityIdentifier.identifier_canonical)
+    )
+    inserted = {tuple(row) for row in session.execute(stmt)}
+    skipped = [key for key in pending if key not in inserted]
+    if not skipped:
+        return
+
+    stmt = select(
+        EntityIdentifier.id_type,
+        EntityIdentifier.identifier_canonical,
+        EntityIdentifier.entity_id,
+    ).where(
+        tuple_(EntityIdentifier.id_type, EntityIdentifier.identifier_canonical).in_(skipped)
+    )
+    for id_type, canonical, owner_id in session.execute(stmt):
+        if owner_id != pending[(id_type, canonical)]["entity_id"]:
+            typer.echo(f"Identifier {canonical} already belongs to entity {owner_id}")
+        identifier_cache.put((id_type, canonical), owner_id)
+
+
+@app.command()
+def compact_identifiers():
+    """Delete duplicate entity identifiers, keeping the oldest row for each (entity, issuer type,
+    canonical identifier) and for each (id type, canonical identifier), and then add the unique
+    constraint and index on those columns. This needs to run once on databases that were populated
+    before they existed, after add-identifier-types on databases without the id_type column."""
+    dup = aliased(EntityIdentifier)
+    stmt = delete(EntityIdentifier).where(
+        EntityIdentifier.entity_id == dup.entity_id,
+        EntityIdentifier.issuer_type.is_not_distinct_from(dup.issuer_type),
+        EntityIdentifier.identifier_canonical == dup.identifier_canonical,
+        EntityIdentifier.id > dup.id,
+    )
+    constraint = next(
+        c
+        for c in EntityIdentifier.__table__.constraints
+        if c.name == "uq_entity_identifiers_entity_issuer_canonical"
+    )
+    index = next(
+        i
+        for i in EntityIdentifier.__table__.indexes
+        if i.name == "ix_entity_identifiers_id_type_canonical"
+    )
+    with Session(engine) as session:
+        # keep workers from adding duplicates between the deletes and the constraint and index
+        session.execute(
+            text(f"LOCK TABLE {EntityIdentifier.__tablename__} IN SHARE ROW EXCLUSIVE MODE")
+        )
+        result = session.execute(stmt.execution_options(synchronize_session=False))
+        typer.echo(f"Deleted {result.rowcount} duplicate identifiers")
+        deleted = delete_conflicting_identifiers(session)
+        typer.echo(f"Deleted {deleted} identifiers that another entity already has")
+        exists = session.scalar(
+            text("SELECT 1 FROM pg_constraint WHERE conname = :name"), {"name": constraint.name}
+        )
+        if not exists:
+            session.execute(AddConstraint(constraint))
+            typer.echo(f"Added {constraint.name}")
+        index.create(session.connection(), checkfirst=True)
+        session.commit()
+
+
+def delete_conflicting_identifiers(session: Session) -> int:
+    """Delete the identifiers that conflict with the unique (id_type, identifier_canonical) index,
+    keeping the oldest row for each: an identifier keeps its first owner, as it does when platon
+    stores identifiers. Returns the number of rows deleted."""
+    dup = aliased(EntityIdentifier)
+    stmt = delete(EntityIdentifier).where(
+        EntityIdentifier.id_type == dup.id_type,
+        EntityIdentifier.identifier_canonical == dup.identifier_canonical,
+        EntityIdentifier.id > dup.id,
+    )
+    return session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+
+
+@app.command()
+def add_identifier_types():
+    """One-off migration that adds the id_type column of entity identifiers, sets it from the asset
+    observations of each identifier's entity, deletes identifiers that are owned twice, and then
+    builds the unique (id_type, identifier_canonical) index that identifier resolution relies on.
+    Identifiers that none of their entity's observations carry are typed as generic, like
+    untyped identifiers in observations. Stop the workers first: their identifier caches may hold
+    owners that this changes."""
+    table = EntityIdentifier.__table__
+    index = next(i for i in table.indexes if i.name == "ix_entity_identifiers_id_type_canonical")
+    with Session(engine) as session:
+        session.execute(text(f"LOCK TABLE {table.name} IN SHARE ROW EXCLUSIVE MODE"))
+        ddl = CreateColumn(table.c.id_type).compile(dialect=session.bind.dialect)
+        session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}"))
+
+        stmt = (
+            select(
+                EntityIdentifier.id,
+                EntityIdentifier.identifier_canonical,
+                Observations.payload,
+            )
+            .join(EntityObservation, EntityObservation.entity_id == EntityIdentifier.entity_id)
+            .join(Observations, Observations.id == EntityObservation.observation_id)
+            .where(EntityIdentifier.id_type.is_(None), Observations.observation_type == "asset")
+            .order_by(EntityIdentifier.id, Observations.id)
+            .execution_options(yield_per=10_000)
+        )
+        id_types = {}
+        for row in session.execute(stmt):
+            if row.id in id_types:
+                continue
+            for id_type, id_text in observation_identifiers(row.payload):
+                if canonicalize_identifier(id_text) == row.identifier_canonical:
+                    id_types[row.id] = id_type
+                    break
+        if id_types:
+            session.connection().execute(
+                update(EntityIdentifier)
+                .where(EntityIdentifier.id == bindparam("row_id"))
+                .values(id_type=bindparam("new_id_type")),
+                [{"row_id": i, "new_id_type": t} for i, t in id_types.items()],
+            )
+        untyped = session.execute(
+            update(EntityIdentifier)
+            .where(EntityIdentifier.id_type.is_(None))
+            .values(id_type="generic")
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        typer.echo(f"Typed {len(id_types)} identifiers, and {untyped} more as generic")
+
+        typer.echo(f"Deleted {delete_conflicting_identifiers(session)} conflicting identifiers")
+        index.create(session.connection(), checkfirst=True)
+        session.commit()
+    typer.echo(f"Added {index.name}")
+
+
+def _radius_degrees(lat: float) -> tuple[float, float]:
+    # the match radius as (latitude, longitude) degrees; a degree of longitude shrinks towards
+    # the poles, so this is an overestimate that is only used to prefilter candidates
+    dlat = FACILITY_MATCH_RADIUS / METERS_PER_DEGREE
+    dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+    return dlat, dlon
+
+
+def find_nearby_facility(
+    payload, location: tuple[float, float], session: Session
+) -> Optional[Entity]:
+    """Find an existing facility entity within FACILITY_MATCH_RADIUS meters of the observation.
+    The nearest candidates come from a KNN scan of the spatial index on Entity.location; if several
+    are within the radius, the one whose description is most similar to the observation's wins,
+    and then the nearest. Facilities created earlier in the same batch have already been flushed,
+    so they are matched as well."""
+    lat, lon = location
+    point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
+    distance = func.ST_Distance(cast(Entity.location, GEOGRAPHY), cast(point, GEOGRAPHY))
+    stmt = (
+        select(Entity, distance.label("distance"))
+        .where(
+            Entity.entity_type == "facility",
+            # an index-assisted prefilter in degrees, followed by the exact test in meters
+            func.ST_DWithin(Entity.location, point, max(_radius_degrees(lat))),
+            func.ST_DWithin(
+                cast(Entity.location, GEOGRAPHY),
+                cast(point, GEOGRAPHY),
+                FACILITY_MATCH_RADIUS,
+            ),
+        )
+        .order_by(Entity.location.distance_centroid(point))
+        .limit(FACILITY_MATCH_CANDIDATES)
+    )
+    candidates = session.execute(stmt).all()
+    if not candidates:
+        return None
+
+    description = (payload or {}).get("description") or ""
+
+    def score(candidate):
+        other = (candidate.Entity.data or {}).get("description") or ""
+        similarity = SequenceMatcher(None, description.lower(), other.lower()).ratio()
+        return (-similarity, candidate.distance)
+
+    return min(candidates, key=score).Entity
+
+
 def create_entity_from_observation(obs, session: Session) -> Entity:
     # Create the entity and return it. This method assumes that the entity does not
     # exist, and will create a duplicate if it does.
@@ -136,53 +1005,596 @@ def add_observation_to_entity(obs, ent: Entity, session: Session):
     session.flush()
 
 
+def observation_identifiers(payload):
+    """Yield the (id_type, id_text) pairs of the asset identifiers in an observation payload.
+    Identifiers without a type are treated as generic."""
+    if not payload or "asset_id" not in payload:
+        return
+    asset_ids = payload["asset_id"]
+    if not isinstance(asset_ids, list):
+        asset_ids = [asset_ids]
+    for asset_id in asset_ids:
+        if asset_id and asset_id.get("id_text"):
+            yield asset_id.get("id_type") or "generic", asset_id["id_text"]
+
+
+def _as_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    # observation_events stores naive UTC timestamps, while entities use timestamptz
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def assign_taxa(ent: Entity):
+    """Set the taxon ids of the entity's attributes from its data."""
+    for column, value in attribute_taxa(ent.data).items():
+        setattr(ent, column, value)
+
+
+def fold_observation(ent: Entity, obs):
+    """Fold a single newly linked observation into the stored state of the entity, without
+    re-reading the entity's other observations. Observations can arrive out of order, so an
+    observation older than the entity's latest one only fills in data that is still missing."""
+    observed_at = _as_utc(obs.observed_at)
+    latest_at = _as_utc(ent.latest_observation_at)
+    is_latest = latest_at is None or (observed_at is not None and observed_at >= latest_at)
+
+    if is_latest:
+        ent.latest_observation_at = observed_at or latest_at
+        if obs.geo is not None:
+            ent.location = obs.geo
+    elif ent.location is None and obs.geo is not None:
+        ent.location = obs.geo
+
+    if obs.payload:
+        if is_latest:
+            ent.data = {**(ent.data or {}), **obs.payload}
+        else:
+            ent.data = {**obs.payload, **(ent.data or {})}
+        assign_taxa(ent)
+
+    ent.updated_at = datetime.now()
+
+
 def synthesize_entity(ent: Entity, session: Session):
-    # Synthesize the entity based on the linked observations. This operation
-    # is idempotent, but the assumption is that an observation was just added
-    # to the entity, so the entity should be re-synthesized.
-    typer.echo(" | S")
+    """Fully re-synthesize the entity from all of its linked observations. This is idempotent, and
+    gives the same result as folding the observations in one at a time."""
+    typer.echo(f"Rebuilding entity {ent.id}")
     stmt = (
-        select(Observations)
-        .join(ObservationEvents)
-        .join(EntityObservation)
-        .join(Entity)
-        .where(Entity.id == ent.id)
-        .order_by(ObservationEvents.observed_at.desc())
-    )
-    res = session.execute(stmt).scalars()
-    latest_obs_at = None
-    latest_geo: Point = None
-    data = {}
-
-    for obs in res.all():
-        if not latest_obs_at or obs.event.observed_at > latest_obs_at:
-            latest_obs_at = obs.event.observed_at
-        if obs.event.geo:
-            latest_geo = obs.event.geo
-        if obs.payload:
-            data.update(obs.payload)
-
-            if "asset_id" in obs.payload:
-                asset_id = obs.payload["asset_id"]
-                if "id_text" in asset_id:
-                    id_text = asset_id["id_text"]
-                    id_type = asset_id.get("id_type")
-                    ent.identifiers.append(
-                        EntityIdentifier(
-                            identifier=id_text,
-                            identifier_canonical=canonicalize_identifier(id_text),
-                            issuer_type='operator',
-                        )
-                    )
-    
-    # for now, we just update the entity with the latest observation
-    ent.latest_observation_at = latest_obs_at
-    ent.updated_at = datetime.now()
-    ent.data = data
-    if latest_geo:
-        ent.location = latest_geo
+        select(
+            Observations.id,
+            Observations.payload,
+            ObservationEvents.observed_at,
+            ObservationEvents.geo,
+        )
+        .join(Observations.event)
+        .join(Observations.entities)
+        .where(EntityObservation.entity_id == ent.id)
+        .order_by(ObservationEvents.observed_at)
+    )
+
+    ent.latest_observation_at = None
+    ent.location = None
+    ent.data = {}
+    assign_taxa(ent)
+    for obs in session.execute(stmt):
+        fold_observation(ent, obs)
+        register_identifiers(ent, obs.payload, session)
+        record_position(ent, obs, session)
+    flush_identifiers(session)
+    flush_positions(session)
     session.flush()
 
 
+def record_position(ent: Entity, obs, session: Session):
+    """Add the location of an asset observation to the asset's trajectory. Positions are
+    collected on the session and written in bulk by flush_positions."""
+    if ent.entity_type != "asset" or obs.geo is None or obs.observed_at is None:
+        return
+    session.info.setdefault("new_positions", []).append(
+        {
+            "entity_id": ent.id,
+            "observed_at": _as_utc(obs.observed_at),
+            "observation_id": obs.id,
+            "geo": obs.geo,
+        }
+    )
+
+
+def flush_positions(session: Session):
+    positions = session.info.pop("new_positions", [])
+    if positions:
+        session.execute(pg_insert(AssetPosition).values(positions).on_conflict_do_nothing())
+
+
+@app.command()
+def maintain_partitions(
+    months_back: int = typer.Option(12, help="Past months to create partitions for"),
+    months_ahead: int = typer.Option(3, help="Future months to create partitions for"),
+    retain_months: int = typer.Option(
+        PARTITION_RETENTION_MONTHS, help="Detach partitions older than this many months (0: never)"
+    ),
+):
+    """Create the monthly partitions of the partitioned tables, from months_back months ago to
+    months_ahead months from now, and detach the partitions that have aged out of retention. The
+    daemon does this periodically."""
+    start = month_start(date.today(), -months_back)
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            create_monthly_partitions(conn, table, start, months_back + months_ahead + 1)
+            if retain_months > 0:
+                cutoff = month_start(date.today(), -retain_months)
+                for name in detach_partitions_before(conn, table, cutoff):
+                    typer.echo(f"Detached {name}")
+
+
+@app.command()
+def partition_observations(
+    months_ahead: int = typer.Option(3, help="Future months to create partitions for"),
+):
+    """One-off migration of unpartitioned observation_events and observations tables to monthly
+    partitioned ones. The existing tables are renamed with an _unpartitioned suffix and their rows
+    copied into the new tables; the old tables are kept for verification, and can be dropped
+    afterwards. Run this with the API and the processor stopped."""
+    tables = [ObservationEvents.__table__, Observations.__table__]
+    with engine.begin() as conn:
+        partitioned = conn.scalar(
+            text("SELECT relkind = 'p' FROM pg_class WHERE relname = :table"),
+            {"table": ObservationEvents.__tablename__},
+        )
+        if partitioned:
+            typer.echo("Observation tables are already partitioned")
+            return
+
+        # move the old tables, and everything named after them, out of the way
+        for table in tables:
+            old = f"{table.name}_unpartitioned"
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old}"))
+            for (index,) in conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = :table"), {"table": old}
+            ):
+                conn.execute(text(f"ALTER INDEX {index} RENAME TO {index}_unpartitioned"))
+            conn.execute(
+                text(f"ALTER SEQUENCE IF EXISTS {table.name}_id_seq RENAME TO {old}_id_seq")
+            )
+        # foreign keys into the old tables cannot be recreated against the partitioned ones
+        conn.execute(
+            text("ALTER TABLE rewards DROP CONSTRAINT IF EXISTS rewards_observation_event_id_fkey")
+        )
+        conn.execute(
+            text(
+                "ALTER TABLE entities_observations "
+                "DROP CONSTRAINT IF EXISTS entities_observations_observation_id_fkey"
+            )
+        )
+
+        for table in tables:
+            table.create(conn, checkfirst=True)
+        first = conn.scalar(
+            text("SELECT min(submitted_at) FROM observation_events_unpartitioned")
+        )
+        start = month_start(first.date() if first else date.today())
+        months = (date.today().year - start.year) * 12 + date.today().month - start.month
+        for table in tables:
+            create_monthly_partitions(conn, table.name, start, months + months_ahead + 1)
+
+        # events without a submission time are filed under their observation time
+        event_columns = [c.name for c in ObservationEvents.__table__.columns]
+        copied = [
+            "coalesce(submitted_at, observed_at, now())" if c == "submitted_at" else c
+            for c in event_columns
+        ]
+        conn.execute(
+            text(
+                f"INSERT INTO observation_events ({', '.join(event_columns)}) "
+                f"SELECT {', '.join(copied)} FROM observation_events_unpartitioned"
+            )
+        )
+        # generated columns are computed by the new table, and columns that the old table does not
+        # have yet (e.g. the taxon ids, see reindex-taxa) are left empty
+        old_columns = set(
+            conn.execute(
+                text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = 'observations_unpartitioned'"
+                )
+            ).scalars()
+        )
+        observation_columns = [
+            c.name
+            for c in Observations.__table__.columns
+            if c.computed is None and (c.name in old_columns or c.name == "submitted_at")
+        ]
+        copied = [
+            "coalesce(e.submitted_at, now())" if c == "submitted_at" else f"o.{c}"
+            for c in observation_columns
+        ]
+        conn.execute(
+            text(
+                f"INSERT INTO observations ({', '.join(observation_columns)}) "
+                f"SELECT {', '.join(copied)} FROM observations_unpartitioned o "
+                "LEFT JOIN observation_events e ON e.id = o.event_id"
+            )
+        )
+        for table in tables:
+            conn.execute(
+                text(
+                    f"SELECT setval('{table.name}_id_seq', "
+                    f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"
+                )
+            )
+    typer.echo("Observation tables partitioned; the old tables have the _unpartitioned suffix")
+
+
+@app.command()
+def add_attribute_columns():
+    """One-off migration that adds the generated attribute columns and the taxon id columns, and
+    their indexes, to existing observations and entities tables; run reindex-taxa afterwards to
+    fill in the taxon ids. Adding a generated column rewrites the table, so run this with the API
+    and the processor stopped."""
+    with engine.begin() as conn:
+        for model in [Observations, Entity]:
+            table = model.__table__
+            for column in table.columns:
+                if column.computed is not None or column.name in TAXON_COLUMNS.values():
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+            typer.echo(f"Added the attribute columns of {table.name}")
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a query. It is executed like the query itself would be, so its
+    parameters are bound (e.g. JSONB documents serialized) the same way."""
+
+    inherit_cache = False
+
+    def __init__(self, query):
+        self.query = query
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.query, **kw)
+
+
+def explain(conn, query) -> dict:
+    """The plan that Postgres chooses for a query, as parsed EXPLAIN (FORMAT JSON) output."""
+    plan = conn.execute(Explain(query)).scalar()
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+@app.command()
+def check_attribute_indexes():
+    """Check that every kind of attribute filter (see shared.db.attribute_conditions) can be
+    answered from an index, by planning each one with sequential scans disabled: if the planner
+    still chooses a sequential scan, there is no index that it can use. Exits with status 1 if any
+    filter cannot use an index."""
+    filters = []
+    for name, taxonomy in get_taxonomies().items():
+        value = next(iter(taxonomy.ids))
+        filters += [{name: value}, {name: value.split(":")[0] + "*"}]
+
+    unindexed = []
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for model, document in [(Observations, Observations.payload), (Entity, Entity.data)]:
+            checks = [
+                (f"{name}={value}", attribute_conditions(model, {name: value}))
+                for f in filters
+                for name, value in f.items()
+            ]
+            checks.append((f"{document.key} @>", [document.contains({"asset_type": "x:y"})]))
+            for description, conditions in checks:
+                plan = explain(conn, select(model.id).where(*conditions))
+                if any(node["Node Type"] == "Seq Scan" for node in plan_nodes(plan)):
+                    unindexed.append(f"{model.__tablename__}: {description}")
+
+    for description in unindexed:
+        typer.echo(f"No index used for {description}")
+    if unindexed:
+        raise typer.Exit(1)
+    typer.echo("All attribute filters use an index")
+
+
+@app.command()
+def reindex_taxa():
+    """Set the taxon ids of all observations and entities from their attribute values (see
+    shared.db.TAXON_COLUMNS). Run this after add-attribute-columns, and whenever the attribute
+    enums in shared.schemas change, since that renumbers the taxonomies; the API and the processor
+    must be running the new enums. Only rows whose ids change are written."""
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TEMPORARY TABLE taxa (attribute text, value text, id integer, "
+                "PRIMARY KEY (attribute, value)) ON COMMIT DROP"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO taxa VALUES (:attribute, :value, :id)"),
+            [
+                {"attribute": name, "value": value, "id": taxon}
+                for name, taxonomy in get_taxonomies().items()
+                for value, taxon in taxonomy.ids.items()
+            ],
+        )
+        for model in [Observations, Entity]:
+            table = model.__tablename__
+            columns, ids = [], []
+            for name, column in TAXON_COLUMNS.items():
+                columns.append(column)
+                if name in LIST_ATTRIBUTES:
+                    ids.append(
+                        f"ARRAY(SELECT t.id FROM jsonb_array_elements_text({table}.{name}) "
+                        "WITH ORDINALITY AS e(value, n) "
+                        f"JOIN taxa t ON t.attribute = '{name}' AND t.value = e.value "
+                        "ORDER BY e.n)"
+                    )
+                else:
+                    ids.append(
+                        "(SELECT t.id FROM taxa t "
+                        f"WHERE t.attribute = '{name}' AND t.value = {table}.{name})"
+                    )
+            result = conn.execute(
+                text(
+                    f"UPDATE {table} SET ({', '.join(columns)}) = ({', '.join(ids)}) "
+                    f"WHERE ({', '.join(columns)}) IS DISTINCT FROM ({', '.join(ids)})"
+                )
+            )
+            typer.echo(f"Updated the taxon ids of {result.rowcount} rows of {table}")
+
+
+
+@app.command("refresh-leaderboards")
+def refresh_leaderboards_command():
+    """Recompute the leaderboard rankings, creating the leaderboard views first if needed. The
+    daemon does this every LEADERBOARD_INTERVAL seconds."""
+    with engine.begin() as conn:
+        create_leaderboards(conn)
+        refresh_leaderboards(conn)
+
+
+@app.command()
+def rollup_user_stats():
+    """Rebuild the per-user daily observation counts from all observations. The API maintains the
+    counts at ingest, so this is only needed for backfilling and repair."""
+    day = cast(ObservationEvents.observed_at, Date)
+    obs_type = cast(Observations.observation_type, String)
+    rollup = (
+        select(ObservationEvents.username, day, obs_type, func.count())
+        .join(ObservationEvents.observations)
+        .where(ObservationEvents.username.is_not(None), ObservationEvents.observed_at.is_not(None))
+        .group_by(ObservationEvents.username, day, obs_type)
+    )
+    with engine.begin() as conn:
+        conn.execute(delete(UserDailyCounts))
+        conn.execute(
+            insert(UserDailyCounts).from_select(
+                ["username", "day", "observation_type", "count"], rollup
+            )
+        )
+
+
+@app.command()
+def rollup_ledger_totals():
+    """Rebuild the per-user daily ledger totals from all rewards and ledger entries. The API
+    maintains the totals as rewards and transactions are created, so this is only needed for
+    backfilling and repair."""
+
+    def rollup(username, created_at, kind: str, amount):
+        day = cast(func.timezone("UTC", created_at), Date)
+        return (
+            select(username, day, literal(kind), func.count(), func.sum(amount))
+            .where(username.is_not(None), created_at.is_not(None))
+            .group_by(username, day)
+        )
+
+    with engine.begin() as conn:
+        conn.execute(delete(DailyLedgerTotals))
+        for query in [
+            rollup(Rewards.username, Rewards.created_at, "reward", Rewards.amount),
+            rollup(Entries.to_username, Entries.created_at, "credit", Entries.amount),
+            rollup(Entries.from_username, Entries.created_at, "debit", Entries.amount),
+        ]:
+            conn.execute(
+                insert(DailyLedgerTotals).from_select(
+                    ["username", "day", "kind", "count", "amount"], query
+                )
+            )
+
+
+def account_movements(after_id: int, upto_id: Optional[int] = None):
+    """The ledger entries with ids after after_id (and up to upto_id) as signed amounts on the
+    accounts they move between: positive for the receiving account, negative for the paying one."""
+    window = [Entries.id > after_id]
+    if upto_id is not None:
+        window.append(Entries.id <= upto_id)
+    return union_all(
+        select(Entries.to_account_id.label("account_id"), Entries.amount.label("amount")).where(
+            *window
+        ),
+        select(Entries.from_account_id, -Entries.amount).where(*window),
+    ).subquery()
+
+
+def opening_balances():
+    return (
+        select(BalanceCheckpoint.account_id, BalanceCheckpoint.balance)
+        .where(BalanceCheckpoint.entry_id == 0)
+        .subquery()
+    )
+
+
+def latest_checkpoints():
+    return (
+        select(BalanceCheckpoint.account_id, BalanceCheckpoint.balance)
+        .distinct(BalanceCheckpoint.account_id)
+        .order_by(BalanceCheckpoint.account_id, BalanceCheckpoint.entry_id.desc())
+        .subquery()
+    )
+
+
+@app.command()
+def open_balances(
+    usernames: list[str] = typer.Argument(
+        None, help="The accounts to open (default: the house account)"
+    ),
+):
+    """Record the opening balance of accounts that were funded outside the ledger, such as the
+    house account: the part of their balance that no ledger entry accounts for. It is stored as
+    a balance checkpoint at entry 0, which checkpoint-balances, verify-ledger and balance_at start
+    from. Running this again recomputes the opening balance, and corrects the later checkpoints of
+    the account by the difference."""
+    with engine.begin() as conn:
+        for username in usernames or ["house"]:
+            # lock the account, so that no transaction changes its balance meanwhile; entries
+            # are inserted in the same transaction as the balance update, so every entry that
+            # the balance includes is visible once the lock is granted
+            account = conn.execute(
+                select(Accounts.id, Accounts.balance, Accounts.created_at)
+                .where(Accounts.username == username)
+                .with_for_update()
+            ).first()
+            if account is None:
+                typer.echo(f"No account for {username}")
+                continue
+            moves = account_movements(0)
+            ledger = conn.scalar(
+                select(func.coalesce(func.sum(moves.c.amount), 0)).where(
+                    moves.c.account_id == account.id
+                )
+            )
+            opening = account.balance - ledger
+            previous = conn.scalar(
+                select(BalanceCheckpoint.balance).where(
+                    BalanceCheckpoint.account_id == account.id, BalanceCheckpoint.entry_id == 0
+                )
+            )
+            stmt = pg_insert(BalanceCheckpoint).values(
+                account_id=account.id,
+                entry_id=0,
+                balance=opening,
+                as_of=account.created_at or datetime.fromtimestamp(0, timezone.utc),
+            )
+            conn.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[BalanceCheckpoint.account_id, BalanceCheckpoint.entry_id],
+                    set_={"balance": stmt.excluded.balance},
+                )
+            )
+            conn.execute(
+                update(BalanceCheckpoint)
+                .where(BalanceCheckpoint.account_id == account.id, BalanceCheckpoint.entry_id > 0)
+                .values(balance=BalanceCheckpoint.balance + opening - (previous or 0))
+            )
+            typer.echo(f"Opening balance of {username}: {opening}")
+
+
+@app.command()
+def checkpoint_balances(
+    grace: int = typer.Option(
+        300, help="Only cover entries older than this many seconds, so that none are in flight"
+    ),
+):
+    """Record a balance checkpoint for every account with ledger entries since the previous run.
+    Every run covers the entries after those of the previous one, so only the new part of the
+    ledger is read."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    with engine.begin() as conn:
+        conn.execute(select(func.pg_advisory_xact_lock(func.hashtext("checkpoint-balances"))))
+        previous, previous_as_of = conn.execute(
+            select(
+                func.coalesce(func.max(BalanceCheckpoint.entry_id), 0),
+                func.max(BalanceCheckpoint.as_of),
+            )
+        ).one()
+        # the checkpoint is bounded by entry id alone: it covers every entry up to the newest one
+        # older than the grace period. Entries are stamped by the clocks of the API servers, so
+        # some of those may have been created later than that one; as_of is the latest of them
+        # all, so that balance_at never starts from a checkpoint that counts an entry created
+        # after the time asked for
+        horizon = conn.scalar(
+            select(func.max(Entries.id)).where(Entries.id > previous, Entries.created_at < cutoff)
+        )
+        if horizon is None:
+            typer.echo("No new ledger entries")
+            return
+        as_of = conn.scalar(
+            select(func.max(Entries.created_at)).where(
+                Entries.id > previous, Entries.id <= horizon
+            )
+        )
+        if previous_as_of is not None:
+            as_of = max(as_of, previous_as_of)
+
+        moves = account_movements(previous, horizon)
+        deltas = (
+            select(moves.c.account_id, func.sum(moves.c.amount).label("delta"))
+            .where(moves.c.account_id.is_not(None))
+            .group_by(moves.c.account_id)
+            .subquery()
+        )
+        latest = latest_checkpoints()
+        checkpoints = select(
+            deltas.c.account_id,
+            literal(horizon),
+            func.coalesce(latest.c.balance, 0) + deltas.c.delta,
+            literal(as_of),
+        ).select_from(deltas.outerjoin(latest, latest.c.account_id == deltas.c.account_id))
+        result = conn.execute(
+            insert(BalanceCheckpoint).from_select(
+                ["account_id", "entry_id", "balance", "as_of"], checkpoints
+            )
+        )
+    typer.echo(f"Checkpointed {result.rowcount} accounts as of entry {horizon}")
+
+
+@app.command()
+def verify_ledger(
+    full: bool = typer.Option(False, help="Sum the whole ledger rather than using checkpoints"),
+):
+    """Compare the balance of every account with its balance according to the ledger: the latest
+    checkpoint plus the entries since (or, with --full, the opening balance plus all entries).
+    Reports the accounts that have drifted, and exits with status 1 if there are any."""
+    with engine.execution_options(isolation_level="REPEATABLE READ").begin() as conn:
+        previous = 0
+        if not full:
+            previous = conn.scalar(select(func.coalesce(func.max(BalanceCheckpoint.entry_id), 0)))
+        moves = account_movements(previous)
+        deltas = (
+            select(moves.c.account_id, func.sum(moves.c.amount).label("delta"))
+            .group_by(moves.c.account_id)
+            .subquery()
+        )
+        start = opening_balances() if full else latest_checkpoints()
+        ledger = func.coalesce(start.c.balance, 0) + func.coalesce(deltas.c.delta, 0)
+        accounts = (
+            select(Accounts.id, Accounts.username, Accounts.balance)
+            .outerjoin(deltas, deltas.c.account_id == Accounts.id)
+            .outerjoin(start, start.c.account_id == Accounts.id)
+        )
+        drifted = conn.execute(
+            accounts.add_columns(ledger.label("ledger")).where(
+                Accounts.balance.is_distinct_from(ledger)
+            )
+        ).all()
+
+    for account in drifted:
+        typer.echo(
+            f"Account {account.id} ({account.username}): balance {account.balance}, "
+            f"ledger {account.ledger}"
+        )
+    if drifted:
+        raise typer.Exit(1)
+    typer.echo("All balances match the ledger")
+
+
 if __name__ == "__main__":
     app()
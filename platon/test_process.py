@@ -0,0 +1,48 @@
+import math
+from types import SimpleNamespace
+import pytest
+from process import (
+    FACILITY_MATCH_RADIUS,
+    METERS_PER_DEGREE,
+    DanglingReference,
+    payload_ref_entity,
+    resolution_keys,
+)
+
+
+def test_payload_ref_resolves_to_linked_observation():
+    assert payload_ref_entity([(None, False), (7, False)]) == 7
+
+
+def test_payload_ref_waits_for_unprocessed_observation():
+    assert payload_ref_entity([(None, False)]) is None
+    assert payload_ref_entity([(None, True), (None, False)]) is None
+
+
+def test_dangling_payload_ref():
+    # no observation of the event has the payload_ref
+    with pytest.raises(DanglingReference):
+        payload_ref_entity([])
+
+
+def test_payload_ref_to_failed_observation():
+    with pytest.raises(DanglingReference):
+        payload_ref_entity([(None, True)])
+
+
+def facility(lat: float, lon: float):
+    return SimpleNamespace(
+        observation_type="facility", location={"latitude": lat, "longitude": lon}
+    )
+
+
+@pytest.mark.parametrize("lat", [0.0, 37.8, 70.0, 89.5])
+def test_nearby_facilities_share_a_resolution_key(lat):
+    # points just within the match radius of each other, in every direction and across cell edges
+    dlat = 0.99 * FACILITY_MATCH_RADIUS / METERS_PER_DEGREE
+    dlon = dlat / math.cos(math.radians(lat))
+    for lon in (-122.5, 0.0, 0.0499, 0.05):
+        keys = set(resolution_keys(facility(lat, lon)))
+        for i, j in [(1, 0), (-1, 0), (0, 1), (0, -1), (0.7, 0.7), (-0.7, 0.7)]:
+            other = facility(lat + i * dlat, lon + j * dlon)
+            assert keys & set(resolution_keys(other)), (lat, lon, i, j)
@@ -1 +1,7 @@
-from .db import Users
\ No newline at end of file
+def __getattr__(name):
+    # imported on first use, so that importing a submodule does not load the database layer
+    if name == "Users":
+        from .db import Users
+
+        return Users
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
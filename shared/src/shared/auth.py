@@ -4,15 +4,21 @@ import os
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from jose import jwt, JWTError
-from sqlalchemy import select
+from sqlalchemy import select, bindparam
 from .models import UserInDB
-from .db import db, Users
+from .db import Users
+from .statements import Statement
 
 # Adapted from https://fastapi.tiangolo.com/tutorial/security/simple-oauth2/
 # and https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt/
 SECRET_KEY = os.getenv("LAYERS_SECRET_KEY", "")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# the users with the bulk importer role, who may import scraped observation events through
+# /observations/bulk: a comma separated list of usernames
+BULK_IMPORTERS = frozenset(
+    name.strip() for name in os.getenv("LAYERS_BULK_IMPORTERS", "").split(",") if name.strip()
+)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -33,11 +39,13 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
+# looked up on every authenticated request, so compiled once (see statements.Statement)
+GET_USER = Statement(select(Users).where(Users.username == bindparam("username")))
+
+
 async def get_user(user_db, username: str) -> Optional[UserInDB]:
-    query = select(Users).filter(Users.username == username)
-    users = await user_db.fetch_all(query=query)
-    if len(users) > 0:
-        user = users[0]
+    user = await user_db.fetch_one(GET_USER, {"username": username})
+    if user:
         return UserInDB(**user._mapping)
     else:
         return None
@@ -57,6 +65,10 @@ def username_from_token(token: str) -> Optional[str]:
     return payload.get("sub")
 
 
+def is_bulk_importer(user: UserInDB) -> bool:
+    return user.username in BULK_IMPORTERS
+
+
 async def user_from_token(token: str, user_db) -> Optional[UserInDB]:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
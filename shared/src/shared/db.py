@@ -1,7 +1,8 @@
-from typing import List
+from typing import List, Optional, TYPE_CHECKING
 import os
-import databases
-from datetime import datetime
+import time
+import asyncio
+from datetime import date, datetime, timedelta, timezone
 from sqlalchemy import (
     select,
     insert,
@@ -11,24 +12,293 @@ from sqlalchemy import (
     Column,
     Integer,
     String,
+    Text,
     Boolean,
+    Date,
     DateTime,
+    LargeBinary,
     ForeignKey,
     Enum,
+    Index,
+    UniqueConstraint,
+    Computed,
+    bindparam,
+    case,
+    false,
+    func,
+    or_,
 )
 from sqlalchemy.orm import relationship, Mapped, declarative_base
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, array, insert as pg_insert
 
 # from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2 import Geometry
-from .util import level_for_xp
+from .util import level_for_xp, activity_set_day, activity_streaks
+from .querystats import timed
+from .statements import Statement
+from .geocoder import NUM_CELLS, BOUNDARY_LAYERS, cell_index, get_geocoder
+from .taxonomy import get_taxonomies
 
-DATABASE_URL = os.getenv("DB_CREDS")
+# databases and its asyncpg driver are imported when the API first connects, since scripts and
+# platon only use the synchronous engine
+if TYPE_CHECKING:
+    import databases
+
+# the primary database, and an optional streaming replica of it for read-only queries; both are
+# read from the environment when first used, so that importing this module does not need them
+DATABASE_URL_VAR = "DB_CREDS"
+DATABASE_READ_URL_VAR = "DB_READ_CREDS"
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# reads go to the primary while the replica is more than this many seconds behind it
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = 5.0
+# observation times are client supplied; for activity and daily counts they are clamped to this window around the
+# time they are stored, so a wrong clock can neither start streaks in the future nor grow a user's
+# activity bitmap back into the distant past
+ACTIVITY_MAX_AGE = timedelta(days=int(os.getenv("DB_ACTIVITY_MAX_AGE_DAYS", "365")))
+ACTIVITY_MAX_AHEAD = timedelta(days=1)
+
+# the channel on which new observation events are announced to the processor (platon)
+OBSERVATIONS_CHANNEL = "observations"
 
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
-engine = create_engine(DATABASE_URL)
-db = databases.Database(DATABASE_URL)
+
+
+# The payload attributes that observations and entities are commonly filtered on, by column name
+# and key in the JSONB document. They are copied out of the document into generated columns: single
+# valued attributes into text columns, and those that may hold one value or a list of them into
+# JSONB columns that always hold a list.
+ATTRIBUTE_KEYS = {
+    "asset_type": "asset_type",
+    "configuration": "configuration",
+    "resource_type": "resource_type",
+    "connection_type": "connection_type",
+    "facility_functions": "functions",
+    "facility_processes": "processes",
+}
+TEXT_ATTRIBUTES = ["asset_type", "configuration", "resource_type", "connection_type"]
+LIST_ATTRIBUTES = ["facility_functions", "facility_processes"]
+# The attribute values are hierarchical, and each attribute's values also have their ids in its
+# taxonomy (see taxonomy.Taxonomy) in these columns, so that hierarchical filters are range
+# queries. Postgres cannot compute the ids, so they are set by the code that writes the document.
+TAXON_COLUMNS = {
+    "asset_type": "asset_taxon",
+    "configuration": "configuration_taxon",
+    "resource_type": "resource_taxon",
+    "connection_type": "connection_taxon",
+    "facility_functions": "facility_function_taxa",
+    "facility_processes": "facility_process_taxa",
+}
+
+
+def text_attribute(document: str, key: str) -> Column:
+    return Column(String, Computed(f"{document} ->> '{key}'", persisted=True))
+
+
+def list_attribute(document: str, key: str) -> Column:
+    # in lax mode, [*] also turns a single value into a one element list
+    return Column(
+        JSONB, Computed(f"jsonb_path_query_array({document}, '$.{key}[*]')", persisted=True)
+    )
+
+
+def attribute_indexes(table: str, document: str) -> list[Index]:
+    """Indexes for filtering on the attribute columns of a table: btree indexes on the text
+    attributes and taxon ids, GIN indexes on the list attributes and their lists of taxon ids, and
+    a jsonb_path_ops GIN index for containment queries on the whole document."""
+    indexes = []
+    for name in TEXT_ATTRIBUTES:
+        indexes.append(Index(f"ix_{table}_{name}", name))
+        indexes.append(Index(f"ix_{table}_{TAXON_COLUMNS[name]}", TAXON_COLUMNS[name]))
+    for name in LIST_ATTRIBUTES:
+        indexes.append(Index(f"ix_{table}_{name}", name, postgresql_using="gin"))
+        indexes.append(
+            Index(
+                f"ix_{table}_{TAXON_COLUMNS[name]}", TAXON_COLUMNS[name], postgresql_using="gin"
+            )
+        )
+    indexes.append(
+        Index(
+            f"ix_{table}_{document}",
+            document,
+            postgresql_using="gin",
+            postgresql_ops={document: "jsonb_path_ops"},
+        )
+    )
+    return indexes
+
+
+class LazyDatabase:
+    """A databases.Database for the URL in an environment variable, created when it is first used.
+    It is false if the variable is not set."""
+
+    def __init__(self, url_var: str):
+        self.url_var = url_var
+        self._database: "databases.Database | None" = None
+
+    def __bool__(self) -> bool:
+        return self._database is not None or bool(os.getenv(self.url_var))
+
+    def _get(self) -> "databases.Database":
+        if self._database is None:
+            import databases
+
+            url = os.getenv(self.url_var)
+            if not url:
+                raise RuntimeError(f"{self.url_var} is not set")
+            self._database = databases.Database(
+                url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE
+            )
+        return self._database
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    # the query methods are timed, for the per-request stats and the slow query log, and also
+    # accept precompiled statements (see statements.Statement)
+    async def _run(self, method: str, query, values=None, **kwargs):
+        database = self._get()
+        if isinstance(query, Statement):
+            run = query.run(database, method, values, **kwargs)
+            return await timed(query.query, values, run)
+        return await timed(query, values, getattr(database, method)(query, values, **kwargs))
+
+    async def execute(self, query, values: dict | None = None):
+        return await self._run("execute", query, values)
+
+    async def execute_many(self, query, values: list):
+        return await self._run("execute_many", query, values)
+
+    async def fetch_all(self, query, values: dict | None = None):
+        return await self._run("fetch_all", query, values)
+
+    async def fetch_one(self, query, values: dict | None = None):
+        return await self._run("fetch_one", query, values)
+
+    async def fetch_val(self, query, values: dict | None = None, column=0):
+        return await self._run("fetch_val", query, values, column=column)
+
+
+db = LazyDatabase(DATABASE_URL_VAR)
+db_replica = LazyDatabase(DATABASE_READ_URL_VAR)
+_engine = None
+
+
+def __getattr__(name):
+    # the synchronous engine is only needed by scripts, and creating it loads the DBAPI driver
+    global _engine
+    if name == "engine":
+        if _engine is None:
+            _engine = create_engine(os.getenv(DATABASE_URL_VAR))
+        return _engine
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# the replication lag in seconds; zero when the replica has replayed everything it has received,
+# since the last replay timestamp does not advance while the primary is idle
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def replica_errors() -> tuple:
+    """The errors that make the read router fall back to the primary: the replica cannot be
+    reached, has gone away, or cancelled the query (e.g. for a conflict with recovery)."""
+    import asyncpg
+
+    return (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+
+class ReadRouter:
+    """Chooses the database for read-only queries: the replica while its replication lag is within
+    max_lag seconds, and the primary when it is not, when the replica cannot be reached, or when
+    there is no replica. The lag is checked at most every check_interval seconds. The replica is
+    connected to on first use rather than at startup, so that the API starts (and reads from the
+    primary) while the replica is down; and a query that fails on the replica is run again on the
+    primary, and the replica left alone until its next check."""
+
+    def __init__(
+        self,
+        primary: LazyDatabase,
+        replica: LazyDatabase,
+        max_lag: float = REPLICA_MAX_LAG,
+        check_interval: float = REPLICA_CHECK_INTERVAL,
+    ):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag: float | None = None
+        self.routed = {"primary": 0, "replica": 0}
+        self._checked_at = 0.0
+        self._connected = False
+
+    async def connect(self):
+        # the primary is connected to by the app, and the replica on first use
+        pass
+
+    async def disconnect(self):
+        if self._connected:
+            self._connected = False
+            await self.replica.disconnect()
+
+    async def _replica_usable(self) -> bool:
+        if time.monotonic() - self._checked_at > self.check_interval:
+            self._checked_at = time.monotonic()
+            try:
+                if not self._connected:
+                    await self.replica.connect()
+                    self._connected = True
+                self.lag = float(await self.replica.fetch_val(REPLICA_LAG_QUERY))
+            except replica_errors():
+                self.lag = None
+        return self.lag is not None and self.lag <= self.max_lag
+
+    async def _read(self, method: str, query, values: dict | None, **kwargs):
+        if self.replica and await self._replica_usable():
+            try:
+                result = await getattr(self.replica, method)(query, values, **kwargs)
+            except replica_errors():
+                self.lag = None
+                self._checked_at = time.monotonic()
+            else:
+                self.routed["replica"] += 1
+                return result
+        self.routed["primary"] += 1
+        return await getattr(self.primary, method)(query, values, **kwargs)
+
+    async def fetch_all(self, query, values: dict | None = None):
+        return await self._read("fetch_all", query, values)
+
+    async def fetch_one(self, query, values: dict | None = None):
+        return await self._read("fetch_one", query, values)
+
+    async def fetch_val(self, query, values: dict | None = None, column=0):
+        return await self._read("fetch_val", query, values, column=column)
+
+
+# for read-only queries that can tolerate slightly stale data
+read_db = ReadRouter(db, db_replica)
+
+
+def pool_stats(database: "databases.Database") -> dict[str, int]:
+    """The size and number of idle connections of a database's connection pool. databases keeps the
+    pool in a private attribute of its backend, so the stats are all zero while there is no pool,
+    or if a databases version keeps it elsewhere."""
+    pool = getattr(getattr(database, "_backend", None), "_pool", None)
+    try:
+        return {
+            "size": pool.get_size(),
+            "idle": pool.get_idle_size(),
+            "max_size": pool.get_max_size(),
+        }
+    except AttributeError:
+        return {"size": 0, "idle": 0, "max_size": 0}
 
 
 class Users(Base):
@@ -66,29 +336,89 @@ class UserStats(Base):
         orm_mode = True
 
 
+class UserDailyCounts(Base):
+    """The number of observations of each type that a user made on each day, maintained at ingest.
+    Counts over any window of days are range sums over the user's rows, rather than scans over the
+    user's observations."""
+
+    __tablename__ = "user_daily_counts"
+    username = Column(String(50), primary_key=True)
+    day = Column(Date, primary_key=True)
+    observation_type = Column(String(20), primary_key=True)
+    count = Column(Integer)
+
+
+class UserActivity(Base):
+    """The days on which a user made observations, as a bitmap with one bit per day from start_day
+    on, together with the user's streaks of consecutive active days. The streaks are updated in
+    constant time as observations arrive, so reading them never touches the bitmap."""
+
+    __tablename__ = "user_activity"
+    username = Column(String(50), primary_key=True)
+    start_day = Column(Date)
+    days = Column(LargeBinary)
+    # the most recent active day, and the length of the streak ending on it
+    last_day = Column(Date)
+    current_streak = Column(Integer)
+    longest_streak = Column(Integer)
+
+
+class UserTerritory(Base):
+    """The territory a user has covered: a bitmap with one bit per 1 degree cell of the globe (see
+    geocoder.cell_index), and the sets of countries, time zones and zip codes the user has made
+    observations in, as arrays of boundary ids (see geocoder.BoundaryLayer). Both are updated in
+    place as observations arrive, so badge counts never scan the user's history."""
+
+    __tablename__ = "user_territory"
+    username = Column(String(50), primary_key=True)
+    cells = Column(LargeBinary)
+    cell_count = Column(Integer)
+    countries = Column(ARRAY(Integer))
+    timezones = Column(ARRAY(Integer))
+    zipcodes = Column(ARRAY(Integer))
+
+
 class ObservationEvents(Base):
+    """An observation event as submitted by a user, containing one or more observations. The table
+    is partitioned by month of submitted_at, which is part of the primary key as Postgres requires;
+    queries that filter on submitted_at only touch the relevant partitions. Since foreign keys into
+    a partitioned table must include its partition key, other tables refer to events by id without
+    a foreign key constraint."""
+
     __tablename__ = "observation_events"
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     username = Column(String(50))
     # the observer, as contained in the body of the observation; this should match the logged in user
     observer = Column(String(50))
     source = Column(String(50))
     observed_at = Column(DateTime)
-    submitted_at = Column(DateTime)
+    submitted_at = Column(DateTime, primary_key=True)
     location = Column(JSONB)
     observation_count = Column(Integer)
     geo = Column(Geometry(geometry_type="POINT", srid=4326))
-    observations = relationship("Observations", back_populates="event")
+    observations = relationship(
+        "Observations",
+        primaryjoin="and_(ObservationEvents.id == foreign(Observations.event_id), "
+        "ObservationEvents.submitted_at == foreign(Observations.submitted_at))",
+        back_populates="event",
+    )
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (submitted_at)"}
 
     class Config:
         orm_mode = True
 
 
 class Observations(Base):
+    """A single observation within an observation event. The table is partitioned by month of
+    submitted_at like observation_events, and submitted_at is copied from the event so that joins
+    between the two are between matching partitions."""
+
     __tablename__ = "observations"
-    id = Column(Integer, primary_key=True)
-    event_id = Column(Integer, ForeignKey("observation_events.id"))
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_id = Column(Integer)
+    submitted_at = Column(DateTime, primary_key=True)
     observation_type = Column(
         Enum(
             "asset",
@@ -96,14 +426,42 @@ class Observations(Base):
             "resource",
             "transport",
             "extent",
+            "connection",
             "",
             name="observation_type",
         )
     )
     geo = Column(Geometry(geometry_type="POLYGON", srid=4326))
     payload = Column(JSONB)
-    event = relationship("ObservationEvents", back_populates="observations")
-    entities = relationship("EntityObservation", back_populates="observation")
+    asset_type = text_attribute("payload", "asset_type")
+    configuration = text_attribute("payload", "configuration")
+    resource_type = text_attribute("payload", "resource_type")
+    connection_type = text_attribute("payload", "connection_type")
+    facility_functions = list_attribute("payload", "functions")
+    facility_processes = list_attribute("payload", "processes")
+    asset_taxon = Column(Integer)
+    configuration_taxon = Column(Integer)
+    resource_taxon = Column(Integer)
+    connection_taxon = Column(Integer)
+    facility_function_taxa = Column(ARRAY(Integer))
+    facility_process_taxa = Column(ARRAY(Integer))
+    event = relationship(
+        "ObservationEvents",
+        primaryjoin="and_(ObservationEvents.id == foreign(Observations.event_id), "
+        "ObservationEvents.submitted_at == foreign(Observations.submitted_at))",
+        back_populates="observations",
+    )
+    entities = relationship(
+        "EntityObservation",
+        primaryjoin="Observations.id == foreign(EntityObservation.observation_id)",
+        back_populates="observation",
+    )
+
+    __table_args__ = (
+        Index("ix_observations_event_id_submitted_at", "event_id", "submitted_at"),
+        *attribute_indexes("observations", "payload"),
+        {"postgresql_partition_by": "RANGE (submitted_at)"},
+    )
 
     class Config:
         orm_mode = True
@@ -113,7 +471,7 @@ class Entity(Base):
     __tablename__ = "entities"
     id = Column(Integer, primary_key=True)
     entity_type = Column(
-        Enum("asset", "facility", "resource", "extent", name="entity_type")
+        Enum("asset", "facility", "resource", "extent", "connection", name="entity_type")
     )
     created_at = Column(DateTime(timezone=True))
     updated_at = Column(DateTime(timezone=True))
@@ -121,9 +479,23 @@ class Entity(Base):
     location = Column(Geometry(geometry_type="POINT", srid=4326))
     shape = Column(Geometry(geometry_type="POLYGON", srid=4326))
     data = Column(JSONB)
+    asset_type = text_attribute("data", "asset_type")
+    configuration = text_attribute("data", "configuration")
+    resource_type = text_attribute("data", "resource_type")
+    connection_type = text_attribute("data", "connection_type")
+    facility_functions = list_attribute("data", "functions")
+    facility_processes = list_attribute("data", "processes")
+    asset_taxon = Column(Integer)
+    configuration_taxon = Column(Integer)
+    resource_taxon = Column(Integer)
+    connection_taxon = Column(Integer)
+    facility_function_taxa = Column(ARRAY(Integer))
+    facility_process_taxa = Column(ARRAY(Integer))
     observations = relationship("EntityObservation", back_populates="entity")
     identifiers = relationship("EntityIdentifier", back_populates="entity")
 
+    __table_args__ = tuple(attribute_indexes("entities", "data"))
+
     class Config:
         orm_mode = True
 
@@ -133,11 +505,16 @@ class EntityObservation(Base):
 
     __tablename__ = "entities_observations"
     entity_id = Column(Integer, ForeignKey("entities.id"), primary_key=True)
-    observation_id = Column(Integer, ForeignKey("observations.id"), primary_key=True)
+    # observations is partitioned, so this cannot be a foreign key (see ObservationEvents)
+    observation_id = Column(Integer, primary_key=True)
     created_at = Column(DateTime(timezone=True))
     status = Column(Enum("active", "inactive", name="entity_observation_status"))
     entity = relationship("Entity", back_populates="observations")
-    observation = relationship("Observations", back_populates="entities")
+    observation = relationship(
+        "Observations",
+        primaryjoin="Observations.id == foreign(EntityObservation.observation_id)",
+        back_populates="entities",
+    )
 
 
 class EntityIdentifier(Base):
@@ -155,10 +532,95 @@ class EntityIdentifier(Base):
         Enum("government", "manufacturer", "operator", "end-user", name="issuer_type")
     )
     issuer = Column(String(250))
+    # the Identifier.IDType of the identifier, e.g. BIC or a license plate type
+    id_type = Column(String(50))
     identifier = Column(String(250))
     identifier_canonical = Column(String(250))
     entity = relationship("Entity", back_populates="identifiers")
 
+    __table_args__ = (
+        # an entity records each identifier once per issuer type; platon's identifier upserts
+        # skip rows that conflict with it
+        UniqueConstraint(
+            "entity_id",
+            "issuer_type",
+            "identifier_canonical",
+            name="uq_entity_identifiers_entity_issuer_canonical",
+        ),
+        # an identifier of a given type belongs to exactly one entity; this also backs identifier
+        # lookups
+        Index(
+            "ix_entity_identifiers_id_type_canonical",
+            "id_type",
+            "identifier_canonical",
+            unique=True,
+        ),
+        # trigram index for similarity searches over identifiers (requires the pg_trgm extension)
+        Index(
+            "ix_entity_identifiers_canonical_trgm",
+            "identifier_canonical",
+            postgresql_using="gin",
+            postgresql_ops={"identifier_canonical": "gin_trgm_ops"},
+        ),
+    )
+
+
+class ProcessingCheckpoint(Base):
+    """Progress of the observation processor (platon). Every observation with an id up to and
+    including observation_id has been linked to an entity, so a new run can start after it."""
+
+    __tablename__ = "processing_checkpoints"
+    name = Column(String(50), primary_key=True)
+    observation_id = Column(Integer)
+    updated_at = Column(DateTime(timezone=True))
+
+
+class FailedObservation(Base):
+    """An observation that the processor (platon) failed to process. It stays unlinked, and workers
+    skip it until the failure is cleared (platon retry-failed)."""
+
+    __tablename__ = "failed_observations"
+    observation_id = Column(Integer, primary_key=True)
+    failed_at = Column(DateTime(timezone=True))
+    error = Column(Text)
+
+
+class AssetPosition(Base):
+    """The trajectory of an asset: one row for each observation of the asset that has a location.
+    The table is partitioned by month of observed_at, so time-windowed track queries only touch the
+    relevant partitions, and the primary key doubles as the last-known-position index."""
+
+    __tablename__ = "asset_positions"
+    entity_id = Column(Integer, ForeignKey("entities.id"), primary_key=True)
+    observed_at = Column(DateTime(timezone=True), primary_key=True)
+    observation_id = Column(Integer)
+    geo = Column(Geometry(geometry_type="POINT", srid=4326, spatial_index=False))
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (observed_at)"}
+
+
+class NetworkEdge(Base):
+    """A directed edge of the utility network, from an upstream entity to a downstream entity. The
+    edge is made by a connection entity: a conductor, pipe, conduit, canal and so on."""
+
+    __tablename__ = "network_edges"
+    id = Column(Integer, primary_key=True)
+    connection_id = Column(Integer, ForeignKey("entities.id"))
+    upstream_id = Column(Integer, ForeignKey("entities.id"))
+    downstream_id = Column(Integer, ForeignKey("entities.id"))
+    connection_type = Column(String(50))
+    connection_function = Column(String(50))
+    created_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        UniqueConstraint(
+            "upstream_id",
+            "downstream_id",
+            "connection_id",
+            name="uq_network_edges_upstream_downstream_connection",
+        ),
+    )
+
 
 class Entries(Base):
     """A ledger of all transactions between users."""
@@ -174,6 +636,27 @@ class Entries(Base):
     txtype = Column(String(50))
     txdata = Column(JSONB)
 
+    # an account's entries after a balance checkpoint are found by range scans on these
+    __table_args__ = (
+        Index("ix_entries_from_account_id_id", "from_account_id", "id"),
+        Index("ix_entries_to_account_id_id", "to_account_id", "id"),
+        # each side of a user's ledger history, newest first, readable from the index alone
+        Index(
+            "ix_entries_from_username_created_at_id",
+            from_username,
+            created_at.desc(),
+            id.desc(),
+            postgresql_include=["to_username", "amount", "txtype"],
+        ),
+        Index(
+            "ix_entries_to_username_created_at_id",
+            to_username,
+            created_at.desc(),
+            id.desc(),
+            postgresql_include=["from_username", "amount", "txtype"],
+        ),
+    )
+
     class Config:
         orm_mode = True
 
@@ -190,27 +673,443 @@ class Accounts(Base):
         orm_mode = True
 
 
+class BalanceCheckpoint(Base):
+    """The balance of an account according to the ledger: the sum of the amounts of all entries
+    into the account minus those out of it, over the entries with id up to and including entry_id.
+    No entry up to entry_id was created after as_of. The balance at any time can be found from the
+    nearest earlier checkpoint and the entries since, without reading the whole ledger.
+
+    A checkpoint at entry 0 is the opening balance of an account that was funded outside the
+    ledger, like the house account (see platon open-balances); the other checkpoints of the
+    account include it."""
+
+    __tablename__ = "balance_checkpoints"
+    account_id = Column(Integer, ForeignKey("accounts.id"), primary_key=True)
+    entry_id = Column(Integer, primary_key=True)
+    balance = Column(Integer)
+    as_of = Column(DateTime(timezone=True))
+
+    __table_args__ = (Index("ix_balance_checkpoints_account_id_as_of", "account_id", "as_of"),)
+
+
 class Rewards(Base):
     __tablename__ = "rewards"
     id = Column(Integer, primary_key=True)
     username = Column(String(50))
     amount = Column(Integer)
     created_at = Column(DateTime(timezone=True))
-    observation_event_id = Column(Integer, ForeignKey("observation_events.id"))
+    # observation_events is partitioned, so this cannot be a foreign key (see ObservationEvents)
+    observation_event_id = Column(Integer)
+
+    # a user's reward history, newest first, readable from the index alone
+    __table_args__ = (
+        Index(
+            "ix_rewards_username_created_at_id",
+            username,
+            created_at.desc(),
+            id.desc(),
+            postgresql_include=["amount"],
+        ),
+    )
+
+
+class DailyLedgerTotals(Base):
+    """The number and total amount of each kind of ledger movement (reward, credit or debit) for
+    each user and day, maintained as rewards and transactions are created. History totals are sums
+    over the user's rows, rather than over the user's rewards and entries."""
+
+    __tablename__ = "daily_ledger_totals"
+    username = Column(String(50), primary_key=True)
+    day = Column(Date, primary_key=True)
+    kind = Column(String(10), primary_key=True)
+    count = Column(Integer)
+    amount = Column(Integer)
+
+
+def attribute_taxa(document: Optional[dict]) -> dict:
+    """The values of the taxon columns for a JSONB document (see TAXON_COLUMNS). Values that are
+    not in their attribute's taxonomy have no id."""
+    taxonomies = get_taxonomies()
+    document = document or {}
+    taxa = {}
+    for name, column in TAXON_COLUMNS.items():
+        taxonomy = taxonomies[name]
+        value = document.get(ATTRIBUTE_KEYS[name])
+        if name in LIST_ATTRIBUTES:
+            values = value if isinstance(value, list) else [] if value is None else [value]
+            ids = [taxonomy.taxon(v) for v in values if isinstance(v, str)]
+            taxa[column] = [i for i in ids if i is not None]
+        else:
+            taxa[column] = taxonomy.taxon(value) if isinstance(value, str) else None
+    return taxa
+
+
+def attribute_conditions(model, filters: dict[str, str]) -> list:
+    """Where clauses for filters on the attributes of Observations or Entity, keyed by column name.
+    A value ending in * is a hierarchical filter, matching every value that starts with the part
+    before it (e.g. container:* matches container:tank:plastic, and provision:mineral:* everything
+    under provision:mineral); it is a range query on the taxon ids. Any other value matches
+    exactly. For list attributes, a filter matches if any value in the list does."""
+    conditions = []
+    for name, value in filters.items():
+        if not value.endswith("*"):
+            column = getattr(model, name)
+            if name in LIST_ATTRIBUTES:
+                conditions.append(column.contains([value]))
+            else:
+                conditions.append(column == value)
+            continue
+
+        column = getattr(model, TAXON_COLUMNS[name])
+        taxa = get_taxonomies()[name].prefix_range(value[:-1])
+        if taxa is None:
+            conditions.append(false())
+        elif name in LIST_ATTRIBUTES:
+            # GIN indexes cannot answer range queries, so the range is expanded into its ids
+            conditions.append(column.overlap(array(range(taxa[0], taxa[1] + 1))))
+        else:
+            conditions.append(column.between(*taxa))
+    return conditions
+
+
+# the statements run for every observation event, compiled once (see statements.Statement)
+INSERT_OBSERVATION_EVENT = Statement(
+    insert(ObservationEvents)
+    .values(
+        {
+            column: bindparam(column)
+            for column in [
+                "username",
+                "observer",
+                "source",
+                "observed_at",
+                "submitted_at",
+                "location",
+                "observation_count",
+                "geo",
+            ]
+        }
+    )
+    .returning(ObservationEvents.id)
+)
+INSERT_OBSERVATION = Statement(
+    insert(Observations).values(
+        {
+            column: bindparam(column)
+            for column in [
+                "event_id",
+                "submitted_at",
+                "observation_type",
+                "payload",
+                *TAXON_COLUMNS.values(),
+            ]
+        }
+    )
+)
+INSERT_REWARD = Statement(
+    insert(Rewards).values(
+        username=bindparam("username"),
+        amount=bindparam("amount"),
+        observation_event_id=bindparam("event_id"),
+        created_at=bindparam("created_at"),
+    )
+)
+ADD_XP = Statement(
+    update(Users)
+    .where(Users.username == bindparam("username"))
+    .values(xp=Users.xp + bindparam("amount"))
+)
+GET_USER_XP = Statement(
+    select(Users.xp, Users.level).where(Users.username == bindparam("username"))
+)
+SET_LEVEL = Statement(
+    update(Users).where(Users.username == bindparam("username")).values(level=bindparam("level"))
+)
+GET_ACCOUNT = Statement(
+    select(Accounts.id, Accounts.balance).where(Accounts.username == bindparam("username"))
+)
+INSERT_ENTRY = Statement(
+    insert(Entries).values(
+        {
+            column: bindparam(column)
+            for column in [
+                "from_account_id",
+                "to_account_id",
+                "from_username",
+                "to_username",
+                "amount",
+                "created_at",
+                "txtype",
+            ]
+        }
+    )
+)
+ADD_TO_BALANCE = Statement(
+    update(Accounts)
+    .where(Accounts.id == bindparam("account_id"))
+    .values(balance=Accounts.balance + bindparam("amount"))
+)
+_ledger_totals = pg_insert(DailyLedgerTotals).values(
+    username=bindparam("username"),
+    day=bindparam("day"),
+    kind=bindparam("kind"),
+    count=1,
+    amount=bindparam("amount"),
+)
+ADD_LEDGER_TOTALS = Statement(
+    _ledger_totals.on_conflict_do_update(
+        index_elements=[DailyLedgerTotals.username, DailyLedgerTotals.day, DailyLedgerTotals.kind],
+        set_={
+            "count": DailyLedgerTotals.count + _ledger_totals.excluded.count,
+            "amount": DailyLedgerTotals.amount + _ledger_totals.excluded.amount,
+        },
+    )
+)
 
 
 async def create_reward(username: str, amount: int, event_id: int):
     """Create a reward for a user, including both a reward ledger entry and an increment to the
     user's XP. This must be done in a transaction (assumed to be handled by the caller)."""
-    reward = insert(Rewards).values(
-        username=username,
-        amount=amount,
-        observation_event_id=event_id,
-        created_at=datetime.now(),
+    await db.execute(
+        INSERT_REWARD,
+        {
+            "username": username,
+            "amount": amount,
+            "event_id": event_id,
+            "created_at": datetime.now(timezone.utc),
+        },
+    )
+    await db.execute(ADD_XP, {"username": username, "amount": amount})
+    await record_ledger_totals([(username, "reward", amount)])
+
+
+async def record_ledger_totals(movements: list[tuple[str, str, int]]):
+    """Add (username, kind, amount) movements to today's ledger totals."""
+    day = utc_day(datetime.now(timezone.utc))
+    await db.execute_many(
+        ADD_LEDGER_TOTALS,
+        [
+            {"username": username, "day": day, "kind": kind, "amount": amount}
+            for username, kind, amount in movements
+        ],
+    )
+
+
+async def ledger_totals(username: str) -> dict[str, dict[str, int]]:
+    """A user's all-time count and amount of each kind of ledger movement."""
+    rows = await db.fetch_all(
+        select(
+            DailyLedgerTotals.kind,
+            func.sum(DailyLedgerTotals.count).label("count"),
+            func.sum(DailyLedgerTotals.amount).label("amount"),
+        )
+        .where(DailyLedgerTotals.username == username)
+        .group_by(DailyLedgerTotals.kind)
     )
-    bump = update(Users).where(Users.username == username).values(xp=Users.xp + amount)
-    await db.execute(reward)
-    await db.execute(bump)
+    totals = {kind: {"count": 0, "amount": 0} for kind in ("reward", "credit", "debit")}
+    for row in rows:
+        totals[row.kind] = {"count": row.count, "amount": row.amount}
+    return totals
+
+
+def utc_day(dt: datetime) -> date:
+    """The UTC calendar day of a timestamp; naive timestamps are taken to be in UTC already."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.date()
+
+
+def activity_time(observed_at: datetime, now: datetime | None = None) -> datetime:
+    """An observation time clamped to between ACTIVITY_MAX_AGE before now and ACTIVITY_MAX_AHEAD
+    after it; naive timestamps are taken to be in UTC."""
+    if observed_at.tzinfo is None:
+        observed_at = observed_at.replace(tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    return min(max(observed_at, now - ACTIVITY_MAX_AGE), now + ACTIVITY_MAX_AHEAD)
+
+
+async def record_daily_counts(username: str, observed_at: datetime, counts: dict[str, int]):
+    """Add a user's observations, counted by observation type, to the user's daily counts for the
+    day they were observed. observed_at should already be clamped by activity_time."""
+    if not counts:
+        return
+    day = utc_day(observed_at)
+    stmt = pg_insert(UserDailyCounts).values(
+        [
+            {"username": username, "day": day, "observation_type": obs_type, "count": count}
+            for obs_type, count in counts.items()
+        ]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[
+            UserDailyCounts.username,
+            UserDailyCounts.day,
+            UserDailyCounts.observation_type,
+        ],
+        set_={"count": UserDailyCounts.count + stmt.excluded.count},
+    )
+    await db.execute(stmt)
+
+
+async def record_activity(username: str, observed_at: datetime):
+    """Mark the day of an observation as an active day for the user, and update the user's streaks.
+    observed_at should already be clamped by activity_time. This must be done in a transaction (assumed to be handled by the caller)."""
+    day = utc_day(observed_at)
+    await db.execute(
+        pg_insert(UserActivity)
+        .values(
+            username=username,
+            start_day=day,
+            days=b"",
+            current_streak=0,
+            longest_streak=0,
+        )
+        .on_conflict_do_nothing()
+    )
+    activity = await db.fetch_one(
+        select(UserActivity).where(UserActivity.username == username).with_for_update()
+    )
+    last_day = activity.last_day
+    if last_day == day:
+        return
+
+    days, start_day = activity_set_day(activity.days, activity.start_day, day)
+    if last_day is None or day == last_day + timedelta(days=1):
+        current = activity.current_streak + 1
+        longest = max(activity.longest_streak, current)
+        last_day = day
+    elif day > last_day:
+        current = 1
+        longest = max(activity.longest_streak, 1)
+        last_day = day
+    else:
+        # a day in the past may join two streaks together, so recount from the bitmap
+        current, longest = activity_streaks(days, start_day, last_day)
+
+    await db.execute(
+        update(UserActivity)
+        .where(UserActivity.username == username)
+        .values(
+            start_day=start_day,
+            days=days,
+            last_day=last_day,
+            current_streak=current,
+            longest_streak=longest,
+        )
+    )
+
+
+async def get_streaks(username: str, today: date) -> tuple[int, int]:
+    """The user's (current, longest) streaks of active days. The current streak is still alive if
+    its last day is today or yesterday, and is zero otherwise."""
+    activity = await db.fetch_one(
+        select(
+            UserActivity.last_day, UserActivity.current_streak, UserActivity.longest_streak
+        ).where(UserActivity.username == username)
+    )
+    if not activity or activity.last_day is None:
+        return 0, 0
+    current = activity.current_streak
+    if activity.last_day < today - timedelta(days=1):
+        current = 0
+    return current, activity.longest_streak
+
+
+async def record_territory(username: str, longitude: float, latitude: float):
+    """Add the location of an observation to the user's territory. The cell bit and the boundary
+    sets are updated by a single UPDATE, so concurrent submissions by the same user cannot lose
+    each other's updates."""
+    await db.execute(
+        pg_insert(UserTerritory)
+        .values(
+            username=username,
+            cells=bytes(NUM_CELLS // 8),
+            cell_count=0,
+            countries=[],
+            timezones=[],
+            zipcodes=[],
+        )
+        .on_conflict_do_nothing()
+    )
+    cell = cell_index(longitude, latitude)
+    values = {
+        "cells": func.set_bit(UserTerritory.cells, cell, 1),
+        "cell_count": UserTerritory.cell_count + 1 - func.get_bit(UserTerritory.cells, cell),
+    }
+    geocoder = get_geocoder()
+    if geocoder:
+        for layer, ids in geocoder.lookup([longitude], [latitude]).items():
+            boundary = int(ids[0])
+            if boundary < 0:
+                continue
+            column = getattr(UserTerritory, layer)
+            values[layer] = case(
+                (column.any(boundary), column), else_=func.array_append(column, boundary)
+            )
+    await db.execute(
+        update(UserTerritory).where(UserTerritory.username == username).values(**values)
+    )
+
+
+async def get_territory(username: str) -> dict[str, int]:
+    """The number of cells, and of boundaries in each layer, that the user has covered."""
+    territory = await db.fetch_one(
+        select(
+            UserTerritory.cell_count,
+            *[
+                func.coalesce(func.cardinality(getattr(UserTerritory, layer)), 0).label(layer)
+                for layer in BOUNDARY_LAYERS
+            ],
+        ).where(UserTerritory.username == username)
+    )
+    if not territory:
+        return {"cells": 0, **{layer: 0 for layer in BOUNDARY_LAYERS}}
+    return {
+        "cells": territory.cell_count,
+        **{layer: getattr(territory, layer) for layer in BOUNDARY_LAYERS},
+    }
+
+
+STATS_WINDOWS = [1, 7, 30, 90, 365]
+
+
+async def rolling_counts(username: str, today: date) -> dict[str, dict[str, int]]:
+    """Sum a user's daily counts by observation type over the trailing windows in STATS_WINDOWS
+    (the window of n days ends with today), and over all time. Returns a dict from window name
+    ("alltime", "1day", "7days", ...) to a dict from observation type to count, plus the last day
+    with an observation under "last_day"."""
+    windows = {"alltime": func.sum(UserDailyCounts.count)}
+    for n in STATS_WINDOWS:
+        name = "1day" if n == 1 else f"{n}days"
+        windows[name] = func.coalesce(
+            func.sum(UserDailyCounts.count).filter(
+                UserDailyCounts.day > today - timedelta(days=n)
+            ),
+            0,
+        )
+    query = (
+        select(
+            UserDailyCounts.observation_type,
+            func.max(UserDailyCounts.day).label("last_day"),
+            *[col.label(f"counts_{name}") for name, col in windows.items()],
+        )
+        .where(UserDailyCounts.username == username)
+        .group_by(UserDailyCounts.observation_type)
+    )
+    rows = await db.fetch_all(query)
+
+    out = {name: {} for name in windows}
+    out["last_day"] = max((r.last_day for r in rows), default=None)
+    for r in rows:
+        for name in windows:
+            out[name][r.observation_type] = r._mapping[f"counts_{name}"]
+    return out
+
+
+async def notify_observations(event_id: int):
+    """Announce a new observation event to listening processors. Postgres delivers the
+    notification when the enclosing transaction commits, and not at all if it rolls back."""
+    await db.execute(select(func.pg_notify(OBSERVATIONS_CHANNEL, str(event_id))))
 
 
 async def create_transaction(
@@ -220,48 +1119,55 @@ async def create_transaction(
     balance of the from and to accounts."""
 
     # For now, assume each user has a single account.
-    from_account = await db.fetch_one(
-        select(Accounts).filter(Accounts.username == from_username)
-    )
-    to_account = await db.fetch_one(
-        select(Accounts).filter(Accounts.username == to_username)
-    )
+    from_account = await db.fetch_one(GET_ACCOUNT, {"username": from_username})
+    to_account = await db.fetch_one(GET_ACCOUNT, {"username": to_username})
 
     if from_account.balance < amount:
         # insufficient funds
         raise Exception("Insufficient funds")
 
-    entry = insert(Entries).values(
-        from_account_id=from_account.id,
-        to_account_id=to_account.id,
-        from_username=from_username,
-        to_username=to_username,
-        amount=amount,
-        created_at=datetime.now(),
-        txtype=txtype,
-    )
-    debit = (
-        update(Accounts)
-        .where(Accounts.id == from_account.id)
-        .values(balance=Accounts.balance - amount)
+    entry = {
+        "from_account_id": from_account.id,
+        "to_account_id": to_account.id,
+        "from_username": from_username,
+        "to_username": to_username,
+        "amount": amount,
+        "created_at": datetime.now(timezone.utc),
+        "txtype": txtype,
+    }
+    await db.execute(INSERT_ENTRY, entry)
+    await db.execute(ADD_TO_BALANCE, {"account_id": from_account.id, "amount": -amount})
+    await db.execute(ADD_TO_BALANCE, {"account_id": to_account.id, "amount": amount})
+    await record_ledger_totals([(from_username, "debit", amount), (to_username, "credit", amount)])
+
+
+async def balance_at(account_id: int, at: datetime) -> int:
+    """The balance of an account according to the ledger, counting the entries created up to at.
+    Starts from the checkpoint with the highest entry id among those whose entries were all created
+    by that time, so only the entries after the checkpoint's entry id are summed."""
+    checkpoint = await db.fetch_one(
+        select(BalanceCheckpoint.entry_id, BalanceCheckpoint.balance)
+        .where(BalanceCheckpoint.account_id == account_id, BalanceCheckpoint.as_of <= at)
+        .order_by(BalanceCheckpoint.entry_id.desc())
+        .limit(1)
     )
-    credit = (
-        update(Accounts)
-        .where(Accounts.id == to_account.id)
-        .values(balance=Accounts.balance + amount)
+    entry_id, balance = (checkpoint.entry_id, checkpoint.balance) if checkpoint else (0, 0)
+    tail = select(
+        func.coalesce(func.sum(Entries.amount).filter(Entries.to_account_id == account_id), 0)
+        - func.coalesce(func.sum(Entries.amount).filter(Entries.from_account_id == account_id), 0)
+    ).where(
+        or_(Entries.to_account_id == account_id, Entries.from_account_id == account_id),
+        Entries.id > entry_id,
+        Entries.created_at <= at,
     )
-    await db.execute(entry)
-    await db.execute(debit)
-    await db.execute(credit)
+    return balance + await db.fetch_val(tail)
 
 
 async def maybe_increase_level(username) -> bool:
     """Increase the level of a user if they have enough XP."""
-    user = await db.fetch_one(select(Users).filter(Users.username == username))
+    user = await db.fetch_one(GET_USER_XP, {"username": username})
     new_level = level_for_xp(user.xp)
     if new_level > user.level:
-        await db.execute(
-            update(Users).where(Users.username == username).values(level=new_level)
-        )
+        await db.execute(SET_LEVEL, {"username": username, "level": new_level})
         return True
     return False
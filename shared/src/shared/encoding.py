@@ -0,0 +1,238 @@
+from typing import Any, Optional
+import sys
+from array import array
+from functools import lru_cache
+from itertools import islice
+import msgpack
+
+# MessagePack bodies are the JSON bodies of the API made smaller in two ways: map keys that are
+# field names of the models in shared.schemas are replaced by small integers, and the coordinates
+# of GeoJSON geometries are packed into an array of integers. Keys are replaced at every depth,
+# including the keys of props and data that happen to be field names; since integer keys only ever
+# stand for field names, decoding restores them all. Coordinates are rounded to 1e-7 degrees,
+# and decode as floats. Everything else (e.g. dates as ISO strings) is as in JSON.
+#
+# The smaller bodies cost time: both encoding and decoding go through every map in Python, where
+# JSON and plain MessagePack do not leave C. See api/bench_encoding.py for how the sizes and times
+# compare.
+MEDIA_TYPE = "application/msgpack"
+MEDIA_TYPES = {MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack"}
+
+# the MessagePack extension type of packed coordinates
+COORDINATES_EXT = 1
+# packed coordinates are 32 bit integers in units of 1e-7 degrees (about a centimetre), so that
+# any longitude or latitude fits; finer coordinates lose their extra digits
+COORDINATE_SCALE = 10**7
+GEOMETRY_TYPES = {
+    "Point",
+    "MultiPoint",
+    "LineString",
+    "MultiLineString",
+    "Polygon",
+    "MultiPolygon",
+}
+SEQUENCES = (list, tuple)
+CONTAINERS = (dict, list, tuple)
+NUMBERS = (float, int)
+# the depth of the lists of positions in the coordinates of a MultiPolygon
+MAX_DEPTH = 3
+
+
+# the field names of the observation event and entity models that MessagePack bodies replace by
+# integer keys; the key of a name is its position here. Clients may keep the keys they got from
+# /meta/field-keys, so this list is append only: add new field names at the end, and never remove
+# or reorder names (a removed field keeps its key). Field names that are not here stay strings.
+FIELD_NAMES = (
+    "agriculture_type",
+    "amount",
+    "asset_id",
+    "asset_type",
+    "bbox",
+    "boundary_type",
+    "configuration",
+    "connection_function",
+    "connection_type",
+    "coordinates",
+    "data",
+    "description",
+    "downstream",
+    "entity_type",
+    "extent_id",
+    "features",
+    "functions",
+    "geohash",
+    "geometries",
+    "geometry",
+    "id",
+    "id_text",
+    "id_type",
+    "identifiers",
+    "landuse_type",
+    "latest_observation_at",
+    "latitude",
+    "location",
+    "longitude",
+    "mode",
+    "observation_type",
+    "observations",
+    "observed_at",
+    "observer",
+    "payload",
+    "payload_ref",
+    "pluscode",
+    "processes",
+    "product",
+    "properties",
+    "props",
+    "quantity",
+    "ref",
+    "resource_id",
+    "resource_type",
+    "route",
+    "shape",
+    "source",
+    "submitted_at",
+    "transporter",
+    "type",
+    "unit",
+    "upstream",
+    "vessel",
+)
+
+
+@lru_cache(maxsize=1)
+def field_keys() -> dict[str, int]:
+    """The integer key that stands for each field name in FIELD_NAMES in MessagePack bodies."""
+    return {name: key for key, name in enumerate(FIELD_NAMES)}
+
+
+@lru_cache(maxsize=1)
+def field_names() -> dict[int, str]:
+    return {key: name for name, key in field_keys().items()}
+
+
+def _positions(positions, values: list) -> bool:
+    """Add the coordinates of positions to values, in order. False if they are not all longitude,
+    latitude pairs."""
+    for position in positions:
+        if type(position) not in SEQUENCES or len(position) != 2:
+            return False
+        longitude, latitude = position
+        if type(longitude) not in NUMBERS or type(latitude) not in NUMBERS:
+            return False
+        values.append(longitude)
+        values.append(latitude)
+    return True
+
+
+def _flatten(coordinates, depth: int, counts: list[int], values: list) -> bool:
+    """Add the coordinates of the positions nested depth lists deep in coordinates to values, and
+    the length of each of those lists to counts, in order."""
+    if type(coordinates) not in SEQUENCES:
+        return False
+    counts.append(len(coordinates))
+    if depth == 1:
+        return _positions(coordinates, values)
+    return all(_flatten(c, depth - 1, counts, values) for c in coordinates)
+
+
+def pack_coordinates(coordinates) -> Optional[msgpack.ExtType]:
+    """The coordinates of a GeoJSON geometry as a COORDINATES_EXT value, or None if they are not
+    all longitude, latitude pairs (in which case they are left as they are)."""
+    depth = 0
+    position = coordinates
+    while type(position) in SEQUENCES and position and type(position[0]) in SEQUENCES:
+        depth += 1
+        position = position[0]
+    counts: list[int] = []
+    values: list = []
+    if depth == 0:
+        valid = _positions([coordinates], values)
+    else:
+        valid = depth <= MAX_DEPTH and _flatten(coordinates, depth, counts, values)
+    if not valid:
+        return None
+    try:
+        packed = array("i", [round(x * COORDINATE_SCALE) for x in values])
+    except (OverflowError, ValueError):
+        return None
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return msgpack.ExtType(COORDINATES_EXT, msgpack.packb([depth, counts, packed.tobytes()]))
+
+
+def _nest(positions, depth: int, counts):
+    count = next(counts)
+    if depth > 1:
+        return [_nest(positions, depth - 1, counts) for _ in range(count)]
+    nested = list(islice(positions, count))
+    if len(nested) != count:
+        raise ValueError
+    return nested
+
+
+def unpack_coordinates(data: bytes) -> list:
+    """The coordinates of a GeoJSON geometry, from a COORDINATES_EXT value."""
+    try:
+        depth, counts, packed = msgpack.unpackb(data)
+        if type(depth) is not int or not 0 <= depth <= MAX_DEPTH:
+            raise ValueError
+        values = array("i")
+        values.frombytes(packed)
+        if sys.byteorder == "big":
+            values.byteswap()
+        scaled = iter([x / COORDINATE_SCALE for x in values])
+        positions = map(list, zip(scaled, scaled))
+        coordinates = _nest(positions, depth, iter(counts)) if depth else next(positions)
+        if next(positions, None) is not None:
+            raise ValueError
+        return coordinates
+    except (StopIteration, TypeError, ValueError):
+        raise ValueError("Invalid packed coordinates")
+
+
+def _compact(value, keys: dict[str, int]):
+    if type(value) is dict:
+        coordinates = None
+        geometry_type = value.get("type")
+        if type(geometry_type) is str and geometry_type in GEOMETRY_TYPES:
+            coordinates = pack_coordinates(value.get("coordinates"))
+        out = {}
+        for k, v in value.items():
+            if k == "coordinates" and coordinates is not None:
+                v = coordinates
+            elif type(v) in CONTAINERS:
+                v = _compact(v, keys)
+            out[keys.get(k, k)] = v
+        return out
+    return [_compact(v, keys) if type(v) in CONTAINERS else v for v in value]
+
+
+def _expand(obj: dict) -> dict:
+    names = field_names()
+    try:
+        return {k if type(k) is str else names[k]: v for k, v in obj.items()}
+    except (KeyError, TypeError):
+        raise ValueError("Unknown field key")
+
+
+def _ext(code: int, data: bytes):
+    if code == COORDINATES_EXT:
+        return unpack_coordinates(data)
+    raise ValueError(f"Unknown extension type {code}")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode a JSON value (dicts, lists, strings, numbers, booleans and None) as MessagePack."""
+    if type(content) in CONTAINERS:
+        content = _compact(content, field_keys())
+    return msgpack.packb(content)
+
+
+def loads(data: bytes) -> Any:
+    """Decode MessagePack made by dumps, to the value that was encoded, with its coordinates rounded
+    to 1e-7 degrees. Raises ValueError if the data is not valid."""
+    try:
+        return msgpack.unpackb(data, object_hook=_expand, ext_hook=_ext, strict_map_key=False)
+    except (msgpack.UnpackException, TypeError) as e:
+        raise ValueError(str(e) or "Invalid MessagePack")
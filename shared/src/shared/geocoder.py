@@ -0,0 +1,93 @@
+from typing import Optional, TYPE_CHECKING
+import os
+import json
+import math
+from functools import lru_cache
+
+# numpy and shapely are imported where they are needed, since most importers only need cell_index
+if TYPE_CHECKING:
+    import numpy as np
+
+# A directory of GeoJSON FeatureCollections, one per boundary layer, in which every feature has a
+# "code" property (an ISO country code, a time zone name, a zip code, ...)
+BOUNDARIES_PATH = os.getenv("LAYERS_BOUNDARIES_PATH")
+BOUNDARY_LAYERS = {
+    "countries": "countries.geojson",
+    "timezones": "timezones.geojson",
+    "zipcodes": "zipcodes.geojson",
+}
+
+# 1 degree latitude / longitude cells, numbered row by row from the south west corner
+NUM_CELLS = 180 * 360
+
+
+def cell_index(longitude: float, latitude: float) -> int:
+    """The number of the 1 degree cell containing a point."""
+    row = min(math.floor(latitude) + 90, 179)
+    col = min(math.floor(longitude) + 180, 359)
+    return row * 360 + col
+
+
+class BoundaryLayer:
+    """A set of boundary polygons in an STRtree, for point-in-polygon lookups. Each boundary is
+    identified by a small integer: its position in the layer when sorted by code, which is stable
+    for as long as the dataset does not change."""
+
+    def __init__(self, codes: list[str], geometries: list):
+        from shapely import STRtree
+
+        order = sorted(range(len(codes)), key=lambda i: codes[i])
+        self.codes = [codes[i] for i in order]
+        self.tree = STRtree([geometries[i] for i in order])
+
+    @classmethod
+    def from_geojson(cls, path: str, code_property: str = "code") -> "BoundaryLayer":
+        import shapely
+
+        with open(path, "r") as fd:
+            collection = json.load(fd)
+        codes, geometries = [], []
+        for feature in collection["features"]:
+            codes.append(str(feature["properties"][code_property]))
+            geometries.append(shapely.from_geojson(json.dumps(feature["geometry"])))
+        return cls(codes, geometries)
+
+    def lookup(self, longitudes, latitudes) -> "np.ndarray":
+        """The ids of the boundaries containing each of the points, or -1 for points outside of
+        every boundary. All points are looked up in a single vectorized query."""
+        import numpy as np
+        import shapely
+
+        points = shapely.points(np.asarray(longitudes, float), np.asarray(latitudes, float))
+        point_idx, boundary_idx = self.tree.query(points, predicate="within")
+        ids = np.full(len(points), -1, dtype=np.int64)
+        # where boundaries overlap, the point gets the one with the lowest id
+        ids[point_idx[::-1]] = boundary_idx[::-1]
+        return ids
+
+
+class ReverseGeocoder:
+    """An offline, in-process reverse geocoder over the boundary layers that are present in a local
+    directory. It never makes network calls."""
+
+    def __init__(self, path: str):
+        self.layers = {}
+        for name, filename in BOUNDARY_LAYERS.items():
+            layer_path = os.path.join(path, filename)
+            if os.path.exists(layer_path):
+                self.layers[name] = BoundaryLayer.from_geojson(layer_path)
+
+    def lookup(self, longitudes, latitudes) -> dict[str, "np.ndarray"]:
+        """The boundary ids containing each point, for every layer (see BoundaryLayer.lookup)."""
+        return {
+            name: layer.lookup(longitudes, latitudes) for name, layer in self.layers.items()
+        }
+
+
+@lru_cache(maxsize=1)
+def get_geocoder() -> Optional[ReverseGeocoder]:
+    """The shared reverse geocoder, or None if no boundary dataset is configured. Loading the
+    boundaries is slow, so this is done once per process."""
+    if not BOUNDARIES_PATH:
+        return None
+    return ReverseGeocoder(BOUNDARIES_PATH)
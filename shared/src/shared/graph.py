@@ -0,0 +1,112 @@
+from typing import Optional, Sequence
+import numpy as np
+
+
+def _expand(indptr: np.ndarray, indices: np.ndarray, frontier: np.ndarray):
+    """Gather the neighbors of every node in frontier from a CSR adjacency in one vectorized step.
+    Returns the neighbors along with the frontier node that each one was reached from."""
+    starts = indptr[frontier]
+    lengths = indptr[frontier + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=indices.dtype), np.empty(0, dtype=frontier.dtype)
+    # position p of the output belongs to frontier node k, and maps to starts[k] + (p - offset[k])
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return indices[offsets + np.arange(total)], np.repeat(frontier, lengths)
+
+
+def _csr(src: np.ndarray, dst: np.ndarray, n: int):
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst[order]
+
+
+class NetworkGraph:
+    """The utility network as a compact adjacency structure for traversal queries. Entity ids are
+    mapped to dense node numbers, and the edges are kept in compressed sparse row (CSR) form in
+    both directions, so that every traversal step is a handful of array operations regardless of
+    the size of the graph."""
+
+    def __init__(self, upstream_ids: Sequence[int], downstream_ids: Sequence[int]):
+        upstream = np.asarray(upstream_ids, dtype=np.int64)
+        downstream = np.asarray(downstream_ids, dtype=np.int64)
+        self.entity_ids, inverse = np.unique(
+            np.concatenate([upstream, downstream]), return_inverse=True
+        )
+        src, dst = inverse[: len(upstream)], inverse[len(upstream) :]
+        n = len(self.entity_ids)
+        self.num_edges = len(src)
+        self._down = _csr(src, dst, n)
+        self._up = _csr(dst, src, n)
+
+    def __len__(self) -> int:
+        return len(self.entity_ids)
+
+    def _node(self, entity_id: int) -> Optional[int]:
+        i = int(np.searchsorted(self.entity_ids, entity_id))
+        if i < len(self.entity_ids) and self.entity_ids[i] == entity_id:
+            return i
+        return None
+
+    def _bfs(self, start: int, adjacencies, max_depth: Optional[int] = None):
+        """Breadth-first search from node start, level by level. Returns the parent of every
+        reached node (-1 for unreached nodes, and start is its own parent)."""
+        parent = np.full(len(self.entity_ids), -1, dtype=np.int64)
+        parent[start] = start
+        frontier = np.array([start], dtype=np.int64)
+        depth = 0
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            reached, sources = [], []
+            for indptr, indices in adjacencies:
+                r, s = _expand(indptr, indices, frontier)
+                reached.append(r)
+                sources.append(s)
+            reached = np.concatenate(reached)
+            sources = np.concatenate(sources)
+            new = parent[reached] == -1
+            reached, first = np.unique(reached[new], return_index=True)
+            parent[reached] = sources[new][first]
+            frontier = reached
+            depth += 1
+        return parent
+
+    def _reachable(self, entity_id: int, adjacencies, max_depth=None) -> list[int]:
+        start = self._node(entity_id)
+        if start is None:
+            return []
+        parent = self._bfs(start, adjacencies, max_depth)
+        parent[start] = -1
+        return self.entity_ids[parent != -1].tolist()
+
+    def downstream(self, entity_id: int, max_depth: Optional[int] = None) -> list[int]:
+        """The ids of all entities downstream of an entity, optionally within max_depth edges."""
+        return self._reachable(entity_id, [self._down], max_depth)
+
+    def upstream(self, entity_id: int, max_depth: Optional[int] = None) -> list[int]:
+        """The ids of all entities upstream of an entity, optionally within max_depth edges."""
+        return self._reachable(entity_id, [self._up], max_depth)
+
+    def component(self, entity_id: int) -> list[int]:
+        """The ids of all entities connected to an entity, ignoring the direction of the edges. The
+        entity itself is included."""
+        if self._node(entity_id) is None:
+            return []
+        return sorted([entity_id] + self._reachable(entity_id, [self._down, self._up]))
+
+    def shortest_path(
+        self, source_id: int, target_id: int, directed: bool = True
+    ) -> Optional[list[int]]:
+        """The entity ids along a path with the fewest edges from source to target, or None if
+        there is no such path. With directed=False, edges may be followed in either direction."""
+        source, target = self._node(source_id), self._node(target_id)
+        if source is None or target is None:
+            return None
+        adjacencies = [self._down] if directed else [self._down, self._up]
+        parent = self._bfs(source, adjacencies)
+        if parent[target] == -1:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(int(parent[path[-1]]))
+        return self.entity_ids[path[::-1]].tolist()
@@ -0,0 +1,84 @@
+from typing import Optional
+from sqlalchemy import text, select, table, column, Integer, String
+from .db import db
+
+# geohash precision of the regions that have their own leaderboard (2 characters is about
+# 1250km x 625km)
+REGION_PRECISION = 2
+
+# Each leaderboard is a materialized view with one row per (scope, user) and the user's rank
+# within the scope. The global leaderboard has a single scope, "all".
+LEADERBOARDS = {
+    "leaderboard_global": """
+        SELECT 'all'::text AS scope, username, xp AS score,
+            rank() OVER (ORDER BY xp DESC) AS rank
+        FROM users
+        WHERE xp > 0
+    """,
+    "leaderboard_observation_type": """
+        SELECT observation_type::text AS scope, username, sum(count) AS score,
+            rank() OVER (PARTITION BY observation_type ORDER BY sum(count) DESC) AS rank
+        FROM user_daily_counts
+        GROUP BY observation_type, username
+    """,
+    "leaderboard_region": f"""
+        SELECT ST_GeoHash(e.geo, {REGION_PRECISION}) AS scope, r.username, sum(r.amount) AS score,
+            rank() OVER (
+                PARTITION BY ST_GeoHash(e.geo, {REGION_PRECISION}) ORDER BY sum(r.amount) DESC
+            ) AS rank
+        FROM rewards r JOIN observation_events e ON e.id = r.observation_event_id
+        WHERE e.geo IS NOT NULL AND r.username IS NOT NULL
+        GROUP BY 1, r.username
+    """,
+}
+
+
+def leaderboard_view(name: str):
+    return table(
+        name,
+        column("scope", String),
+        column("username", String),
+        column("score", Integer),
+        column("rank", Integer),
+    )
+
+
+def create_leaderboards(conn):
+    """Create the leaderboard views that do not exist yet, along with their indexes: a unique index
+    on (scope, username), which serves rank lookups and allows concurrent refreshes, and an index
+    on (scope, rank) for reading the top of a leaderboard."""
+    for name, query in LEADERBOARDS.items():
+        conn.execute(text(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {query}"))
+        conn.execute(
+            text(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_user ON {name} (scope, username)")
+        )
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name}_rank ON {name} (scope, rank)"))
+
+
+def refresh_leaderboards(conn):
+    """Recompute the rankings. The refresh is concurrent, so readers keep seeing the previous
+    rankings until it completes."""
+    for name in LEADERBOARDS:
+        conn.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}"))
+
+
+async def leaderboard_top(name: str, scope: str, limit: int = 10) -> list[dict]:
+    """The highest ranked users in a scope of a leaderboard."""
+    view = leaderboard_view(name)
+    query = (
+        select(view.c.username, view.c.score, view.c.rank)
+        .where(view.c.scope == scope)
+        .order_by(view.c.rank, view.c.username)
+        .limit(limit)
+    )
+    return [dict(row._mapping) for row in await db.fetch_all(query)]
+
+
+async def leaderboard_rank(name: str, scope: str, username: str) -> Optional[dict]:
+    """A user's rank in a scope of a leaderboard, or None if the user is not ranked there."""
+    view = leaderboard_view(name)
+    query = select(view.c.username, view.c.score, view.c.rank).where(
+        view.c.scope == scope, view.c.username == username
+    )
+    row = await db.fetch_one(query)
+    return dict(row._mapping) if row else None
@@ -32,6 +32,31 @@ class Reward(BaseModel):
     amount: int
     created_at: datetime
 
+
+class LedgerEntry(BaseModel):
+    from_username: str
+    to_username: str
+    amount: int
+    txtype: str | None
+    created_at: datetime
+
+
+class LedgerTotals(BaseModel):
+    count: int
+    amount: int
+
+
+class RewardsPage(BaseModel):
+    rewards: list[Reward]
+    next_cursor: str | None
+    totals: LedgerTotals
+
+
+class LedgerPage(BaseModel):
+    entries: list[LedgerEntry]
+    next_cursor: str | None
+    totals: dict[str, LedgerTotals]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -69,3 +94,13 @@ class UserStats(BaseModel):
     counts_90days: Counts
     counts_365days: Counts
     last_observation: str
+    current_streak: int = 0
+    longest_streak: int = 0
+
+
+class Territory(BaseModel):
+    username: str
+    cells: int
+    countries: int
+    timezones: int
+    zipcodes: int
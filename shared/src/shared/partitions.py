@@ -0,0 +1,115 @@
+import re
+from datetime import date
+from sqlalchemy import text
+
+
+def month_start(d: date, offset: int = 0) -> date:
+    """The first day of the month containing d, moved by offset months."""
+    months = d.year * 12 + d.month - 1 + offset
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def create_monthly_partitions(conn, table: str, start: date, months: int) -> list[str]:
+    """Create the monthly range partitions of table for the months starting at start, plus a
+    default partition that catches rows outside every range. Partitions that already exist are left
+    alone. Returns the names of the partitions."""
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+    names = []
+    for i in range(months):
+        lower = month_start(start, i)
+        upper = month_start(start, i + 1)
+        name = partition_name(table, lower)
+        exists = conn.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+        if not exists:
+            create_partition(conn, table, name, lower, upper)
+        names.append(name)
+    return names
+
+
+def partition_key(conn, table: str) -> str:
+    """The column that table is range partitioned on."""
+    definition = conn.scalar(
+        text("SELECT pg_get_partkeydef(:table ::regclass)"), {"table": table}
+    )
+    return re.fullmatch(r"RANGE \((\w+)\)", definition).group(1)
+
+
+def create_partition(conn, table: str, name: str, lower: date, upper: date):
+    """Create the partition of table for the range from lower to upper. Rows in that range that
+    are in the default partition (the partition key of observations is the submission time given
+    by clients, so these can be future dated) would keep the partition from being created, so they
+    are moved into it."""
+    key = partition_key(conn, table)
+    in_range = f"{key} >= '{lower.isoformat()}' AND {key} < '{upper.isoformat()}'"
+    moved = conn.scalar(text(f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {in_range})"))
+    if moved:
+        # keep new rows for the range from landing in the default partition meanwhile
+        conn.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+        conn.execute(
+            text(f"CREATE TEMPORARY TABLE {name}_moved (LIKE {table}_default) ON COMMIT DROP")
+        )
+        conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM {table}_default WHERE {in_range} RETURNING *) "
+                f"INSERT INTO {name}_moved SELECT * FROM moved"
+            )
+        )
+    conn.execute(
+        text(
+            f"CREATE TABLE {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+        )
+    )
+    if moved:
+        # generated columns are computed again on insert
+        columns = ", ".join(
+            conn.execute(
+                text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = :table AND is_generated = 'NEVER' "
+                    "ORDER BY ordinal_position"
+                ),
+                {"table": table},
+            ).scalars()
+        )
+        conn.execute(
+            text(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {name}_moved")
+        )
+        conn.execute(text(f"DROP TABLE {name}_moved"))
+
+
+def monthly_partitions(conn, table: str) -> dict[date, str]:
+    """The monthly partitions currently attached to table, by month."""
+    rows = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table"
+        ),
+        {"table": table},
+    )
+    partitions = {}
+    prefix = f"{table}_"
+    for (name,) in rows:
+        suffix = name[len(prefix) :]
+        if name.startswith(prefix) and len(suffix) == 7 and suffix[:4].isdigit():
+            partitions[date(int(suffix[:4]), int(suffix[5:]), 1)] = name
+    return partitions
+
+
+def detach_partitions_before(conn, table: str, before: date) -> list[str]:
+    """Detach the monthly partitions of table for the months before the one containing before. The
+    detached partitions remain as ordinary tables, to be archived or dropped. Returns their
+    names."""
+    cutoff = month_start(before)
+    names = []
+    for month, name in sorted(monthly_partitions(conn, table).items()):
+        if month < cutoff:
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            names.append(name)
+    return names
@@ -0,0 +1,77 @@
+from typing import Optional
+import os
+import time
+import logging
+from contextvars import ContextVar
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.dialects import postgresql
+
+# statements that take longer than this are logged, with their parameters
+SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_MS", "200")) / 1000
+
+slow_query_log = logging.getLogger("layers.slow_queries")
+
+
+class QueryStats:
+    """The database queries made while handling one request: how many there were, how long they
+    took in total, and which one was the slowest."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.slowest = None
+        self.slowest_seconds = 0.0
+
+    def record(self, query, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest = query
+            self.slowest_seconds = seconds
+        if seconds > SLOW_QUERY_SECONDS:
+            self.slow += 1
+
+    def server_timing(self) -> str:
+        """The stats as the value of a Server-Timing header."""
+        return (
+            f'db;dur={self.seconds * 1000:.1f};desc="{self.count} queries", '
+            f"db-slowest;dur={self.slowest_seconds * 1000:.1f}"
+        )
+
+
+_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+def start_request() -> QueryStats:
+    """Start collecting the stats of the queries made in the current context (a request)."""
+    stats = QueryStats()
+    _stats.set(stats)
+    return stats
+
+
+def statement_text(query, values: Optional[dict] = None) -> tuple[str, dict]:
+    """The SQL and parameters of a query, as sent to Postgres."""
+    if isinstance(query, ClauseElement):
+        compiled = query.compile(dialect=postgresql.dialect())
+        if isinstance(values, dict):
+            # the values given for the bindparams of a precompiled statement
+            return str(compiled), {**compiled.params, **values}
+        return str(compiled), compiled.params
+    return str(query), values or {}
+
+
+async def timed(query, values, awaitable):
+    """Await the execution of a query, adding it to the current request's stats and logging it if
+    it is slow."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        seconds = time.perf_counter() - start
+        stats = _stats.get()
+        if stats is not None:
+            stats.record(query, seconds)
+        if seconds > SLOW_QUERY_SECONDS:
+            sql, params = statement_text(query, values)
+            slow_query_log.warning("%.1fms: %s %r", seconds * 1000, sql, params)
@@ -2,7 +2,7 @@ import json
 from typing import Optional, Literal, Any
 from enum import Enum
 from datetime import datetime
-from pydantic import BaseModel, Extra
+from pydantic import BaseModel, Extra, validator
 from geojson_pydantic import FeatureCollection, Feature, Point
 
 # Observations
@@ -40,7 +40,45 @@ class AddressLocation(BaseModel):
 
 
 Location = LatLongLocation | GeohashLocation | PlusCodeLocation
-Shape = FeatureCollection
+
+
+def check_positions(coordinates) -> None:
+    """Raise ValueError if a position in the coordinates of a GeoJSON geometry is not a longitude
+    within [-180, 180] and a latitude within [-90, 90]."""
+    if coordinates and isinstance(coordinates[0], (list, tuple)):
+        for c in coordinates:
+            check_positions(c)
+    elif coordinates and not (-180 <= coordinates[0] <= 180 and -90 <= coordinates[1] <= 90):
+        raise ValueError(f"position {list(coordinates)} is out of range")
+
+
+def check_closed_rings(coordinates) -> None:
+    """Raise ValueError if a ring of the coordinates of a Polygon does not end where it starts (as
+    geojson_pydantic's Polygon does)."""
+    if any(ring[-1] != ring[0] for ring in coordinates):
+        raise ValueError("All linear rings have the same start and end coordinates")
+
+
+def check_geometry(geometry: dict) -> None:
+    """Raise ValueError if a GeoJSON geometry (or geometry collection) has a position out of
+    range."""
+    if "geometries" in geometry:
+        for g in geometry["geometries"]:
+            check_geometry(g)
+    else:
+        check_positions(geometry["coordinates"])
+
+
+class Shape(FeatureCollection):
+    """A GeoJSON FeatureCollection in longitude and latitude."""
+
+    @validator("features")
+    def check_features(cls, features: list) -> list:
+        for feature in features:
+            if feature.geometry is not None:
+                check_geometry(feature.geometry.dict())
+        return features
+
 
 class PayloadRef(BaseModel):
     ref: str | int
@@ -66,7 +104,7 @@ class Observation(BaseModel, extra=Extra.forbid):
     """The abstract base model for an observation, which may optionally contain a payload reference"""
 
     payload_ref: Optional[str | int]
-    shape: Optional[FeatureCollection]
+    shape: Optional[Shape]
     props: Optional[dict[str, str]]
 
 
@@ -581,6 +619,7 @@ class ResourceObservation(Observation):
 
     observation_type: Literal["resource"]
     description: str
+    resource_type: Optional[ResourceType]
     resource_id: ResourceId
     amount: Amount
 
@@ -635,7 +674,8 @@ class ExtentObservation(Observation):
 
 
 class ConnectionObservation(Observation):
-    """An observation of a connection between two assets"""
+    """An observation of a connection between two assets, optionally referring to the payloads of
+    the observations of the upstream and downstream assets"""
 
     class ConnectionType(str, Enum):
         CONDUCTOR = "conductor"
@@ -676,6 +716,8 @@ class ConnectionObservation(Observation):
     observation_type: Literal["connection"]
     connection_type: ConnectionType
     connection_function: ConnectionFunction
+    upstream: Optional[PayloadRef]
+    downstream: Optional[PayloadRef]
 
 
 class SourceType(str, Enum):
@@ -693,6 +735,7 @@ SomeObservation = (
     | FacilityObservation
     | ResourceObservation
     | ExtentObservation
+    | ConnectionObservation
 )
 
 
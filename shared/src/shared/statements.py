@@ -0,0 +1,121 @@
+from typing import Optional, TYPE_CHECKING
+from functools import lru_cache
+from sqlalchemy.exc import InvalidRequestError
+
+# asyncpg and databases are imported when a statement is first run, so that importing the
+# statements defined in shared.db does not load them
+if TYPE_CHECKING:
+    import asyncpg
+    from databases.backends.postgres import Record
+
+
+@lru_cache(maxsize=1)
+def dialect():
+    """The dialect that databases compiles statements with, so that prepared statements bind and
+    return values exactly as the same statements run through databases would."""
+    from databases.backends.postgres import PostgresBackend
+
+    return PostgresBackend("postgresql://")._dialect
+
+
+def reset_errors() -> tuple:
+    """The errors after which a statement that is not in a transaction is run again through
+    databases: the connection was reset, or the plan that the connection prepared for the statement
+    went stale after a schema change."""
+    import asyncpg
+
+    return (
+        asyncpg.ConnectionDoesNotExistError,
+        asyncpg.InterfaceError,
+        asyncpg.InvalidCachedStatementError,
+    )
+
+
+class Statement:
+    """A parameterized statement that is compiled to SQL once, when it is first run, rather than
+    every time it is run. Values are given for its bindparams by name. asyncpg prepares the SQL
+    once per connection and caches it, so later executions only send the parameters.
+
+    Pass a Statement to the query methods of shared.db's databases in place of a SQLAlchemy
+    statement."""
+
+    def __init__(self, query):
+        self.query = query
+        self.sql: Optional[str] = None
+
+    def _compile(self):
+        from databases.backends.postgres import PostgresConnection, Record
+
+        compiled = self.query.compile(dialect=dialect())
+        self.names = sorted(compiled.params)
+        self.defaults = compiled.params
+        # bindparams without a value, which every execution has to give one for
+        self.required = {name for name, bind in compiled.binds.items() if bind.required}
+        self._processors = {
+            name: bind.type.dialect_impl(compiled.dialect).bind_processor(compiled.dialect)
+            for name, bind in compiled.binds.items()
+        }
+        # rows are returned as databases returns them, which takes the private result columns of
+        # the compiled statement; SQLAlchemy and databases are pinned in api/requirements.txt, and
+        # tests/test_statements.py fails when an upgrade drops what this uses
+        self._result_columns = compiled._result_columns
+        self._column_maps = PostgresConnection._create_column_maps(self._result_columns)
+        self._record_class = Record
+        self.sql = compiled.string % {name: f"${i}" for i, name in enumerate(self.names, 1)}
+
+    def arguments(self, values: Optional[dict]) -> list:
+        if self.sql is None:
+            self._compile()
+        values = values or {}
+        args = []
+        for name in self.names:
+            if name in values:
+                value = values[name]
+            elif name in self.required:
+                raise InvalidRequestError(f"A value is required for bind parameter {name!r}")
+            else:
+                value = self.defaults[name]
+            processor = self._processors.get(name)
+            args.append(processor(value) if processor else value)
+        return args
+
+    def _record(self, row: "asyncpg.Record") -> "Record":
+        return self._record_class(row, self._result_columns, dialect(), self._column_maps)
+
+    async def run(self, database, method: str, values: Optional[dict] = None, column=0):
+        """Run the statement on a databases.Database with one of its query methods (execute,
+        execute_many, fetch_all, fetch_one or fetch_val), returning what that method would."""
+        if self.sql is None:
+            self._compile()
+        in_transaction = False
+        try:
+            async with database.connection() as connection:
+                raw = connection.raw_connection
+                in_transaction = raw.is_in_transaction()
+                if method == "execute_many":
+                    return await raw.executemany(self.sql, [self.arguments(v) for v in values])
+                args = self.arguments(values)
+                if method == "execute":
+                    return await raw.fetchval(self.sql, *args)
+                if method == "fetch_all":
+                    return [self._record(row) for row in await raw.fetch(self.sql, *args)]
+                row = await raw.fetchrow(self.sql, *args)
+                if row is None:
+                    return None
+                if method == "fetch_val":
+                    return self._record(row)[column]
+                return self._record(row)
+        except reset_errors():
+            # the error has aborted the transaction, so running the statement again would only fail
+            # in it; the transaction is for its owner to retry. Outside of one, the statement is
+            # run again through databases, on a fresh connection from the pool if this one closed.
+            if in_transaction:
+                raise
+            if method == "execute_many":
+                for v in values:
+                    await database.execute(self.query.params(v))
+                return None
+            query = self.query.params(values or {})
+            if method == "fetch_val":
+                return await database.fetch_val(query, column=column)
+            return await getattr(database, method)(query)
@@ -0,0 +1,111 @@
+from typing import Iterable, Optional
+import re
+from functools import lru_cache
+
+# the enum values in shared.schemas are paths of segments, most general first, e.g.
+# provision:mineral:metallic:ferrous
+SEPARATOR = ":"
+# the numeric code that some values carry on their last segment, e.g. cereal:wheat[11]
+CODE_SUFFIX = re.compile(r"\[\d+\]$")
+
+
+def segments(value: str) -> list[str]:
+    return [CODE_SUFFIX.sub("", label) for label in value.split(SEPARATOR)]
+
+
+class TaxonNode:
+    __slots__ = ("label", "children", "id", "last")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.children: dict[str, "TaxonNode"] = {}
+        self.id = 0
+        # the highest id in the node's subtree
+        self.last = 0
+
+
+class Taxonomy:
+    """A prefix trie over a set of hierarchical values, with an integer id for each node. Ids are
+    assigned in depth first order, visiting children in order of their labels, so the ids of the
+    values under any node (a nested set) form a contiguous range, as do those of the values under
+    a run of siblings whose labels share a prefix. A prefix filter on the values is therefore a
+    range query on their ids.
+
+    Ids depend on the whole set of values, so ids that are stored must be renumbered when the set
+    changes."""
+
+    def __init__(self, values: Iterable[str]):
+        self.root = TaxonNode("")
+        nodes = {}
+        for value in values:
+            node = self.root
+            for label in segments(value):
+                node = node.children.setdefault(label, TaxonNode(label))
+            nodes[value] = node
+        self._number(self.root, 0)
+        self.ids: dict[str, int] = {value: node.id for value, node in nodes.items()}
+
+    def _number(self, node: TaxonNode, next_id: int) -> int:
+        node.id = next_id
+        next_id += 1
+        for label in sorted(node.children):
+            next_id = self._number(node.children[label], next_id)
+        node.last = next_id - 1
+        return next_id
+
+    def __len__(self) -> int:
+        return self.root.last
+
+    def taxon(self, value: str) -> Optional[int]:
+        """The id of a value, or None if it is not in the taxonomy."""
+        return self.ids.get(value)
+
+    def prefix_range(self, prefix: str) -> Optional[tuple[int, int]]:
+        """The first and last ids of the values (and inner nodes) whose paths start with prefix, or
+        None if there are none. The last segment of the prefix may be partial: container:ta
+        matches container:tank:metal, and container: matches everything under container."""
+        *parents, partial = prefix.split(SEPARATOR)
+        node = self.root
+        for label in parents:
+            node = node.children.get(CODE_SUFFIX.sub("", label))
+            if node is None:
+                return None
+        matches = [
+            node.children[label] for label in sorted(node.children) if label.startswith(partial)
+        ]
+        if not matches:
+            return None
+        return matches[0].id, matches[-1].last
+
+
+def attribute_values() -> dict[str, list[str]]:
+    """The values of the hierarchical payload attributes, from their enums in shared.schemas."""
+    from .schemas import (
+        AssetObservation,
+        FacilityObservation,
+        ResourceObservation,
+        ConnectionObservation,
+    )
+
+    enums = {
+        "asset_type": [
+            AssetObservation.VehicleType,
+            AssetObservation.ContainerType,
+            AssetObservation.TowerType,
+            AssetObservation.EquipmentType,
+        ],
+        "configuration": [AssetObservation.AssetConfiguration],
+        "resource_type": [ResourceObservation.ResourceType],
+        "connection_type": [ConnectionObservation.ConnectionType],
+        "facility_functions": [FacilityObservation.FacilityFunction],
+        "facility_processes": [FacilityObservation.FacilityProcess],
+    }
+    values = {name: [m.value for enum in group for m in enum] for name, group in enums.items()}
+    values["asset_type"].append("asset:generic")
+    return values
+
+
+@lru_cache(maxsize=1)
+def get_taxonomies() -> dict[str, Taxonomy]:
+    """The taxonomy of each hierarchical payload attribute, built once per process."""
+    return {name: Taxonomy(values) for name, values in attribute_values().items()}
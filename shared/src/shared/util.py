@@ -1,8 +1,13 @@
 import urllib.parse
 import re
+import base64
+from datetime import date, datetime
+from typing import TYPE_CHECKING
 import basket_case as bc
-import geojson_pydantic as gp
-from .schemas import ObservationEvent
+
+# the schemas are only needed for annotations here, and are slow to import
+if TYPE_CHECKING:
+    from .schemas import ObservationEvent
 
 import math
 
@@ -134,6 +139,8 @@ def format_as_native(result):
 
 
 def format_as_geojson(result):
+    import geojson_pydantic as gp
+
     # extract geojson features from each row in the result, and add them to a FeatureCollection
     features = []
     for row in result:
@@ -151,9 +158,14 @@ def canonicalize_identifier(orig: str) -> str:
     return orig.lower().replace(" ", "_").strip()
 
 
-def compute_reward(observation_event: ObservationEvent) -> int:
+def compute_reward(observation_event: "ObservationEvent") -> int:
     """Compute the reward for an observation."""
-    return observation_event.num_observations() * 10
+    return observation_reward(observation_event.num_observations())
+
+
+def observation_reward(num_observations: int) -> int:
+    """Compute the reward for an observation event with a number of observations."""
+    return num_observations * 10
 
 
 LEVELS = [
@@ -186,3 +198,78 @@ def level_for_xp(xp: int) -> int:
         if xp < level_xp:
             return i
     return len(LEVELS)
+
+
+# ISO 6346 letter values: counting up from A=10, skipping multiples of 11
+BIC_LETTER_VALUES = {}
+_value = 10
+for _letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+    if _value % 11 == 0:
+        _value += 1
+    BIC_LETTER_VALUES[_letter] = _value
+    _value += 1
+
+
+def bic_check_digit(code: str) -> int | None:
+    """Compute the ISO 6346 check digit for a container code (BIC) from its owner code, category
+    identifier and serial number, ignoring any separators. Returns None if the code is malformed."""
+    code = re.sub(r"[^0-9A-Za-z]", "", code).upper()
+    if len(code) < 10 or not code[:4].isalpha() or not code[4:10].isdigit():
+        return None
+    total = 0
+    for i, ch in enumerate(code[:10]):
+        value = int(ch) if ch.isdigit() else BIC_LETTER_VALUES[ch]
+        total += value * 2**i
+    return total % 11 % 10
+
+
+def is_valid_bic(code: str) -> bool:
+    """Check whether a container code (BIC) is well-formed and has the correct check digit."""
+    compact = re.sub(r"[^0-9A-Za-z]", "", code).upper()
+    if len(compact) != 11 or compact[3] not in "UJZ" or not compact[10].isdigit():
+        return False
+    return bic_check_digit(compact) == int(compact[10])
+
+
+def activity_set_day(days: bytes, start: date, day: date) -> tuple[bytes, date]:
+    """Set the bit for day in an activity bitmap, where bit i (little-endian) stands for the day i
+    days after start. The bitmap grows as needed, and its start moves back if day is before it.
+    Returns the new bitmap and start."""
+    bits = int.from_bytes(days, "little")
+    if day < start:
+        bits <<= (start - day).days
+        start = day
+    bits |= 1 << (day - start).days
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little"), start
+
+
+def activity_streaks(days: bytes, start: date, last_day: date) -> tuple[int, int]:
+    """The (current, longest) streaks of consecutive active days in an activity bitmap, where the
+    current streak is the one ending on last_day."""
+    bits = int.from_bytes(days, "little")
+    end = (last_day - start).days
+    window = (1 << (end + 1)) - 1
+    gaps = ~bits & window
+    current = end + 1 - gaps.bit_length()
+
+    # each step shortens every run of ones by one, so the number of steps is the longest run
+    longest = 0
+    while bits:
+        bits &= bits >> 1
+        longest += 1
+    return current, longest
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    """An opaque pagination cursor for the position after the item with (created_at, id)."""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """The (created_at, id) position of a pagination cursor. Raises ValueError if the cursor is
+    malformed."""
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(id)
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
@@ -0,0 +1,413 @@
+from typing import Any, Callable, Optional
+from datetime import datetime
+from functools import lru_cache
+
+# keywords that do not constrain documents
+ANNOTATIONS = {"title", "description", "default", "examples", "definitions"}
+SUPPORTED = ANNOTATIONS | {
+    "$ref",
+    "type",
+    "enum",
+    "const",
+    "format",
+    "properties",
+    "required",
+    "additionalProperties",
+    "items",
+    "minItems",
+    "maxItems",
+    "anyOf",
+}
+
+TYPE_CHECKS = {
+    "object": "type({v}) is dict",
+    "array": "type({v}) is list",
+    "string": "type({v}) is str",
+    # JSON does not distinguish 1 from 1.0, but Python does; True is an int to Python only
+    "integer": "(type({v}) is int or (type({v}) is float and {v}.is_integer()))",
+    "number": "type({v}) in (int, float)",
+    "boolean": "type({v}) is bool",
+    "null": "{v} is None",
+}
+
+
+def is_date_time(value: str) -> bool:
+    try:
+        datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    return True
+
+
+# the format checks used by default
+FORMATS = {"date-time": is_date_time}
+
+# the definitions of the GeoJSON geometry models (of geojson_pydantic) in the observation schema
+GEOMETRY_DEFINITIONS = [
+    "Point",
+    "MultiPoint",
+    "LineString",
+    "MultiLineString",
+    "Polygon",
+    "MultiPolygon",
+]
+
+
+class SchemaError(ValueError):
+    """A document that does not conform to a schema, with the JSON pointer to the offending part."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+        self.path: list = []
+
+    def within(self, key) -> "SchemaError":
+        self.path.insert(0, key)
+        return self
+
+    def __str__(self) -> str:
+        return f"/{'/'.join(str(key) for key in self.path)}: {self.message}"
+
+
+class Compiler:
+    """Generates the Python source of a validator for a JSON schema: one function per definition
+    and per alternative of an anyOf, with the checks of every other subschema inlined. Checks on
+    the happy path are plain comparisons and membership tests; the location of a failure is only
+    worked out when there is one.
+
+    Covers the subset of JSON Schema that pydantic generates. An anyOf over objects that each fix a
+    different value of a common property, such as observation_type, dispatches on that value
+    rather than trying each alternative in turn. What the validators of pydantic models check
+    beyond their schema is left to definition_checks: functions, by definition name, that are
+    called with a value once it conforms to that definition and raise ValueError if it does not
+    pass."""
+
+    def __init__(
+        self,
+        schema: dict,
+        formats: dict[str, Callable[[str], bool]] = FORMATS,
+        definition_checks: Optional[dict[str, Callable[[Any], None]]] = None,
+    ):
+        self.schema = schema
+        self.formats = formats
+        self.definition_checks = definition_checks or {}
+        self.definitions = schema.get("definitions", {})
+        self.functions: list[list[str]] = []
+        self.refs: dict[str, str] = {}
+        self.constants: dict[str, Any] = {}
+        self.dispatches: list[str] = []
+        self.variables = 0
+
+    def compile(self) -> str:
+        self.function(self.schema, "validate")
+        return "\n\n".join("\n".join(lines) for lines in self.functions) + "\n"
+
+    def constant(self, value) -> str:
+        name = f"C{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    def variable(self) -> str:
+        self.variables += 1
+        return f"v{self.variables}"
+
+    def resolve(self, node: dict) -> dict:
+        while "$ref" in node:
+            node = self.definitions[node["$ref"].split("/")[-1]]
+        return node
+
+    def function(
+        self, node: dict, name: Optional[str] = None, definition: Optional[str] = None
+    ) -> str:
+        """The name of a function that validates its argument against node (the definition of that
+        name, if given)."""
+        if "$ref" in node:
+            ref = node["$ref"]
+            if ref not in self.refs:
+                definition = ref.split("/")[-1]
+                self.refs[ref] = f"ref_{len(self.refs)}_{definition}"
+                self.function(self.resolve(node), self.refs[ref], definition)
+            return self.refs[ref]
+        name = name or f"alt_{len(self.functions)}"
+        lines = [f"def {name}(v0):"]
+        self.functions.append(lines)
+        body = self.checks(node, "v0", 1)
+        if definition in self.definition_checks:
+            check = self.constant(self.definition_checks[definition])
+            body += [
+                "    try:",
+                f"        {check}(v0)",
+                "    except ValueError as e:",
+                "        raise SchemaError(str(e))",
+            ]
+        lines.extend(body or ["    pass"])
+        return name
+
+    def checks(self, node: dict, v: str, depth: int) -> list[str]:
+        """Statements that raise SchemaError unless the value in variable v conforms to node."""
+        pad = "    " * depth
+        if "$ref" in node:
+            return [f"{pad}{self.function(node)}({v})"]
+        unsupported = set(node) - SUPPORTED
+        if unsupported:
+            raise NotImplementedError(f"Unsupported schema keywords: {sorted(unsupported)}")
+
+        out = []
+        types = node.get("type")
+        if types is not None:
+            types = [types] if isinstance(types, str) else types
+            test = " or ".join(TYPE_CHECKS[t].format(v=v) for t in types)
+            out += [
+                f"{pad}if not ({test}):",
+                f"{pad}    raise SchemaError(repr({v}) + {' is not of type ' + '/'.join(types)!r})",
+            ]
+        if "enum" in node:
+            values = node["enum"]
+            if all(isinstance(value, str) for value in values):
+                test = f"type({v}) is str and {v} in {self.constant(frozenset(values))}"
+            else:
+                test = f"{v} in {self.constant(tuple(values))}"
+            out += [
+                f"{pad}if not ({test}):",
+                f"{pad}    raise SchemaError(repr({v}) + ' is not one of the allowed values')",
+            ]
+        if "const" in node:
+            message = f" is not {node['const']!r}"
+            out += [
+                f"{pad}if {v} != {self.constant(node['const'])}:",
+                f"{pad}    raise SchemaError(repr({v}) + {message!r})",
+            ]
+        if "format" in node and node["format"] in self.formats:
+            check = self.constant(self.formats[node["format"]])
+            out += [
+                f"{pad}if type({v}) is str and not {check}({v}):",
+                f"{pad}    raise SchemaError(repr({v}) + {' is not a ' + node['format']!r})",
+            ]
+        if "anyOf" in node:
+            out += self.any_of(node["anyOf"], v, depth)
+        # the checks that only apply to objects (or arrays) need no type test if the type is fixed
+        if {"properties", "required", "additionalProperties"} & set(node):
+            out += self.object_checks(node, v, depth, types == ["object"])
+        if {"items", "minItems", "maxItems"} & set(node):
+            out += self.array_checks(node, v, depth, types == ["array"])
+        return out
+
+    def object_checks(self, node: dict, v: str, depth: int, typed: bool) -> list[str]:
+        out = [] if typed else [f"{'    ' * depth}if type({v}) is dict:"]
+        depth += 0 if typed else 1
+        pad = "    " * depth
+        properties = node.get("properties", {})
+        if node.get("required"):
+            required = self.constant(frozenset(node["required"]))
+            out += [
+                f"{pad}if not {required}.issubset({v}):",
+                f"{pad}    missing = sorted({required} - set({v}))",
+                f"{pad}    raise SchemaError(f'missing required properties {{missing}}')",
+            ]
+        additional = node.get("additionalProperties", True)
+        if additional is False:
+            names = self.constant(frozenset(properties))
+            out += [
+                f"{pad}if not {names}.issuperset({v}):",
+                f"{pad}    extra = sorted(set({v}) - {names})",
+                f"{pad}    raise SchemaError(f'unexpected properties {{extra}}')",
+            ]
+        elif additional is not True:
+            names = self.constant(frozenset(properties))
+            key, item = self.variable(), self.variable()
+            out += [
+                f"{pad}for {key}, {item} in {v}.items():",
+                f"{pad}    if {key} in {names}:",
+                f"{pad}        continue",
+            ]
+            out += self.guarded(item, key, depth + 1, self.checks(additional, item, depth + 2))
+        for key, subschema in properties.items():
+            body_var = self.variable()
+            body = self.checks(subschema, body_var, depth + 2)
+            if not body:
+                continue
+            out += [f"{pad}if {key!r} in {v}:", f"{pad}    {body_var} = {v}[{key!r}]"]
+            out += self.guarded(body_var, repr(key), depth + 1, body)
+        return out if len(out) > (0 if typed else 1) else []
+
+    def array_checks(self, node: dict, v: str, depth: int, typed: bool) -> list[str]:
+        out = [] if typed else [f"{'    ' * depth}if type({v}) is list:"]
+        depth += 0 if typed else 1
+        pad = "    " * depth
+        if "minItems" in node:
+            out += [
+                f"{pad}if len({v}) < {node['minItems']}:",
+                f"{pad}    raise SchemaError('fewer than {node['minItems']} items')",
+            ]
+        if "maxItems" in node:
+            out += [
+                f"{pad}if len({v}) > {node['maxItems']}:",
+                f"{pad}    raise SchemaError('more than {node['maxItems']} items')",
+            ]
+        items = node.get("items")
+        if isinstance(items, list):
+            for i, subschema in enumerate(items):
+                item = self.variable()
+                body = self.checks(subschema, item, depth + 2)
+                if body:
+                    out += [f"{pad}if len({v}) > {i}:", f"{pad}    {item} = {v}[{i}]"]
+                    out += self.guarded(item, str(i), depth + 1, body)
+        elif items is not None:
+            item, index = self.variable(), self.variable()
+            body = self.checks(items, item, depth + 2)
+            if body:
+                out += [f"{pad}for {index}, {item} in enumerate({v}):"]
+                out += self.guarded(item, index, depth + 1, body)
+        return out if len(out) > (0 if typed else 1) else []
+
+    def guarded(self, v: str, key: str, depth: int, body: list[str]) -> list[str]:
+        """The checks in body on v, adding key to the path of the errors they raise."""
+        pad = "    " * depth
+        return [
+            f"{pad}try:",
+            *body,
+            f"{pad}except SchemaError as e:",
+            f"{pad}    raise e.within({key})",
+        ]
+
+    def discriminator(self, alternatives: list[dict]) -> Optional[str]:
+        """A property that every alternative is an object fixing to a different single value."""
+        objects = [self.resolve(a) for a in alternatives]
+        if len(objects) < 2 or any("properties" not in o for o in objects):
+            return None
+        for key in objects[0]["properties"]:
+            values = []
+            for o in objects:
+                prop = self.resolve(o["properties"].get(key, {}))
+                if "const" in prop:
+                    values.append(prop["const"])
+                elif len(prop.get("enum", [])) == 1:
+                    values.append(prop["enum"][0])
+                else:
+                    break
+            else:
+                if all(isinstance(x, str) for x in values) and len(set(values)) == len(values):
+                    return key
+        return None
+
+    def any_of(self, alternatives: list[dict], v: str, depth: int) -> list[str]:
+        """Alternatives of different types are told apart by the type of the value, so that a
+        value is only checked against the alternatives of its type; if there is only one, its
+        error is the one reported."""
+        types = [self.resolve(a).get("type") for a in alternatives]
+        distinct = list(dict.fromkeys(types))
+        if (
+            len(distinct) < 2
+            or not all(isinstance(t, str) for t in types)
+            or {"integer", "number"} <= set(types)
+        ):
+            return self.alternatives(alternatives, v, depth)
+        pad = "    " * depth
+        out = []
+        for i, t in enumerate(distinct):
+            out.append(f"{pad}{'elif' if i else 'if'} {TYPE_CHECKS[t].format(v=v)}:")
+            group = [a for a, a_type in zip(alternatives, types) if a_type == t]
+            out += self.alternatives(group, v, depth + 1)
+        message = f" is not of type {'/'.join(distinct)}"
+        return out + [f"{pad}else:", f"{pad}    raise SchemaError(repr({v}) + {message!r})"]
+
+    def alternatives(self, alternatives: list[dict], v: str, depth: int) -> list[str]:
+        pad = "    " * depth
+        if len(alternatives) == 1:
+            return [f"{pad}{self.function(alternatives[0])}({v})"]
+        out = []
+        objects = [a for a in alternatives if self.resolve(a).get("type") == "object"]
+        key = self.discriminator(objects)
+        if key is not None:
+            table = {}
+            for a in objects:
+                prop = self.resolve(self.resolve(a)["properties"][key])
+                table[prop["const"] if "const" in prop else prop["enum"][0]] = self.function(a)
+            # the table maps to function names here, and to the functions once they are defined
+            dispatch = self.constant(table)
+            self.dispatches.append(dispatch)
+            message = f" is not one of {', '.join(table)}"
+            out += [
+                f"{pad}if type({v}) is dict and type({v}.get({key!r})) is str:",
+                f"{pad}    check = {dispatch}.get({v}[{key!r}])",
+                f"{pad}    if check is None:",
+                f"{pad}        raise SchemaError(repr({v}[{key!r}]) + {message!r}).within({key!r})",
+                f"{pad}    check({v})",
+                f"{pad}else:",
+            ]
+            pad += "    "
+        functions = [self.function(a) for a in alternatives]
+        out += [
+            f"{pad}for check in ({', '.join(functions)},):",
+            f"{pad}    try:",
+            f"{pad}        check({v})",
+            f"{pad}        break",
+            f"{pad}    except SchemaError:",
+            f"{pad}        pass",
+            f"{pad}else:",
+            f"{pad}    raise SchemaError('does not match any of the allowed schemas')",
+        ]
+        return out
+
+
+class Validator:
+    """A validator compiled from a JSON schema (see Compiler). Calling it with a parsed JSON
+    document raises SchemaError if the document does not conform to the schema. Formats are
+    checked by the functions in formats, by format name; other formats are not checked."""
+
+    def __init__(
+        self,
+        schema: dict,
+        formats: dict[str, Callable[[str], bool]] = FORMATS,
+        definition_checks: Optional[dict[str, Callable[[Any], None]]] = None,
+    ):
+        compiler = Compiler(schema, formats, definition_checks)
+        self.source = compiler.compile()
+        namespace = {"SchemaError": SchemaError, **compiler.constants}
+        exec(compile(self.source, "<validator>", "exec"), namespace)
+        for name in compiler.dispatches:
+            namespace[name] = {value: namespace[f] for value, f in namespace[name].items()}
+        self.validate: Callable[[Any], None] = namespace["validate"]
+
+    def __call__(self, document):
+        self.validate(document)
+
+    def is_valid(self, document) -> bool:
+        try:
+            self.validate(document)
+        except SchemaError:
+            return False
+        return True
+
+
+def parses(parse: Callable[[str], Any]) -> Callable[[str], bool]:
+    """A format check that passes the strings that parse accepts."""
+
+    def check(value: str) -> bool:
+        try:
+            parse(value)
+        except (ValueError, TypeError, OverflowError):
+            return False
+        return True
+
+    return check
+
+
+@lru_cache(maxsize=1)
+def get_observation_validator() -> Validator:
+    """The validator for ObservationEvent documents, compiled once per process. Date-times are
+    checked by the parser of the pydantic models, and geometries by the checks of their models, so
+    that they are valid only when the models would accept them."""
+    from pydantic.datetime_parse import parse_datetime
+    from .schemas import ObservationEvent, check_closed_rings, check_geometry
+
+    def check_polygon(polygon: dict):
+        check_closed_rings(polygon["coordinates"])
+        check_geometry(polygon)
+
+    geometry_checks = {name: check_geometry for name in GEOMETRY_DEFINITIONS}
+    return Validator(
+        ObservationEvent.schema(),
+        {"date-time": parses(parse_datetime)},
+        {**geometry_checks, "Polygon": check_polygon},
+    )
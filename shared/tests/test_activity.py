@@ -0,0 +1,15 @@
+from datetime import datetime, timedelta, timezone
+from shared.db import ACTIVITY_MAX_AGE, ACTIVITY_MAX_AHEAD, activity_time
+
+NOW = datetime(2024, 3, 1, 12, tzinfo=timezone.utc)
+
+
+def test_activity_time_within_window():
+    observed_at = NOW - timedelta(days=3)
+    assert activity_time(observed_at, NOW) == observed_at
+    assert activity_time(observed_at.replace(tzinfo=None), NOW) == observed_at
+
+
+def test_activity_time_clamped():
+    assert activity_time(NOW + timedelta(days=400), NOW) == NOW + ACTIVITY_MAX_AHEAD
+    assert activity_time(datetime(1970, 1, 1, tzinfo=timezone.utc), NOW) == NOW - ACTIVITY_MAX_AGE
@@ -0,0 +1,25 @@
+from shared import encoding
+from shared.schemas import ObservationEvent, Entity
+
+
+def test_field_names_cover_models():
+    # a new field of the models should be appended to FIELD_NAMES, which keeps the other keys
+    names = set()
+    for model in (ObservationEvent, Entity):
+        schema = model.schema()
+        for definition in [schema, *schema.get("definitions", {}).values()]:
+            names.update(definition.get("properties", {}))
+    assert names <= set(encoding.FIELD_NAMES), names - set(encoding.FIELD_NAMES)
+    assert len(set(encoding.FIELD_NAMES)) == len(encoding.FIELD_NAMES)
+
+
+def test_field_keys_are_stable():
+    keys = encoding.field_keys()
+    assert keys["agriculture_type"] == 0
+    assert keys["observed_at"] == 32
+    assert keys["vessel"] == 53
+
+
+def test_round_trip_with_unknown_field():
+    event = {"observed_at": "2024-01-01T00:00:00Z", "not_a_field": 1, "props": {"type": "x"}}
+    assert encoding.loads(encoding.dumps(event)) == event
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+# import times are measured this many times, and the fastest is compared to the budget, so that a
+# busy machine does not fail the test
+RUNS = 3
+
+
+def import_profile(module: str, path: Path) -> tuple[float, set[str]]:
+    """The time in seconds that importing module takes in a fresh interpreter (excluding the
+    interpreter's own startup), and the modules that are loaded after it."""
+    env = {**os.environ, "PYTHONPATH": str(ROOT / "shared" / "src"), "DB_CREDS": ""}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys, {module}; print(*sys.modules)"],
+        cwd=path,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines are "import time: self [us] | cumulative | imported package", indented by depth
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].rstrip() == f" {module}":
+            return int(fields[1]) / 1e6, set(result.stdout.split())
+    raise AssertionError(f"no import time for {module}")
+
+
+def check_import(module: str, path: Path, budget: float, deferred: list[str]):
+    profiles = [import_profile(module, path) for _ in range(RUNS)]
+    seconds = min(seconds for seconds, _ in profiles)
+    assert seconds < budget, f"importing {module} took {seconds:.2f}s"
+    loaded = profiles[0][1]
+    assert not loaded.intersection(deferred), f"{module} loaded {loaded.intersection(deferred)}"
+
+
+def test_util_import():
+    check_import(
+        "shared.util",
+        ROOT,
+        budget=0.1,
+        deferred=["shared.schemas", "shared.db", "pydantic", "sqlalchemy", "numpy", "shapely"],
+    )
+
+
+def test_db_import():
+    # without a database: the engine and databases are created when first used
+    check_import(
+        "shared.db",
+        ROOT,
+        budget=0.8,
+        deferred=["databases", "asyncpg", "psycopg2", "shared.schemas"],
+    )
+
+
+def test_platon_import():
+    check_import(
+        "process",
+        ROOT / "platon",
+        budget=0.8,
+        deferred=["databases", "asyncpg", "psycopg2", "multiprocessing", "geojson_pydantic"],
+    )
@@ -0,0 +1,114 @@
+import asyncio
+from shared.db import ReadRouter, REPLICA_LAG_QUERY, pool_stats
+
+
+class StubDatabase:
+    """Stands in for a LazyDatabase: answers every query with its name, and the replication lag
+    query with lag; fails to connect, or to run queries, when told to."""
+
+    def __init__(self, name: str, lag: float = 0.0):
+        self.name = name
+        self.lag = lag
+        self.down = False
+        self.connects = 0
+        self.queries = []
+
+    def __bool__(self) -> bool:
+        return True
+
+    async def connect(self):
+        self.connects += 1
+        if self.down:
+            raise ConnectionRefusedError(f"{self.name} is down")
+
+    async def disconnect(self):
+        pass
+
+    async def fetch_val(self, query, values=None, column=0):
+        if self.down:
+            raise ConnectionResetError(f"{self.name} is down")
+        if query == REPLICA_LAG_QUERY:
+            return self.lag
+        self.queries.append(query)
+        return self.name
+
+    async def fetch_all(self, query, values=None):
+        return [await self.fetch_val(query, values)]
+
+
+def router(replica_lag: float = 0.0) -> tuple[ReadRouter, StubDatabase, StubDatabase]:
+    primary = StubDatabase("primary")
+    replica = StubDatabase("replica", replica_lag)
+    # check the lag on every query
+    return ReadRouter(primary, replica, max_lag=5, check_interval=-1), primary, replica
+
+
+def test_reads_go_to_replica_within_max_lag():
+    read_db, _, _ = router(replica_lag=1)
+    assert asyncio.run(read_db.fetch_val("q")) == "replica"
+    assert read_db.routed == {"primary": 0, "replica": 1}
+
+
+def test_reads_fall_back_to_primary_when_replica_lags():
+    read_db, _, replica = router(replica_lag=10)
+
+    async def reads():
+        lagging = await read_db.fetch_val("q")
+        replica.lag = 0
+        caught_up = await read_db.fetch_val("q")
+        return lagging, caught_up
+
+    assert asyncio.run(reads()) == ("primary", "replica")
+    assert read_db.lag == 0
+
+
+def test_startup_does_not_need_replica():
+    read_db, _, replica = router()
+    replica.down = True
+
+    async def startup_and_read():
+        await read_db.connect()
+        return await read_db.fetch_all("q")
+
+    assert asyncio.run(startup_and_read()) == ["primary"]
+    assert read_db.lag is None
+
+
+def test_replica_is_connected_to_once_it_is_up():
+    read_db, _, replica = router()
+    replica.down = True
+
+    async def reads():
+        down = await read_db.fetch_val("q")
+        replica.down = False
+        up = await read_db.fetch_val("q")
+        again = await read_db.fetch_val("q")
+        return down, up, again
+
+    assert asyncio.run(reads()) == ("primary", "replica", "replica")
+    assert replica.connects == 2
+
+
+def test_failed_replica_query_is_run_on_primary():
+    primary = StubDatabase("primary")
+    replica = StubDatabase("replica")
+    read_db = ReadRouter(primary, replica, max_lag=5, check_interval=60)
+
+    async def reads():
+        first = await read_db.fetch_val("q1")
+        replica.down = True
+        failed_over = await read_db.fetch_val("q2")
+        replica.down = False
+        # the replica is left alone until its next lag check
+        after = await read_db.fetch_val("q3")
+        return first, failed_over, after
+
+    assert asyncio.run(reads()) == ("replica", "primary", "primary")
+    assert primary.queries == ["q2", "q3"]
+    assert replica.queries == ["q1"]
+
+
+def test_pool_stats_without_pool():
+    empty = {"size": 0, "idle": 0, "max_size": 0}
+    assert pool_stats(object()) == empty
+    assert pool_stats(StubDatabase("primary")) == empty
@@ -0,0 +1,87 @@
+import asyncio
+import asyncpg
+import pytest
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import InvalidRequestError
+from shared.db import Users
+from shared.statements import Statement
+
+GET_LEVEL = Statement(
+    select(Users.level).where(Users.username == bindparam("username"), Users.xp >= 10)
+)
+
+
+class StubConnection:
+    """Stands in for the asyncpg connection of a databases connection; fails every query with a
+    stale plan error."""
+
+    def __init__(self, in_transaction: bool):
+        self.in_transaction = in_transaction
+
+    @property
+    def raw_connection(self):
+        return self
+
+    def is_in_transaction(self) -> bool:
+        return self.in_transaction
+
+    async def fetchrow(self, sql, *args):
+        raise asyncpg.InvalidCachedStatementError("cached statement plan is invalid")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class StubRow(dict):
+    """Stands in for an asyncpg record: a mapping that can also be indexed by position."""
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+
+class StubDatabase:
+    def __init__(self, in_transaction: bool):
+        self.in_transaction = in_transaction
+        self.fallbacks = []
+
+    def connection(self):
+        return StubConnection(self.in_transaction)
+
+    async def fetch_val(self, query, values=None, column=0):
+        self.fallbacks.append(query)
+        return 3
+
+
+def test_arguments_in_bindparam_order():
+    assert GET_LEVEL.arguments({"username": "ada"}) == ["ada", 10]
+    assert GET_LEVEL.arguments({"username": "ada", "xp_1": 20}) == ["ada", 20]
+
+
+def test_arguments_require_values_for_bindparams():
+    with pytest.raises(InvalidRequestError, match="username"):
+        GET_LEVEL.arguments({"user": "ada"})
+
+
+def test_rows_are_databases_records():
+    # Statement reads private attributes of SQLAlchemy's compiled statements and of databases, which
+    # this fails without
+    record = GET_LEVEL._record(StubRow(level=3))
+    assert record["level"] == record[0] == record.level == 3
+
+
+def test_stale_plan_is_run_again_outside_transaction():
+    database = StubDatabase(in_transaction=False)
+    assert asyncio.run(GET_LEVEL.run(database, "fetch_val", {"username": "ada"})) == 3
+    assert len(database.fallbacks) == 1
+
+
+def test_stale_plan_is_raised_in_transaction():
+    database = StubDatabase(in_transaction=True)
+    with pytest.raises(asyncpg.InvalidCachedStatementError):
+        asyncio.run(GET_LEVEL.run(database, "fetch_val", {"username": "ada"}))
+    assert database.fallbacks == []
@@ -0,0 +1,129 @@
+import copy
+import random
+import pytest
+from pydantic import ValidationError
+from shared.schemas import ObservationEvent
+from shared.validator import SchemaError, get_observation_validator
+
+SQUARE = [[-122.29, 37.79], [-122.28, 37.79], [-122.28, 37.8], [-122.29, 37.79]]
+EVENT = {
+    "observer": "test@example.com",
+    "source": "scrape",
+    "observed_at": "2022-11-24T23:30:35+0000",
+    "submitted_at": "2022-11-24T23:30:35+0000",
+    "location": {"longitude": -122.2850385, "latitude": 37.7987407},
+}
+
+
+def extent(*geometries: dict) -> dict:
+    features = [{"type": "Feature", "geometry": g, "properties": {}} for g in geometries]
+    return {
+        **EVENT,
+        "payload": {
+            "observation_type": "extent",
+            "boundary_type": "administrative_boundary",
+            "landuse_type": "developed:open_space:park_rec_area[211]",
+            "shape": {"type": "FeatureCollection", "features": features},
+        },
+    }
+
+
+DOCUMENTS = [
+    {
+        **EVENT,
+        "payload": [
+            {
+                "payload_ref": "1",
+                "observation_type": "asset",
+                "asset_type": "container:multimodal_container:40ft",
+                "asset_id": {"id_type": "BIC", "id_text": "CSQU 305438 3"},
+            },
+            {
+                "observation_type": "facility",
+                "description": "PG&E Substation C",
+                "functions": ["energy:electricity:voltage:lower"],
+                "props": {"operator": "PG&E"},
+            },
+        ],
+    },
+    extent(
+        {"type": "Polygon", "coordinates": [SQUARE]},
+        {"type": "MultiPolygon", "coordinates": [[SQUARE]]},
+    ),
+    extent(
+        {"type": "Point", "coordinates": [-122.29, 37.79]},
+        {"type": "LineString", "coordinates": SQUARE[:2]},
+        {"type": "GeometryCollection", "geometries": [{"type": "Polygon", "coordinates": [SQUARE]}]},
+    ),
+]
+# values that mutations put in place of parts of the documents
+VALUES = [-200.0, 181, 95.0, -91, 0, 1.5, True, None, "x", "", [], {}, [1, 2], [1.0, 2.0, 3.0]]
+
+
+def pydantic_accepts(document) -> bool:
+    try:
+        ObservationEvent.parse_obj(copy.deepcopy(document))
+    except ValidationError:
+        return False
+    return True
+
+
+def paths(value, path=()):
+    yield path
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from paths(item, path + (key,))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            yield from paths(item, path + (i,))
+
+
+def mutate(document, rng: random.Random):
+    """The document with one to three of its parts replaced or removed."""
+    document = copy.deepcopy(document)
+    for _ in range(rng.randint(1, 3)):
+        path = rng.choice([p for p in paths(document) if p])
+        parent = document
+        for key in path[:-1]:
+            parent = parent[key]
+        if rng.random() < 0.2:
+            del parent[path[-1]]
+        else:
+            parent[path[-1]] = copy.deepcopy(rng.choice(VALUES))
+    return document
+
+
+def test_accepts_documents():
+    validate = get_observation_validator()
+    for document in DOCUMENTS:
+        assert pydantic_accepts(document)
+        validate(document)
+
+
+@pytest.mark.parametrize(
+    "geometry",
+    [
+        {"type": "Polygon", "coordinates": [SQUARE[:3] + [[-122.3, 37.79]]]},
+        {"type": "Polygon", "coordinates": [[[-200.0, 37.79], *SQUARE[1:3], [-200.0, 37.79]]]},
+        {"type": "Point", "coordinates": [-122.29, 95.0]},
+        {"type": "MultiPolygon", "coordinates": [[[[181, 0], [0, 1], [1, 1], [181, 0]]]]},
+        {"type": "GeometryCollection", "geometries": [{"type": "Point", "coordinates": [-181, 0]}]},
+    ],
+)
+def test_rejects_geometries(geometry):
+    document = extent(geometry)
+    assert not pydantic_accepts(document)
+    with pytest.raises(SchemaError) as e:
+        get_observation_validator()(document)
+    assert str(e.value).startswith("/payload/shape/features/0/geometry")
+
+
+def test_accepts_only_what_pydantic_accepts():
+    # the validator may be stricter than pydantic, which coerces some values (e.g. numbers to
+    # strings), but never accepts a document that pydantic rejects
+    validate = get_observation_validator()
+    rng = random.Random(0)
+    for _ in range(3000):
+        document = mutate(rng.choice(DOCUMENTS), rng)
+        if validate.is_valid(document):
+            assert pydantic_accepts(document), document